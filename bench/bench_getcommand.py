@@ -0,0 +1,89 @@
+#!/usr/bin/python3
+"""Micro-benchmark: QCommandIndex lookup against the old linear scan of qbot.getCommand()
+
+Usage: python3 bench/bench_getcommand.py [--commands N] [--modules M] [--lookups K]
+"""
+import os
+import sys
+import random
+import argparse
+from timeit import default_timer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'run'))
+from qcommands import QCommandIndex
+
+def linear_lookup(commands, cmdFull_original):
+    """getCommand() body as it was before QCommandIndex"""
+    cmdFull = cmdFull_original.strip()
+    cmdLower = cmdFull.lower()
+    cmd = None
+    params = None
+    res_len = 0
+    for c in commands:
+        cLower = c['commandtext'].lower()
+        managerLower = c['module'].lower()
+        if (cmdLower.startswith(cLower) or cmdLower.startswith('%s.%s' % (managerLower, cLower))) and len(c['commandtext']) > res_len:
+            cmd = c
+            res_len = len(c['commandtext'])
+            cmd_index = cmdLower.find(cLower)
+            params = '"%s"' % cmdFull[res_len+cmd_index:].strip()
+    return {'command': cmd, 'params': params}
+
+def index_lookup(index, cmdFull_original):
+    cmdFull = cmdFull_original.strip()
+    cmd, params_index = index.lookup(cmdFull)
+    params = '"%s"' % cmdFull[params_index:].strip() if cmd else None
+    return {'command': cmd, 'params': params}
+
+def make_commands(n, modules):
+    words = ['relay', 'sensor', 'get', 'set', 'radio', 'on', 'off', 'temperature', 'status', 'file', 'реле', 'вкл', 'выкл']
+    rnd = random.Random(1)
+    commands = []
+    for i in range(n):
+        text = ' '.join(rnd.sample(words, rnd.randint(1, 3)))
+        commands.append({'commandtext': '%s %d' % (text.capitalize(), i), 'module': 'mod%d' % (i % modules)})
+    return commands
+
+def make_texts(commands, k):
+    rnd = random.Random(2)
+    texts = []
+    for i in range(k):
+        c = rnd.choice(commands)
+        kind = i % 3
+        if kind == 0:
+            texts.append('%s 1, 2 3' % c['commandtext'].upper())
+        elif kind == 1:
+            texts.append('%s.%s Param' % (c['module'], c['commandtext']))
+        else:
+            texts.append('Unknown command %d' % i)
+    return texts
+
+def measure(func, arg, texts):
+    t0 = default_timer()
+    for t in texts:
+        func(arg, t)
+    return (default_timer() - t0) / len(texts)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='getCommand() micro-benchmark')
+    parser.add_argument('--commands', type=int, default=3000, help='number of commands')
+    parser.add_argument('--modules', type=int, default=10, help='number of manager modules')
+    parser.add_argument('--lookups', type=int, default=3000, help='number of lookups')
+    args = parser.parse_args()
+
+    commands = make_commands(args.commands, args.modules)
+    texts = make_texts(commands, args.lookups)
+    t0 = default_timer()
+    index = QCommandIndex(commands)
+    build = default_timer() - t0
+    #Both implementations should give the same results
+    for t in texts:
+        a, b = linear_lookup(commands, t), index_lookup(index, t)
+        assert a['command'] is b['command'] and a['params'] == b['params'], (t, a, b)
+    linear = measure(linear_lookup, commands, texts)
+    trie = measure(index_lookup, index, texts)
+    print('%d commands, %d modules, %d lookups' % (args.commands, args.modules, args.lookups))
+    print('index build: %.1f ms' % (build * 1000))
+    print('linear scan: %.1f us/lookup' % (linear * 1e6))
+    print('trie index:  %.1f us/lookup' % (trie * 1e6))
+    print('speedup: %.0fx' % (linear / trie))
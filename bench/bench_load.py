@@ -0,0 +1,170 @@
+#!/usr/bin/python3
+"""Load benchmark: runs real qbot init()/main() with in-memory connector and manager module (see qbench.py)
+
+Commands are generated by M simulated users at stepping rates. Every step reports command latency
+(p50/p95/p99/max, from the scheduled send time to the reply), CPU and RSS of qbot and its manager processes.
+The highest rate with all the replies received and p99 below --max-p99 is the max sustainable rate.
+
+Results may be saved and compared with the previous run to catch regressions:
+    python3 bench/bench_load.py --save before.json
+    ...changes...
+    python3 bench/bench_load.py --compare before.json
+
+Usage: python3 bench/bench_load.py [--rates 50,100,200] [--duration 10] [--users 20] [--texts Help,Work]
+"""
+import os
+import sys
+import json
+import tempfile
+import argparse
+import threading
+from time import sleep, monotonic
+
+benchdir = os.path.dirname(os.path.abspath(__file__))
+rundir = os.path.join(benchdir, '..', 'run')
+sys.path.insert(0, rundir)
+sys.path.insert(0, benchdir)
+import yaml
+import psutil
+
+def make_config(args):
+    """Returns qbot configuration with bench connector and manager module"""
+    commands = yaml.safe_load(open(os.path.join(rundir, 'conf', 'commands.yaml')))
+    users = ['user%d' % i for i in range(args.users)]
+    return {
+        'loglevel': 'WARNING',
+        'event_loop': True,
+        'executor': {'workers': args.workers, 'timeout': 60},
+        'alerts': {'coalesce_window': 0},
+        'commands': commands,
+        'connectors': [{'name': 'Bench', 'module': 'qbench', 'class': 'QBenchMessenger', 'default': True, 'timeout': args.poll}],
+        'contacts': [{'address': 'bench', 'channel': 'QBenchMessenger', 'description': 'Bench'}],
+        'users': [{'user_id': x, 'channel': 'QBenchMessenger', 'name': x} for x in users],
+        'managers': [{'name': 'bench', 'module': 'qbench', 'class': 'QBenchManager', 'timeout': 1, 'triggers': [],
+                      'process_cost': args.process_cost, 'command_cost': args.command_cost,
+                      'commands': [{'commandtext': 'Work', 'commandline': 'self.work(COMMAND_PARAMETERS)', 'helptext': 'Bench command'}]}],
+    }
+
+def percentile(values, q):
+    return values[int(q * (len(values) - 1))] if values else 0
+
+def usage(proc):
+    """Returns CPU seconds and RSS bytes of process and its children"""
+    procs = [proc] + proc.children(recursive=True)
+    cpu, rss = 0, 0
+    for p in procs:
+        try:
+            t = p.cpu_times()
+            cpu += t.user + t.system
+            rss += p.memory_info().rss
+        except psutil.Error:
+            pass
+    return cpu, rss
+
+def run_step(connector, rate, args, users, texts):
+    """Runs one load step. Returns its results dict"""
+    proc = psutil.Process()
+    cpu0, _ = usage(proc)
+    t0 = monotonic()
+    connector.set_load(rate, users, texts)
+    sleep(args.duration)
+    sent = connector.stop_load()
+    drainEnd = monotonic() + max(args.duration, 5)
+    while len(connector.replies) < sent and monotonic() < drainEnd:
+        sleep(0.05)
+    wall = monotonic() - t0
+    cpu1, rss = usage(proc)
+    latencies = sorted([x[1] for x in connector.replies])
+    res = {'rate': rate, 'sent': sent, 'replied': len(latencies),
+           'p50': percentile(latencies, 0.5), 'p95': percentile(latencies, 0.95), 'p99': percentile(latencies, 0.99),
+           'max': latencies[-1] if latencies else 0, 'cpu': (cpu1 - cpu0) / wall * 100, 'rss_mb': rss / 2 ** 20}
+    res['sustained'] = res['replied'] >= sent * 0.99 and res['p99'] <= args.max_p99
+    return res
+
+def compare(results, baseline, tolerance, min_delta):
+    """Prints differences with baseline. Returns list of regressions
+
+    Latency is a regression if it grew more than tolerance part and more than min_delta seconds (timer noise)
+    """
+    regressions = []
+    base_steps = {x['rate']: x for x in baseline['steps']}
+    print('\nComparison with baseline (tolerance %d%%):' % (tolerance * 100))
+    for step in results['steps']:
+        base = base_steps.get(step['rate'])
+        if not base:
+            continue
+        for key in ('p50', 'p95', 'p99'):
+            change = (step[key] - base[key]) / base[key] if base[key] else 0
+            mark = ''
+            if change > tolerance and step[key] - base[key] > min_delta:
+                mark = ' REGRESSION'
+                regressions.append('rate %s %s' % (step['rate'], key))
+            print('  rate %5s %s: %8.2f ms -> %8.2f ms (%+.0f%%)%s' % (step['rate'], key, base[key] * 1000, step[key] * 1000, change * 100, mark))
+    if results['params']['rates'] != baseline['params']['rates']:
+        print('  max sustainable rate: not compared, rates differ')
+        return regressions
+    if results['max_rate'] < baseline['max_rate'] * (1 - tolerance):
+        regressions.append('max rate')
+    print('  max sustainable rate: %s -> %s' % (baseline['max_rate'], results['max_rate']))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description='qbot load benchmark')
+    parser.add_argument('--rates', default='25,50,100,200,400', help='commands per second for every step, comma separated')
+    parser.add_argument('--duration', type=float, default=10, help='seconds of every step')
+    parser.add_argument('--users', type=int, default=20, help='simulated users')
+    parser.add_argument('--texts', default='Help,Work', help='commands sent by turn, comma separated')
+    parser.add_argument('--workers', type=int, default=4, help='executor worker threads')
+    parser.add_argument('--poll', type=float, default=0.01, help='connector poll interval, seconds')
+    parser.add_argument('--process-cost', type=float, default=0.001, help='manager process() CPU cost, seconds')
+    parser.add_argument('--command-cost', type=float, default=0.001, help='manager command CPU cost, seconds')
+    parser.add_argument('--max-p99', type=float, default=1.0, help='p99 latency limit of sustainable rate, seconds')
+    parser.add_argument('--save', help='save results to JSON file')
+    parser.add_argument('--compare', help='compare results with JSON file saved before. Exit code 1 if regressions found')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed degradation for --compare')
+    parser.add_argument('--min-delta', type=float, default=0.005, help='latency growth below it is not a regression, seconds')
+    args = parser.parse_args()
+
+    args.save = os.path.abspath(args.save) if args.save else None
+    args.compare = os.path.abspath(args.compare) if args.compare else None
+    workdir = tempfile.mkdtemp(prefix='qbot_bench_')
+    confFileName = os.path.join(workdir, 'qbot.yaml')
+    with open(confFileName, 'w') as f:
+        yaml.safe_dump(make_config(args), f, allow_unicode=True)
+    os.chdir(workdir) #qbot creates its files in working directory
+    import qbot
+    qbot.reload = lambda: 'bench: no restart' #main() calls it on exit
+    qbot.init(confFileName, os.path.join(workdir, 'qbot.pid'), os.path.join(workdir, 'logqbot.txt'))
+    mainThread = threading.Thread(target=qbot.main, name='qbot_main', daemon=True)
+    mainThread.start()
+    connector = qbot.connectors[0]['connector']
+    users = ['user%d' % i for i in range(args.users)]
+    texts = args.texts.split(',')
+    sleep(1) #let managers start
+
+    results = {'params': vars(args), 'steps': [], 'max_rate': 0}
+    print('%6s %7s %7s %9s %9s %9s %9s %6s %8s' % ('rate', 'sent', 'replied', 'p50 ms', 'p95 ms', 'p99 ms', 'max ms', 'cpu%', 'rss MB'))
+    for rate in [float(x) for x in args.rates.split(',')]:
+        step = run_step(connector, rate, args, users, texts)
+        results['steps'].append(step)
+        print('%6g %7d %7d %9.2f %9.2f %9.2f %9.2f %6.0f %8.1f%s' % (rate, step['sent'], step['replied'], step['p50'] * 1000, step['p95'] * 1000,
+              step['p99'] * 1000, step['max'] * 1000, step['cpu'], step['rss_mb'], '' if step['sustained'] else '  not sustained'))
+        if not step['sustained']:
+            break
+        results['max_rate'] = rate
+    print('Max sustainable rate: %g commands/s' % results['max_rate'])
+
+    qbot.isWorking = False
+    mainThread.join(30)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2)
+        print('Results saved to %s' % args.save)
+    if args.compare:
+        regressions = compare(results, json.load(open(args.compare)), args.tolerance, args.min_delta)
+        if regressions:
+            print('Regressions: %s' % ', '.join(regressions))
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+#!/usr/bin/python3
+"""In-memory connector and manager module for qbot load benchmarks (see bench_load.py)
+
+QBenchMessenger generates commands of simulated users at the given rate and timestamps the replies.
+QBenchManager is a manager module with configurable process() and command cost.
+Both may have 'init_delay' seconds to simulate slow constructors (network login etc)
+"""
+
+import threading
+from time import monotonic, sleep
+from qmessenger import QMessenger
+from qbasemanager import QBaseManager
+
+def burn(seconds):
+    """Keeps CPU busy for seconds"""
+    end = monotonic() + seconds
+    while monotonic() < end:
+        pass
+
+class QBenchMessenger(QMessenger):
+    """Connector without network. Commands are generated by set_load(), replies are collected in self.replies"""
+    def __init__(self, **config):
+        QMessenger.__init__(self, **config)
+        sleep(config['init_delay'] if 'init_delay' in config.keys() else 0)
+        self.lock = threading.Lock()
+        self.rate = 0
+        self.users = []
+        self.texts = []
+        self.sent = 0
+        self.nextTime = None
+        self.replies = [] #(user, latency in seconds)
+        self.messages = 0 #messages sent by sendMessage() (alerts, start message)
+        self.logger.info('Init completed')
+
+    def set_load(self, rate, users, texts):
+        """Starts to generate rate commands per second from users. Commands are taken from texts by turn"""
+        with self.lock:
+            self.rate = rate
+            self.users = users
+            self.texts = texts
+            self.sent = 0
+            self.nextTime = monotonic()
+            self.replies = []
+
+    def stop_load(self):
+        """Stops commands generation. Returns number of commands generated"""
+        with self.lock:
+            self.rate = 0
+            return self.sent
+
+    def getMessages(self):
+        res = {'ok': True, 'messages': [], 'status': 'OK'}
+        with self.lock:
+            if not self.rate:
+                return res
+            now = monotonic()
+            #Every command gets its scheduled time, so latency includes the time it waited for poll
+            while self.nextTime <= now:
+                user = self.users[self.sent % len(self.users)]
+                text = self.texts[self.sent % len(self.texts)]
+                res['messages'].append({'text': text, 'caption': None, 'files': [], 'message_id': self.sent, 'user_id': user,
+                                        'message_time': now, 'replyto': user, 'message': {'scheduled': self.nextTime}})
+                self.sent += 1
+                self.nextTime += 1.0 / self.rate
+        return res
+
+    def sendReply(self, msg, originalCommand):
+        latency = monotonic() - originalCommand['message']['scheduled']
+        with self.lock:
+            self.replies.append((originalCommand['user_id'], latency))
+        return 'OK'
+
+    def sendMessage(self, msg, to):
+        with self.lock:
+            self.messages += 1
+        return 'OK'
+
+class QBenchManager(QBaseManager):
+    """Manager module spending process_cost seconds of CPU every turn and command_cost seconds for every command"""
+    def __init__(self, **config):
+        QBaseManager.__init__(self, **config)
+        sleep(config['init_delay'] if 'init_delay' in config.keys() else 0)
+        self.process_cost = config['process_cost'] if 'process_cost' in config.keys() else 0
+        self.command_cost = config['command_cost'] if 'command_cost' in config.keys() else 0
+
+    def process(self):
+        burn(self.process_cost)
+
+    def work(self, params=None):
+        burn(self.command_cost)
+        return 'done %s' % params
@@ -0,0 +1,73 @@
+#!/usr/bin/python3
+"""Alerts coalescing for qbot
+
+Alerts from manager modules are buffered for 'window' seconds per destination (connector and address).
+Identical texts are merged with repeat count, and the buffer is sent as one message. It saves paid SMS
+and keeps chats readable when a trigger fires repeatedly or several managers alert at once.
+Urgent alerts are sent at once together with the alerts already buffered for the destination
+"""
+
+import logging
+from collections import OrderedDict
+from time import monotonic
+
+class QAlertCoalescer:
+    """Buffers alerts per destination and sends them as combined messages (see flush())"""
+    def __init__(self, send, window=0, max_items=20, logger=None):
+        """Sets coalescer values:
+
+        send(connector, address, msg, since) - sends message to one destination. since - time (monotonic) of the first alert in it
+        window - default buffering time in seconds. 0 - send alerts at once. Connector may override it with 'coalesce_window'
+        max_items - maximum different texts in one message. Buffer is flushed when it's reached
+        """
+        self.send = send
+        self.window = window
+        self.max_items = max_items
+        self.logger = logger if logger else logging.getLogger(__name__)
+        self.buffers = {} #(connector name, address) -> {'connector', 'address', 'deadline', 'since', 'texts': OrderedDict(text -> count)}
+
+    def add(self, text, connectors, urgent=False, since=None):
+        """Buffers alert text for all the addresses of connectors. since - time (monotonic) the alert was raised"""
+        now = monotonic()
+        since = since if since else now
+        for connector in connectors:
+            window = connector['coalesce_window'] if connector.get('coalesce_window') is not None else self.window
+            for to in connector['to']:
+                key = (connector['name'], to['address'])
+                buf = self.buffers.get(key)
+                if not buf:
+                    buf = {'connector': connector, 'address': to['address'], 'deadline': now + window, 'since': since, 'texts': OrderedDict()}
+                    self.buffers[key] = buf
+                buf['since'] = min(buf['since'], since)
+                buf['texts'][text] = buf['texts'].get(text, 0) + 1
+                if urgent or not window or len(buf['texts']) >= self.max_items:
+                    self.flush_buffer(key)
+
+    def next_deadline(self):
+        """Returns the nearest time (monotonic) to flush or None if nothing is buffered"""
+        if not self.buffers:
+            return None
+        return min([x['deadline'] for x in self.buffers.values()])
+
+    def flush(self, force=False):
+        """Sends the buffers whose window expired (all of them if force). Returns number of messages sent"""
+        now = monotonic()
+        expired = [k for k, v in self.buffers.items() if force or v['deadline'] <= now]
+        for key in expired:
+            self.flush_buffer(key)
+        return len(expired)
+
+    def flush_buffer(self, key):
+        buf = self.buffers.pop(key)
+        try:
+            self.send(buf['connector'], buf['address'], self.combine(buf['texts']), buf['since'])
+        except Exception as err:
+            self.logger.error('Could not send alert to %s: %s' % (key, err))
+
+    @staticmethod
+    def combine(texts):
+        """Makes one message from OrderedDict text -> repeat count"""
+        lines = []
+        for text, count in texts.items():
+            lines.append(text if count == 1 else '%s (x%d)' % (text, count))
+        return '\n'.join(lines)
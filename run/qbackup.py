@@ -0,0 +1,225 @@
+#!/usr/bin/python3
+"""Backup store for qbot (Backup, Update, Restore commands)
+
+Files are stored by their content: every unique file is compressed once to objects/<sha256>.gz,
+a snapshot is a small manifest (snapshots/<name>.json) of file paths with their hash, size, mtime and mode.
+Files not changed since the previous snapshot of the same source (size and mtime) are not read again.
+New files are hashed and compressed in a process pool. Restore writes just the files differing from the snapshot.
+The oldest snapshots are deleted when the store is bigger than 'budget' bytes (the last 'keep' ones stay)
+Snapshot and prune hold exclusive lock of the store (file 'lock', so processes are locked too), restore - shared one:
+objects of a snapshot being saved are not deleted as unused before its manifest is written
+
+Command line (start_qbot.sh restores the last snapshot if updated qbot could not start):
+    python3 run/qbackup.py [--store backup/store] list|restore [NAME]
+"""
+
+import os
+import sys
+import json
+import gzip
+import fcntl
+import shutil
+import hashlib
+import datetime
+import argparse
+from contextlib import contextmanager
+
+READ_SIZE = 1 << 20
+
+def file_hash(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(READ_SIZE), b''):
+            h.update(block)
+    return h.hexdigest()
+
+def store_file(path, objects):
+    """Hashes file and compresses it to objects directory if there is no such object yet. Returns hash
+
+    Module level function, so it can run in process pool
+    """
+    digest = file_hash(path)
+    obj = os.path.join(objects, digest[:2], '%s.gz' % digest)
+    if not os.path.exists(obj):
+        os.makedirs(os.path.dirname(obj), exist_ok=True)
+        tmp = '%s.%d.tmp' % (obj, os.getpid())
+        with open(path, 'rb') as src, gzip.open(tmp, 'wb', 6) as dst:
+            shutil.copyfileobj(src, dst, READ_SIZE)
+        os.replace(tmp, obj)
+    return digest
+
+class QBackupStore:
+    """Content addressed snapshots of directories"""
+    def __init__(self, root, budget=0, keep=3):
+        """root - store directory, budget - maximum size of objects in bytes (0 - no limit), keep - snapshots never deleted by budget"""
+        self.root = root
+        self.objects = os.path.join(root, 'objects')
+        self.snapshots = os.path.join(root, 'snapshots')
+        self.budget = budget
+        self.keep = keep
+
+    @contextmanager
+    def locked(self, exclusive=True):
+        """Holds the store lock while in with block"""
+        os.makedirs(self.root, exist_ok=True)
+        with open(os.path.join(self.root, 'lock'), 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def object_path(self, digest):
+        return os.path.join(self.objects, digest[:2], '%s.gz' % digest)
+
+    def manifests(self, source=None):
+        """Returns manifests of snapshots (of source if given), the oldest first"""
+        if not os.path.isdir(self.snapshots):
+            return []
+        res = []
+        for name in os.listdir(self.snapshots):
+            if name.endswith('.json'):
+                with open(os.path.join(self.snapshots, name)) as f:
+                    manifest = json.load(f)
+                if not source or manifest['source'] == source:
+                    res.append(manifest)
+        return sorted(res, key=lambda x: x['time'])
+
+    def manifest(self, name=None, source=None):
+        """Returns manifest of snapshot name or the last one (of source if given). None if not found"""
+        if name:
+            fileName = os.path.join(self.snapshots, '%s.json' % name)
+            if not os.path.exists(fileName):
+                return None
+            with open(fileName) as f:
+                return json.load(f)
+        manifests = self.manifests(source)
+        return manifests[-1] if manifests else None
+
+    def snapshot(self, source, name=None, pool=None):
+        """Saves file or directory source (relative to working directory). Returns manifest
+
+        pool - concurrent.futures executor for hashing and compression of the new files. None - in this process
+        """
+        source = os.path.normpath(source)
+        if not os.path.exists(source):
+            raise FileNotFoundError('No such file or directory: %s' % source)
+        with self.locked():
+            return self._snapshot(source, name, pool)
+
+    def _snapshot(self, source, name, pool):
+        now = datetime.datetime.now()
+        name = name if name else '%s-%s' % (os.path.basename(source), now.strftime('%Y%m%d-%H%M%S-%f')) #unique for snapshots following each other
+        if os.path.exists(os.path.join(self.snapshots, '%s.json' % name)):
+            raise FileExistsError('Snapshot %s already exists' % name)
+        previous = self.manifest(source=source)
+        previous = previous['files'] if previous else {}
+        files, new = {}, []
+        paths = [source] if os.path.isfile(source) else [os.path.join(d, x) for d, _, names in os.walk(source) for x in names]
+        for path in paths:
+            if not os.path.isfile(path): #sockets, broken links
+                continue
+            st = os.stat(path)
+            files[path] = {'size': st.st_size, 'mtime': st.st_mtime, 'mode': st.st_mode & 0o7777}
+            old = previous.get(path)
+            if old and old['size'] == st.st_size and old['mtime'] == st.st_mtime and os.path.exists(self.object_path(old['hash'])):
+                files[path]['hash'] = old['hash']
+            else:
+                new.append(path)
+        mapper = pool.map if pool else map
+        for path, digest in zip(new, mapper(store_file, new, [self.objects] * len(new))):
+            files[path]['hash'] = digest
+        manifest = {'name': name, 'source': source, 'created': now.strftime('%Y-%m-%d %H:%M:%S'), 'time': now.timestamp(), 'files': files,
+                    'new': len(new), 'size': sum([x['size'] for x in files.values()])}
+        os.makedirs(self.snapshots, exist_ok=True)
+        fileName = os.path.join(self.snapshots, '%s.json' % name)
+        with open('%s.tmp' % fileName, 'w') as f:
+            json.dump(manifest, f)
+        os.replace('%s.tmp' % fileName, fileName)
+        manifest['deleted'] = self._prune()
+        return manifest
+
+    def restore(self, name=None, source=None):
+        """Restores snapshot name (the last one of source if not given) to working directory
+
+        Files having snapshot size and mtime, or the same content, are not written. Returns (manifest, files written)
+        """
+        with self.locked(False):
+            return self._restore(name, source)
+
+    def _restore(self, name, source):
+        manifest = self.manifest(name, source)
+        if not manifest:
+            raise FileNotFoundError('Snapshot %s not found' % (name if name else 'of %s' % source))
+        written = 0
+        for path, info in manifest['files'].items():
+            if os.path.isfile(path):
+                st = os.stat(path)
+                if st.st_size == info['size'] and (st.st_mtime == info['mtime'] or file_hash(path) == info['hash']):
+                    continue
+            folder = os.path.dirname(path)
+            if folder:
+                os.makedirs(folder, exist_ok=True)
+            tmp = '%s.restore.tmp' % path
+            with gzip.open(self.object_path(info['hash']), 'rb') as src, open(tmp, 'wb') as dst:
+                shutil.copyfileobj(src, dst, READ_SIZE)
+            os.chmod(tmp, info['mode'])
+            os.utime(tmp, (info['mtime'], info['mtime']))
+            os.replace(tmp, path)
+            written += 1
+        return manifest, written
+
+    def objects_size(self):
+        """Returns {hash: compressed size} of stored objects"""
+        res = {}
+        if os.path.isdir(self.objects):
+            for d in os.listdir(self.objects):
+                for x in os.listdir(os.path.join(self.objects, d)):
+                    if x.endswith('.gz'):
+                        res[x[:-3]] = os.path.getsize(os.path.join(self.objects, d, x))
+        return res
+
+    def prune(self):
+        """Deletes the oldest snapshots while objects exceed budget, then the objects no snapshot uses. Returns deleted snapshot names"""
+        with self.locked():
+            return self._prune()
+
+    def _prune(self):
+        manifests = self.manifests()
+        sizes = self.objects_size()
+        deleted = []
+        def used(manifests):
+            return set([x['hash'] for m in manifests for x in m['files'].values()])
+        while self.budget and len(manifests) > self.keep and sum([sizes.get(x, 0) for x in used(manifests)]) > self.budget:
+            m = manifests.pop(0)
+            os.remove(os.path.join(self.snapshots, '%s.json' % m['name']))
+            deleted.append(m['name'])
+        for digest in set(sizes) - used(manifests):
+            os.remove(self.object_path(digest))
+        return deleted
+
+    def status(self):
+        """Returns text list of snapshots and store size"""
+        manifests = self.manifests()
+        lines = ['%s: %s, %d files, %d new, %d bytes' % (m['name'], m['created'], len(m['files']), m.get('new', 0), m['size']) for m in manifests]
+        lines.append('Store: %d snapshots, %d bytes compressed%s' % (len(manifests), sum(self.objects_size().values()),
+                                                                    ', budget %d' % self.budget if self.budget else ''))
+        return '\n'.join(lines)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='qbot backup store')
+    parser.add_argument('--store', default='backup/store', help='store directory (default backup/store)')
+    parser.add_argument('--source', default='run', help='source of the last snapshot for restore without name (default run)')
+    parser.add_argument('action', choices=['list', 'restore'])
+    parser.add_argument('name', nargs='?', help='snapshot name for restore (default the last one)')
+    args = parser.parse_args()
+    store = QBackupStore(args.store)
+    try:
+        if args.action == 'list':
+            print(store.status())
+        else:
+            manifest, written = store.restore(args.name, args.source)
+            print('%s restored: %d of %d files written' % (manifest['name'], written, len(manifest['files'])))
+    except Exception as err:
+        print('Error: %s' % err)
+        sys.exit(1)
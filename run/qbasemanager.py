@@ -1,10 +1,17 @@
 #!/usr/bin/python3
 """Base for qbot manager modules"""
 
+#Name of the variable keeping command arguments in commandline
+PARAM_STRING = 'COMMAND_PARAMETERS'
+
 from multiprocessing import Process, Pipe
 import logging
-from time import sleep
+from qcommands import compile_commands
+from qmetrics import QMetrics
+from logging.handlers import QueueHandler
+from time import monotonic, time
 from datetime import datetime
+from collections.abc import Iterator
 
 class QBaseManager(Process):
     """Defines basic behaviour of manager module"""
@@ -15,8 +22,11 @@ class QBaseManager(Process):
         self.config = config
         self.logger = logging.getLogger(self.name)
         p_logger = self.config['logger'] #parent logger
-        for h in p_logger.handlers:
-            self.logger.addHandler(h)
+        if 'log_queue' in self.config.keys(): #records are written by main module (see qlog.QLogListener)
+            self.logger.addHandler(QueueHandler(self.config['log_queue']))
+        else:
+            for h in p_logger.handlers:
+                self.logger.addHandler(h)
         self.logger.setLevel(p_logger.level)
         self.logger.info('Init started')
         self.name = '%s_%s' % (self.name, self.config['name'])
@@ -34,53 +44,42 @@ class QBaseManager(Process):
         # semaphore for alert_pipe
         self.alert_pipe_semaphore = config['alert_pipe_semaphore']
         self.alert_pipe_semaphore.clear()
+        #module commands compiled to functions (self, COMMAND_PARAMETERS). Keys are lowercased command texts
+        self.commands = {}
+        commands = [dict(c) for c in self.config['commands']] if 'commands' in self.config.keys() else []
+        compile_commands(commands, ('self', PARAM_STRING), globals(), self.logger)
+        for c in commands:
+            self.commands[c['commandtext'].lower()] = c
         #initializing 'lastsent' field of triggers with None
         for trigger in self.config['triggers']:
             trigger['lastsent'] = None
         self.isWorking = True
         self.errors = [] #variable keeping errors occured. It's cleared every cycle turn
+        self.metrics = QMetrics() #module metrics. Main module gets them by rpc_metrics()
         #self.logger.debug(self.config)
         self.status = 'Init'
     
     def run(self):
         """Module func itself
 
-        Every cycle it checks command semaphore for new commands and if it's set run command
-        Then runs self.alert() function to check alert conditions
+        Commands from command pipe are run as soon as they come
+        Every 'timeout' seconds runs self.process() and then self.alert() function to check alert conditions
         
         """
         self.status = 'Running'
+        next_turn = monotonic() + self.timeout
         while self.isWorking:
-            self.errors = []
-            sleep(self.timeout)
+            #wait for commands until the next turn
+            if monotonic() < next_turn and self.command_pipe.poll(max(next_turn - monotonic(), 0)):
+                self.process_command_pipe()
+                continue
+            t0 = monotonic()
             try:
                 self.process()
             except Exception as err:
                 l_err = 'process() failed: %s' % err
                 self.logger.error(l_err)
                 self.errors.append(l_err)
-
-            if self.command_pipe_semaphore.is_set(): #check if new command has come
-                try:
-                    cmd = self.command_pipe.recv()
-                    self.command_pipe_semaphore.clear()
-                except Exception as err:
-                    l_err = 'command_pipe.recv() failed: %s' % err
-                    self.logger.error(l_err)
-                    self.errors.append(l_err)                
-                if cmd:
-                    l = locals()
-                    command = 'resp = %s' % cmd
-                    self.logger.debug(command)
-                    try:
-                        exec(command)
-                        self.logger.debug('Response: %s' % l['resp'])
-                        self.command_pipe.send(l['resp'])
-                    except Exception as err:
-                        l_err = "command failed: %s" % err
-                        self.errors.append(l_err)
-                        self.logger.error(l_err)
-                        self.command_pipe.send(l_err)
             #alert should be at the end of cycle in the case of alerting of errors
             try:
                 self.alert()
@@ -88,8 +87,103 @@ class QBaseManager(Process):
                 l_err = 'alert() failed: %s' % err
                 self.logger.error(l_err)
                 self.errors.append(l_err)            
+            self.metrics.observe('qbot_manager_turn_seconds', monotonic() - t0)
+            self.metrics.inc('qbot_manager_errors_total', len(self.errors))
+            self.errors = []
+            next_turn = monotonic() + self.timeout
         self.logger.info('Exit')
-                
+
+    def process_command_pipe(self):
+        """Runs all the requests from command pipe and sends responses back
+
+        Request is dict {'id': request_id, 'method': name, 'args': {...}} (see qrpc). It runs self.rpc_<name>(**args)
+        and the response is {'id': request_id, 'result': value} or {'id': request_id, 'error': text}
+        Plain string is run as python statement (like 'self.stop()') and its result is sent as is
+        """
+        while self.command_pipe.poll():
+            try:
+                request = self.command_pipe.recv()
+                self.command_pipe_semaphore.clear()
+            except Exception as err:
+                l_err = 'command_pipe.recv() failed: %s' % err
+                self.logger.error(l_err)
+                self.errors.append(l_err)
+                if isinstance(err, EOFError): #main module is gone
+                    self.stop()
+                return
+            if isinstance(request, dict):
+                self.logger.debug('Request: %s' % request)
+                try:
+                    response = {'id': request['id'], 'result': getattr(self, 'rpc_%s' % request['method'])(**request['args'])}
+                except Exception as err:
+                    l_err = "%s failed: %s" % (request['method'], err)
+                    self.errors.append(l_err)
+                    self.logger.error(l_err)
+                    response = {'id': request['id'], 'error': l_err}
+            else:
+                try:
+                    response = self.rpc_exec(request)
+                except Exception as err:
+                    response = "command failed: %s" % err
+                    self.errors.append(response)
+                    self.logger.error(response)
+            self.logger.debug('Response: %s' % response)
+            try:
+                self.command_pipe.send(response)
+            except Exception as err: #For example result can't be pickled
+                l_err = 'command_pipe.send() failed: %s' % err
+                self.logger.error(l_err)
+                self.errors.append(l_err)
+                if isinstance(response, dict):
+                    self.command_pipe.send({'id': response['id'], 'error': l_err})
+
+    def rpc_command(self, command, params):
+        """Runs module command with commandtext 'command'"""
+        if command.lower() not in self.commands:
+            raise Exception("Unknown command '%s'" % command)
+        command = self.commands[command.lower()]
+        if not command['function']:
+            raise Exception(command['error'])
+        t0 = monotonic()
+        try:
+            res = command['function'](self, params)
+            #Iterator can't be sent by pipe. Its chunks are joined here, main module splits the text to messages
+            return ''.join([str(x) for x in res]) if isinstance(res, Iterator) else res
+        finally:
+            self.metrics.observe('qbot_manager_command_seconds', monotonic() - t0, command=command['commandtext'])
+
+    def rpc_reload(self, commands=(), removed=(), triggers=None):
+        """Applies changed module configuration without restart (see qbot.reload_commands())
+
+        commands - added and changed commands to compile, removed - texts of commands to remove
+        triggers - new triggers list. The ones with the same condition and message keep their last alert time
+        """
+        commands = [dict(c) for c in commands]
+        failed = compile_commands(commands, ('self', PARAM_STRING), globals(), self.logger)
+        for text in removed:
+            self.commands.pop(text.lower(), None)
+        for c in commands:
+            self.commands[c['commandtext'].lower()] = c
+        res = '%d commands compiled (%d failed), %d removed' % (len(commands), failed, len(removed))
+        if triggers is not None:
+            lastsent = {(t['condition'], t['message']): t['lastsent'] for t in self.config['triggers']}
+            self.config['triggers'] = [dict(t, lastsent=lastsent.get((t['condition'], t['message']))) for t in triggers]
+            res = '%s, %d triggers' % (res, len(triggers))
+        self.logger.info('Reloaded: %s' % res)
+        return res
+
+    def rpc_metrics(self):
+        """Returns metrics snapshot (see QMetrics.snapshot())"""
+        return self.metrics.snapshot()
+
+    def rpc_exec(self, code):
+        """Runs python statement (like 'self.stop()') and returns its result"""
+        l = {'self': self}
+        command = 'resp = %s' % code
+        self.logger.debug(command)
+        exec(command, globals(), l)
+        return l['resp']
+
     #Checks the module triggers and send alerts to main module
     def alert(self):
         """Check alert conditions defined at module conf-file
@@ -106,24 +200,22 @@ class QBaseManager(Process):
             exec('cond = %s' % trigger['condition'])
             if l['cond']:
                 exec('msg = %s' % trigger['message'])
-                self.sendMessage(l['msg'])
+                self.sendMessage(l['msg'], trigger['urgent'] if 'urgent' in trigger.keys() else False)
                 trigger['lastsent'] = datetime.now()
     
     #sends message(alert) to the alert_pipe
-    def sendMessage(self, message):
-        """Puts message to alert_pipe. Main module should send it by default channel(s)"""
-        if self.alert_pipe_semaphore.is_set():
-            err = 'Alert pipe is busy'
-            self.logger.error(err)
-            self.errors.append(err)
-        else:
-            try: #We need this try cause the sendMessage function may appear within except clause
-                self.alert_pipe.send(message)
-                self.alert_pipe_semaphore.set()
-            except Exception as err:
-                l_err = 'sendAlert failed: %s' % err
-                self.logger.error(l_err)
-                self.errors.append(l_err)
+    def sendMessage(self, message, urgent=False):
+        """Puts message to alert_pipe. Main module should send it by default channel(s)
+
+        Main module merges alerts coming during coalesce window. Urgent ones are sent at once
+        """
+        try: #We need this try cause the sendMessage function may appear within except clause
+            self.alert_pipe.send({'text': message, 'urgent': urgent, 'time': time()})
+            self.alert_pipe_semaphore.set()
+        except Exception as err:
+            l_err = 'sendAlert failed: %s' % err
+            self.logger.error(l_err)
+            self.errors.append(l_err)
             
     def stop(self):
         """Stops module"""
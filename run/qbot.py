@@ -5,7 +5,7 @@ Basic terms:
 Connectors
     - additional modules each adding functionality of some messenger
     - base module - qmessenger (based on threading.Thread), base class - QMessenger
-    - methods to override: getMessages(), sendMessage(), sendFile()
+    - methods to override: getMessages(), sendMessage(), sendFile(), sendReply() if reply goes not to replyto address
 Manager modules
     - modules adding any desired functionality, commands and alerts
     - base module - qbasemanager (based on multiprocessing.Process), base class - QBaseManager
@@ -13,7 +13,8 @@ Manager modules
 Commands - strings described in conf-files (main or module's) that
     Commands definition fields:
         commandtext: user text. Command processor parse the commands and choose the longest start match from the user-text. The rest of user-string is assumed as command parameter
-        commandline: real python3 command to be execute in exec("response = 'commandline'") statement. Should return string
+        commandline: real python3 expression compiled once at load time to function(COMMAND_PARAMETERS, cmdObject). Should return string
+        args: optional parameters schema (int, int_list, string, path, bool or list of them). If given, COMMAND_PARAMETERS is the parsed value
 
 Need files: qbot.conf (or qbot_test.conf if isTest file exists) - configuration
             qmessenger.py - base module for connectors
@@ -27,38 +28,69 @@ Need files: qbot.conf (or qbot_test.conf if isTest file exists) - configuration
 VERSION = '1.3.8'
 
 #Check existance and validity of modules
+#Rarely used modules (psutil, tarfile) are imported where they are needed, connector and manager modules - when they are started
 try:
     import sys, os
-    import psutil
+    from time import sleep, monotonic, time
+    importStarted = monotonic()
     import signal
-    import tarfile
-    from time import sleep
-    from queue import Queue
-    import daemon
+    import atexit
+    import argparse
+    from queue import Queue, Empty
+    import threading
     import datetime
+    from collections.abc import Iterator
     import logging
-    import yaml
-    import json
     from multiprocessing import Pipe, Event
-    import this
+    from multiprocessing.connection import wait
+    from qcommands import QCommandIndex, compile_commands, parse_args, diff_commands, command_definition
+    from qexecutor import QCommandExecutor
+    from qrpc import QManagerRPC
+    from qsupervisor import QConnectorSupervisor
+    from qalerts import QAlertCoalescer
+    from qmetrics import metrics
+    from qconfig import load_config
+    from qfiles import QFileLister, parse_params as parse_files_params
+    from qbackup import QBackupStore
+    from qtransfer import QTransfer
+    from qlog import QLogListener, QLogFileHandler, QRingBufferHandler, LOG_FORMAT, make_filter, parse_query, file_tail
 except Exception as err:
     print('Error! Could not import modules: %s' % err)
     sys.exit(-1)
+#Startup timeline: (phase, start offset, seconds). Connectors and managers phases overlap. See timeline()
+startupTimeline = [('core imports', 0, monotonic() - importStarted)]
+isWorking = False
+startingManagers = [] #manager modules being created in background (see init_managers())
     
-#This value should be in DB COMMANDS as substitution of command arguments
+#Name of the variable keeping command arguments in commandline
 PARAM_STRING='COMMAND_PARAMETERS'
 
 
-class Loader(yaml.SafeLoader):
-    """Adds the !include statement to yaml"""
-    def __init__(self, stream):
-        self._root = os.path.split(stream.name)[0]
-        super(Loader, self).__init__(stream)
-    def include(self, node):
-        filename = os.path.join(self._root, self.construct_scalar(node))
-        with open(filename, 'r') as f:
-            return yaml.load(f, Loader)
-Loader.add_constructor('!include', Loader.include)
+class CommandQueue(Queue):
+    """Common command queue which can be waited together with manager pipes
+
+    Every put() makes 'reader' readable, so the main loop may block in multiprocessing.connection.wait()
+    on the queue and all the alert pipes at once. The wakeup is sent once until clear_wakeup() is called
+    """
+    def __init__(self):
+        Queue.__init__(self)
+        self.reader, self._writer = Pipe(duplex=False)
+        self._wakeup_lock = threading.Lock()
+        self._signalled = False
+
+    def put(self, item, block=True, timeout=None):
+        Queue.put(self, item, block, timeout)
+        with self._wakeup_lock:
+            if not self._signalled:
+                self._signalled = True
+                self._writer.send_bytes(b'1')
+
+    def clear_wakeup(self):
+        """Resets the wakeup signal. Should be called before draining the queue"""
+        with self._wakeup_lock:
+            while self.reader.poll():
+                self.reader.recv_bytes()
+            self._signalled = False
 
 def zen(some):
     """Command Дзен implementation. Returns encrypted or decrypted text of 'this' module"""
@@ -68,47 +100,129 @@ def zen(some):
             for i in range(26):
                 d[chr(i+c)] = chr((i+13) % 26 + c)
         return "".join([d.get(c, c) for c in text]) 
+    import this #prints the Zen to stdout on the first import
     res = this.s if some == '' else zen_plain(this.s)
     return res
 
-#Functions checks if the user has admission to run the command.
-#Developing. Now it just checks the fact that the user is in allowed users list
-def isCommandAllowed(cmdObj):
-    """Checks if the user has admission to run the command"""
-    res = False
-    uid = str(cmdObj['user_id']).lower()
+#Authorization index. Key is (channel, user_id): channel is connector class name, user_id is lowercased string
+#Users without channel in config are allowed on every channel (their key channel is None)
+def init_users(users_config):
+    """Compiles users list from configuration to the authorization index
+
+    Every user may have 'commands' list: command texts allowed for him, 'module.' allows all the module commands.
+    Without 'commands' any command is allowed. Called at start and by reload_commands(): the index is built aside
+    and replaced at once, so the commands being checked never see it half-built
+    """
+    global users, usersIndex, usersCache
+    index = {}
+    for u in users_config:
+        channel = u['channel'] if 'channel' in u.keys() else None
+        permissions = frozenset([x.lower() for x in u['commands']]) if 'commands' in u.keys() else None
+        index[(channel, str(u['user_id']).strip().lower())] = {'user': u, 'permissions': permissions}
+    users, usersIndex = users_config, index
+    usersCache = {} #(channel, original user_id) -> user or None. Keeps both found and unknown senders
+    logger.info('%d users loaded' % len(users))
+
+def getUser(cmdObj):
+    """Returns authorization index record of the command sender or None if the sender is unknown"""
+    channel = cmdObj['self'].__class__.__name__
+    key = (channel, cmdObj['user_id'])
     try:
-        usr = list(filter(lambda x: x['user_id'] == uid, users))[0]
-        logger.info('Command %s allowed for user %s' % (cmdObj['command'], usr))
-        res = True
-    except Exception as err:
-        logger.error("User_id %s not found: %s" % (cmdObj['user_id'], err))
+        return usersCache[key]
+    except KeyError:
+        pass
+    except TypeError: #unhashable user_id
+        key = (channel, str(cmdObj['user_id']))
+    uid = str(cmdObj['user_id']).strip().lower()
+    usr = usersIndex.get((channel, uid)) or usersIndex.get((None, uid))
+    if not usr:
+        #Unknown sender is logged once
+        logger.warning('Unknown user_id %s, channel %s' % (cmdObj['user_id'], channel))
+    if len(usersCache) > 10000: #spam from many senders shouldn't eat memory
+        usersCache.clear()
+    usersCache[key] = usr
+    return usr
+
+#Functions checks if the user has admission to run the command.
+def isCommandAllowed(cmdObj, command=None):
+    """Checks if the user has admission to run the command
+
+    Without command just checks the fact that the user is in allowed users list for the channel
+    """
+    usr = getUser(cmdObj)
+    if not usr:
+        return False
+    if command is None or usr['permissions'] is None:
+        return True
+    permissions = usr['permissions']
+    res = command['commandtext'].lower() in permissions or ('%s.' % command['module'].lower()) in permissions
+    if res:
+        logger.debug('Command %s allowed for user %s' % (command['commandtext'], usr['user']))
+    else:
+        logger.warning('Command %s is not allowed for user %s' % (command['commandtext'], usr['user']))
     return res
     
-def init_connectors(queue, logger, connectors_config):
-    """Forms connectors list from successfully created connectors"""
-    global classes
+def timeline(phase, started, finished=None):
+    """Adds startup phase which started at 'started' (monotonic) and finished now (or at 'finished') to startup timeline
+
+    Returns current time
+    """
+    now = monotonic()
+    if not isWorking: #Restarts after startup are not the part of it
+        startupTimeline.append((phase, started - importStarted, (finished if finished else now) - started))
+    return now
+
+def startupSeconds():
+    """Returns startup time from the process start"""
+    return max([offset + seconds for phase, offset, seconds in startupTimeline])
+
+def getStartupTimeline():
+    """Returns startup phases and their durations"""
+    lines = ['%7.3fs %7.3fs  %s' % (offset, seconds, phase) for phase, offset, seconds in startupTimeline]
+    return 'Startup timeline (start, duration, phase):\n%s\nTotal: %.3fs' % ('\n'.join(lines), startupSeconds())
+
+def is_enabled(conf):
+    """Connector or manager may be switched off with 'enabled: False'. Its module is not imported then"""
+    return conf['enabled'] if 'enabled' in conf.keys() else True
+
+def load_class(conf):
+    """Returns connector or manager class. Its module is imported at the first use"""
+    if not conf['class'] in classes.keys():
+        t0 = monotonic()
+        classes[conf['class']] = __import__(conf['module']).__dict__[conf['class']] #The import itself
+        timeline('  import %s' % conf['module'], t0)
+    return classes[conf['class']]
+
+def init_connectors(queue, logger, connectors_config, deadline=30):
+    """Forms connectors list from successfully created connectors
+
+    All the connectors are constructed at once in background threads and watched by supervisor. wait_connectors() waits
+    for every one up to its startup deadline, the late ones are added to the list by supervisor when started.
+    Supervisor restarts the failed ones. Disabled connectors are skipped
+    """
+    global classes, supervisor
     connectors = []
+    supervisor_conf = config['supervisor'] if 'supervisor' in config.keys() else {}
+    supervisor = QConnectorSupervisor(connectors, lambda conf: init_connector(queue=queue, logger=logger, **conf), sendMessage, logger, **supervisor_conf)
     #Create and start concerning class connectors for each connectors_config member and stores them in connectors list
     for conf in connectors_config:
-        try:
-            c = init_connector(queue=queue, logger=logger, **conf)
-        except Exception as err:
-            logger.error('Init connector %s failed: %s' % (conf['name'], err))
+        if not is_enabled(conf):
+            logger.info('Connector %s is disabled' % conf['name'])
             continue
-        if c:
-            #logger.info('Connector added: %s' % c['name'])
-            connectors.append(c)
-        else:
-            logger.error('Init connector %s failed' % conf['name'])
+        supervisor.start(conf, conf['startup_deadline'] if 'startup_deadline' in conf.keys() else deadline)
     return connectors
 
+def wait_connectors():
+    """Waits for the connectors being started up to their deadlines (see init_connectors())"""
+    for name, (started, finished) in supervisor.wait().items():
+        timeline('connector %s' % name, started, finished)
+
 #create and init 1 connector
 def init_connector(**conf):
     """Creates and run given connector
     
     Besides configuration file values conf must contain logger and queue
-    returns dict with keys: name, connector, to, is_alive, default and autorestart
+    returns dict with keys: name, connector, to, is_alive, default, autorestart and coalesce_window
     if failed returns None
     
     """
@@ -117,7 +231,7 @@ def init_connector(**conf):
     #setting autorestart key. We need False just for problem connectors to avoid error messages storm
     autorestart = conf['autorestart'] if ('autorestart' in conf.keys()) else True    
     try:
-        conn = classes[conf['class']](**conf)
+        conn = load_class(conf)(**conf)
         #conn.setDaemon(True)
         conn.start()
     except Exception as err:
@@ -126,24 +240,29 @@ def init_connector(**conf):
     if conn:
         to_list = list(filter(lambda x: x['channel'] == conf['class'], contacts))
         conn_default = True if ('default' in conf.keys() and conf['default']) else False
-        dict_connector = {'name':conf['name'], 'connector': conn, 'to': to_list, 'default': conn_default, 'class':conf['class'], 'is_alive':conn.is_alive(), 'autorestart':autorestart}
+        coalesce_window = conf['coalesce_window'] if 'coalesce_window' in conf.keys() else None
+        dict_connector = {'name':conf['name'], 'connector': conn, 'to': to_list, 'default': conn_default, 'class':conf['class'], 'is_alive':conn.is_alive(), 'autorestart':autorestart,
+                          'coalesce_window': coalesce_window}
     return dict_connector
 
 def stop_manager(man_name):
-    """Stops manager module with given name"""
+    """Stops manager module with given name and removes its commands"""
     global managers
+    global commands
     mlist = list(filter(lambda x: x['name'].lower() == man_name.lower(), managers))
     m = mlist[0] if len(mlist) else None
     if m:
         logger.debug('Stopping %s' % man_name)
-        m['command_pipe'].send('self.stop()')
-        m['command_pipe_semaphore'].set()
+        m['rpc'].request('exec', code='self.stop()')
         m['connector'].join(25)
         res = 'stopped'
         if m['connector'].is_alive(): #if correct stop operation failed terminating roughly
-            m.terminate()
+            m['connector'].terminate()
             res = 'terminated'
-        res = '%s: %s' % (man_name, res)
+        m['rpc'].fail_all('%s %s' % (man_name, res))
+        removed = commandIndex.remove_module(m['name'])
+        commands = [c for c in commands if c['module'] != m['name']]
+        res = '%s: %s (%d commands removed)' % (man_name, res, len(removed))
         logger.debug(res)
         managers.remove(m)
     else:
@@ -157,38 +276,49 @@ def init_manager(**conf):
         Besides values from configuration file conf must contain logger value
         
     """
-    global managers
-    global commands
-    def start_connector(**conf): #! logger must be in param list
-        dict_connector = None
-        command_pipe1, command_pipe2 = Pipe()
-        command_evt = Event()
-        alert_pipe1, alert_pipe2 = Pipe()
-        alert_evt = Event()
-        #Add runtime conf vars
-        temp_conf = {}
-        temp_conf['command_pipe'] = command_pipe2
-        temp_conf['command_pipe_semaphore'] = command_evt
-        temp_conf['alert_pipe'] = alert_pipe2
-        temp_conf['alert_pipe_semaphore'] = alert_evt
-        #setting autorestart key. We need False just for problem connectors to avoid error messages storm
-        autorestart = conf['autorestart'] if ('autorestart' in conf.keys()) else True
-        try:
-            conn = classes[conf['class']](**conf, **temp_conf)
-            #conn.daemon = True
-            conn.start()
-        except Exception as err:
-            logger.error("%s manager is not available: %s" % (conf['name'], err))
-            conn = None
-        if conn:
-            dict_connector = {'name':conf['name'], 'connector': conn, 'class':conf['class'], 'is_alive':conn.is_alive(), 'command_pipe': command_pipe1, \
-                              'alert_pipe': alert_pipe1, 'command_pipe_semaphore': command_evt, 'alert_pipe_semaphore': alert_evt, 'autorestart': autorestart}
-
-        return dict_connector
     if len(list(filter(lambda x: x['name'] == conf['name'], managers))): #if manager already exists
         res = '%s already running' % conf['name']
         return res
-    new_man = start_connector(**conf)
+    return register_manager(conf, create_manager(**conf))
+
+def create_manager(**conf): #! logger must be in param list
+    """Creates and starts manager module process. Returns manager dict or None if failed
+
+    Doesn't change global lists, so it may run in background thread (see init_managers())
+    """
+    dict_connector = None
+    command_pipe1, command_pipe2 = Pipe()
+    command_evt = Event()
+    alert_pipe1, alert_pipe2 = Pipe()
+    alert_evt = Event()
+    #Add runtime conf vars
+    temp_conf = {}
+    temp_conf['command_pipe'] = command_pipe2
+    temp_conf['command_pipe_semaphore'] = command_evt
+    temp_conf['alert_pipe'] = alert_pipe2
+    temp_conf['alert_pipe_semaphore'] = alert_evt
+    temp_conf['log_queue'] = logListener.process_queue
+    #setting autorestart key. We need False just for problem connectors to avoid error messages storm
+    autorestart = conf['autorestart'] if ('autorestart' in conf.keys()) else True
+    try:
+        conn = load_class(conf)(**conf, **temp_conf)
+        #conn.daemon = True
+        conn.start()
+    except Exception as err:
+        logger.error("%s manager is not available: %s" % (conf['name'], err))
+        conn = None
+    if conn:
+        #rpc_timeout: seconds to wait for module command response if the command has no own timeout
+        rpc = QManagerRPC(command_pipe1, command_evt, conf['name'], conf['rpc_timeout'] if 'rpc_timeout' in conf.keys() else 30, logger)
+        dict_connector = {'name':conf['name'], 'connector': conn, 'class':conf['class'], 'is_alive':conn.is_alive(), 'command_pipe': command_pipe1, \
+                          'alert_pipe': alert_pipe1, 'command_pipe_semaphore': command_evt, 'alert_pipe_semaphore': alert_evt, 'autorestart': autorestart,
+                          'rpc': rpc}
+    return dict_connector
+
+def register_manager(conf, new_man):
+    """Adds created manager module and its commands to global lists. Should be called from main thread"""
+    global managers
+    global commands
     res = '%s: nothing added' % conf['name']
     if new_man:
         managers.append(new_man)
@@ -197,31 +327,84 @@ def init_manager(**conf):
             man_commands = conf['commands'].copy()
             for cmd in man_commands:
                 cmd['module'] = conf['name']
+                commandIndex.add(cmd)
             commands.extend(man_commands)
             res = '%s (%d commands)' % (res, len(man_commands))
     return res
-    
+
+def init_managers(managers_config, deadline):
+    """Creates manager modules at once in background threads
+
+    wait_managers() waits for every one up to its startup deadline. The late ones are registered by check_managers() when created.
+    Disabled managers are skipped
+    """
+    for conf in managers_config:
+        if not is_enabled(conf):
+            logger.info('Manager %s is disabled' % conf['name'])
+            continue
+        job = {'conf': conf, 'result': None, 'started': monotonic(), 'late': False}
+        job['deadline'] = job['started'] + (conf['startup_deadline'] if 'startup_deadline' in conf.keys() else deadline)
+        def target(job=job):
+            job['result'] = create_manager(logger=logger, **job['conf'])
+        job['thread'] = threading.Thread(target=target, name='start_%s' % conf['name'], daemon=True)
+        job['thread'].start()
+        startingManagers.append(job)
+
+def wait_managers():
+    """Waits for the manager modules being created up to their deadlines and registers them"""
+    for job in list(startingManagers):
+        job['thread'].join(max(job['deadline'] - monotonic(), 0))
+        if job['thread'].is_alive():
+            job['late'] = True
+            logger.warning('Manager %s missed startup deadline. It will be added when started' % job['conf']['name'])
+    check_starting_managers()
+
+def check_starting_managers():
+    """Registers the manager modules created in background"""
+    for job in [x for x in startingManagers if not x['thread'].is_alive()]:
+        startingManagers.remove(job)
+        res = register_manager(job['conf'], job['result'])
+        logger.debug(res)
+        if job['late']:
+            msg = 'Manager %s started in %d seconds: %s' % (job['conf']['name'], monotonic() - job['started'], res)
+            logger.info(msg)
+            sendMessage(msg)
+        else:
+            timeline('manager %s' % job['conf']['name'], job['started'])
+
 #----------------------------------------------------------------------------------------------------
 #init parameters, sensors,commands, config etc.
-def init():
+def init(confFileName=None, pidFile=None, logFileName=None, coldConfig=False):
     """Init function
 
     Setting global variables, runs connectors, manager modules, reading configuration files etc.
+    confFileName - configuration file. Default is run/conf/qbot.yaml (qbot_test.yaml in test environment)
+    pidFile - PID file. Default is taken from systemd qbot.service
+    logFileName - log file. Default is logqbot.txt in working directory
+    coldConfig - parse configuration files ignoring the cache (see qconfig.py)
     """
     global isTest
     global connectors, managers, queue, config
     global pidFileName
-    global workdir, downloaddir, uploaddir, maindir, updatefile, updatedir, backupdir
+    global workdir, downloaddir, uploaddir, maindir, updatefile, updatedir, backupdir, transferdir
     global logger
-    global commands, contacts, users, classes
+    global commands, commandIndex, contacts, classes
     global isUpdating
     global waitForConfirm
     global startTime
     global isWorking
     global timeout
+    global eventLoop
+    global executor
+    global alerts
+    global metricsFile, metricsInterval
+    global configFile, configCacheFile
+    global logFile, logBuffer, logListener
+    global fileLister, backupStore, backupTimeout, backupWorkers, transfer
     
     isWorking = False
-    timeout = 2 #Seconds to wait in every cycle    
+    timeout = 2 #Seconds between connectors checks. Also the cycle time if event_loop is off
+    t0 = monotonic()
 
     #if running script manually current directory is run
     if os.path.basename(os.path.realpath(os.curdir)) == 'run':
@@ -233,16 +416,22 @@ def init():
     uploaddir = 'upload/'
     backupdir = 'backup/'
     updatedir = 'update/'
+    transferdir = 'transfer/'
     updatefile = workdir + 'update_flag'
     
     isTest, msg = (True, 'Test') if 'isTest' in os.listdir() else (False, 'Prom')  #Set True at test environment
     print('%s connectors is used' % msg)
-    confFileName = maindir + 'conf/qbot.yaml' #TODO: get var from commandline
-    confFileName = confFileName.replace('qbot.yaml', 'qbot_test.yaml') if isTest else confFileName
+    if not confFileName:
+        confFileName = maindir + 'conf/qbot.yaml'
+        confFileName = confFileName.replace('qbot.yaml', 'qbot_test.yaml') if isTest else confFileName
     print('Using configuration file %s' % confFileName)
-    config = yaml.load(open(confFileName), Loader)
+    #Parsed configuration is cached in working directory until any of its files changes
+    configFile, configCacheFile = confFileName, workdir + '%s.cache' % os.path.basename(confFileName)
+    config, cached = load_config(configFile, configCacheFile, coldConfig)
+    t0 = timeline('config %s%s' % (confFileName, ' (cached)' if cached else ''), t0)
     
-    logFileName = workdir + 'logqbot.txt' #TODO: get var from conf-file
+    if not logFileName:
+        logFileName = workdir + 'logqbot.txt' #TODO: get var from conf-file
     waitForConfirm = 600 #Seconds waiting for update confirm. If no approve until this time, backup system files will be restored
     startTime = datetime.datetime.now()
     isUpdating = False
@@ -253,27 +442,41 @@ def init():
         print('Updating mode - normal')
         
     print("LogFile=%s" % logFileName)
+    logFile = logFileName
     
     #Prepare logger
     #--------------------------------------------------------------------------------------------------------
     #Prepare logger
     logger = logging.getLogger('qbot.service')
+    log_conf = config['log'] if 'log' in config.keys() else {}
     ch = logging.StreamHandler(os.sys.stdout)
-    fh = logging.FileHandler(logFileName)
-    logFormat = logging.Formatter('%(asctime)s %(name)s %(levelname)s: %(message)s')
-    fh.setFormatter(logFormat)
-    ch.setFormatter(logFormat)
-    logger.addHandler(fh)
-    logger.addHandler(ch)
+    #Log file is rotated by size and age, the rotated files are compressed
+    fh = QLogFileHandler(logFileName, log_conf['max_size'] if 'max_size' in log_conf.keys() else 0, log_conf['max_age'] if 'max_age' in log_conf.keys() else 0,
+                         log_conf['backup_count'] if 'backup_count' in log_conf.keys() else 5, log_conf['compress'] if 'compress' in log_conf.keys() else True)
+    #The last records are kept in memory for Log tail
+    logBuffer = QRingBufferHandler(log_conf['buffer'] if 'buffer' in log_conf.keys() else 1000)
+    logFormat = logging.Formatter(LOG_FORMAT)
+    for h in (fh, ch, logBuffer):
+        h.setFormatter(logFormat)
+    #Records of all the threads and manager processes are written by the listener thread. Connectors copy logger handlers
+    logListener = QLogListener((fh, ch, logBuffer), log_conf['batch'] if 'batch' in log_conf.keys() else 200)
+    logListener.start()
+    atexit.register(logListener.stop)
+    logger.addHandler(logListener.handler())
     loglevel = getattr(logging, config['loglevel']) if ('loglevel' in config.keys()) else logging.INFO    
     logger.setLevel(loglevel)
+    #event_loop: wake up on incoming commands and alerts instead of sleeping 'timeout' seconds every cycle
+    eventLoop = config['event_loop'] if 'event_loop' in config.keys() else True
     #--------------------------------------------------------------------------------------------------------
     
     #PID file processing
     #get PIDFilename from systemd qbot.service description
     #if PID file exists and related process is running then exit
-    qbotService = open('/etc/systemd/system/qbot.service').read().splitlines()
-    pidFileName = list(filter(lambda x: x.find('PIDFile') == 0, qbotService))[0].split("=")[1]
+    if pidFile:
+        pidFileName = pidFile
+    else:
+        qbotService = open('/etc/systemd/system/qbot.service').read().splitlines()
+        pidFileName = list(filter(lambda x: x.find('PIDFile') == 0, qbotService))[0].split("=")[1]
     logger.info('Using PID file %s' % pidFileName)
 
     if os.path.exists(pidFileName):
@@ -283,6 +486,7 @@ def init():
             logger.error('Can not read pid from file %s' % pidFileName)
             sys.exit(0)
         logger.warning('Pid file exists %s. Checking for process existance: %s' % (pidFileName, pid))
+        import psutil
         if pid in psutil.pids():
             logger.warning('PID %d is running already. Could not run the second instance' % pid)
             sys.exit(0)
@@ -296,68 +500,86 @@ def init():
         logger.error('Could not write PID=%d to PID-file: %s' % (pid, err))
         sys.exit(-1)
     #--------------------------------------------------------------------------------------------------------
-    logger.removeHandler(ch)
+    logListener.remove_handler(ch)
+    t0 = timeline('logger and PID file', t0)
     
+    #Connectors and managers classes. They are imported by load_class() when started
     classes = {}
-    #import classes from connectors and managers modules
-    for class_type in ['connectors', 'managers']:
-        loadings = [{'class':x['class'], 'module': x['module']} for x in config[class_type]]
-        for l in loadings:
-            if not l['class'] in classes.keys(): #if the class NOT already loaded -> load it
-                try:
-                    classes[l['class']] = __import__(l['module']).__dict__[l['class']] #The import itself
-                except Exception as err:
-                    l_err = "%s import failed: %s" % (l, err)
-                    logger.error(l_err)
-    logger.debug('%d classes imported' % len(list(classes.keys())))
     commands = {}
     #print(config['commands'])
     #Get core module commands
     commands = config['commands'].copy()
     for c in commands:
         c['module'] = __name__
+    compile_commands(commands, (PARAM_STRING, 'cmdObject'), globals(), logger)
+    commandIndex = QCommandIndex(commands)
     logger.info('%d commands loaded from module %s' % (len(config['commands']), __name__))
     #print(commands)
     
     contacts = config['contacts']
     logger.info('%d contacts loaded' % len(contacts))
     
-    users = config['users']
-    logger.info('%d users loaded' % len(users))
+    init_users(config['users'])
+    t0 = timeline('commands and users', t0)
     
     #----------------------------------------------------------------------------------------------------------------------------------------
-    queue = Queue()
+    queue = CommandQueue()
+    #Commands executor. Commands run in worker threads, the main loop just dispatches them
+    executor_conf = config['executor'] if 'executor' in config.keys() else {}
+    executor = QCommandExecutor(logger=logger, **executor_conf)
+    #Alerts from managers are buffered and merged before sending
+    alerts_conf = config['alerts'] if 'alerts' in config.keys() else {}
+    alerts = QAlertCoalescer(lambda c, address, msg, since: c['connector'].post(msg, address, since, 'alert'),
+                             alerts_conf.get('coalesce_window', 0), alerts_conf.get('max_items', 20), logger)
+    #Metrics are written to Prometheus text file every metricsInterval seconds
+    metrics_conf = config['metrics'] if 'metrics' in config.keys() else {}
+    metricsFile = metrics_conf['file'] if 'file' in metrics_conf.keys() else None
+    metricsInterval = metrics_conf['interval'] if 'interval' in metrics_conf.keys() else 60
+    #List files pages and directory stat cache
+    files_conf = config['files'] if 'files' in config.keys() else {}
+    fileLister = QFileLister(files_conf['page_size'] if 'page_size' in files_conf.keys() else 20, files_conf['cache_ttl'] if 'cache_ttl' in files_conf.keys() else 10)
+    #Backup snapshots. The oldest ones are deleted when the store exceeds budget
+    backup_conf = config['backup'] if 'backup' in config.keys() else {}
+    backupStore = QBackupStore(backupdir + 'store', backup_conf['budget'] if 'budget' in backup_conf.keys() else 0, backup_conf['keep'] if 'keep' in backup_conf.keys() else 3)
+    #Backup, Update and Restore file work runs in separate process killed after backupTimeout seconds
+    backupTimeout = backup_conf['timeout'] if 'timeout' in backup_conf.keys() else 540
+    #Processes compressing new files of snapshot. 0 - in the process of snapshot
+    backupWorkers = backup_conf['workers'] if 'workers' in backup_conf.keys() else 1
+    #Files above connector MAX_FILE_SIZE are sent and received by parts
+    transfer = QTransfer(transferdir, {'download': downloaddir, 'update': updatedir})
+    t0 = timeline('executor', t0)
+    #Connectors and managers are started at once. Every one is waited up to its startup_deadline seconds, the late ones are taken later
+    startupDeadline = config['startup_deadline'] if 'startup_deadline' in config.keys() else 30
     #initialize connectors
     connectors = []
     try:
-        connectors = init_connectors(queue, logger, config['connectors']) #Creating and initializing all described connections
+        connectors = init_connectors(queue, logger, config['connectors'], startupDeadline) #Creating and initializing all described connections
     except Exception as err:
         logger.error("Init connectors failed: %s" % (err))
 
     #Starting managers
     managers = []
-    num_of_commands = 0
-    for m in config['managers']:
-        try:
-            res = init_manager(logger=logger, **m)
-            logger.debug(res)
-        except Exception as err:
-            logger.error('%s init manager failed: %s' % (m['name'], err))
-    logger.info('Loaded %d managers with %d commands' % (len(managers), num_of_commands))
+    init_managers(config['managers'], startupDeadline)
+    wait_connectors()
+    wait_managers()
+    logger.info('Loaded %d managers with %d commands' % (len(managers), len(commands)))
+    logger.info(getStartupTimeline())
 #--------------------------------------------------------------------------------------------------------------------------------------------
 #Work functions
 #--------------------------------------------------------------------------------------------------------------------------------------------
 #tail of log file
-def tail(fname, n):
-    """Returns last lines of file"""
-    lines = os.popen("tail -n %d %s" % (n, fname)).read()
-    return lines
-
 def showMessages(param = None):
-    """Returns last lines of log file"""
-    last = int(param) if param else 20
-    res = tail(logger.handlers[0].baseFilename, last)
-    return res
+    """Returns last log records iterator. param: [N] [level=LEVEL] [module=NAME] [since=TIME] [text=TEXT | re=REGEX]
+
+    Records are taken from memory buffer (manager modules records come there too). If it has not enough ones, log file is read from the end
+    """
+    n, filters = parse_query(param)
+    match = make_filter(**filters)
+    records = logBuffer.tail(n, match)
+    if len(records) < n:
+        records = file_tail(logFile, n, match, filters.get('since'))
+    return ('%s\n' % x[3] for x in records) if records else 'No log records found'
+
       
 #Test function to check new functionality
 def testFunction():
@@ -372,20 +594,22 @@ def exitFunction(signum, frame):
     isWorking = False
     return('Stopping')
 
-def runShellCommand(cmd):
-    """Runs shell command
-    
-    if shell process doesn't exit in 10 seconds closes it
-    Return read() of process output
+def runShellCommand(cmd, cmdObject=None):
+    """Runs shell command (see qshell.py)
+
+    The command is killed with its children if it doesn't exit in 'shell: timeout' seconds
+    If cmdObject is given, the output is sent to the user by parts every 'shell: stream_interval' seconds while the command runs
+    Returns the output not sent yet
     """
-    cmdTimeout = 10 # wait 2 seconds for command exit
-    t0 = datetime.datetime.now()
+    from qshell import run_shell
+    shell_conf = config['shell'] if 'shell' in config.keys() else {}
     logger.debug('Running shell command: %s' % cmd)
-    res = ''
-    p = os.popen(cmd)
-    while not p._proc.poll() and (datetime.datetime.now() - t0).seconds < cmdTimeout:
-        res = '%s\n%s' % (res, p.readline())
-    p.close()
+    on_output = (lambda text: cmdObject['self'].reply(text, cmdObject)) if cmdObject else None
+    res, status = run_shell(cmd, shell_conf['timeout'] if 'timeout' in shell_conf.keys() else 10,
+                            shell_conf['max_output'] if 'max_output' in shell_conf.keys() else 65536, on_output,
+                            shell_conf['stream_interval'] if 'stream_interval' in shell_conf.keys() else 0, logger)
+    if status:
+        res = '%s\n[%s]' % (res, status)
     logger.debug(res)
     return res
 
@@ -399,7 +623,9 @@ def help(topic = None):
     """
     logger.debug('Help topic=%s' % topic)
     def manager_info(manager_name):
-        return 'Доступные команды\n' + '\n'.join([x['commandtext'] for x in list(filter(lambda y: y['module'] == manager_name, commands))])
+        yield 'Доступные команды'
+        for x in [y for y in commands if y['module'] == manager_name]:
+            yield '\n%s' % x['commandtext']
     if not topic: #Without topic return just list of modules
         man_list = [__name__]
         man_list.extend([x['name'] for x in managers])
@@ -413,29 +639,18 @@ def help(topic = None):
         res = cmd['command']['helptext'] if cmd['command'] else 'Command not found'
     return res
 
-#Scans commands set for the best match (longer string matching)
+#Looks commands index up for the best match (longer string matching)
 #commands and modules are not case sensitive, but params are
 def getCommand(cmdFull_original):
     """Finds the most suitable command for user command text
 
     command format: [[module].]Command Parameters
-    function searches for the longest command text match
+    function searches for the longest command text match (see QCommandIndex)
     if module is given just the manager module commands are considered (don't use dot in general command texts to avoid mistifications)
     """
-    global commands
     cmdFull = cmdFull_original.strip()
-    cmdLower = cmdFull.lower()
-    cmd = None
-    params = None
-    res_len = 0
-    for c in commands:
-        cLower = c['commandtext'].lower()
-        managerLower = c['module'].lower()
-        if (cmdLower.startswith(cLower) or cmdLower.startswith('%s.%s' % (managerLower, cLower))) and len(c['commandtext']) > res_len:
-            cmd = c
-            res_len = len(c['commandtext'])
-            cmd_index = cmdLower.find(cLower)
-            params = '"%s"' % cmdFull[res_len+cmd_index:].strip() # params MUST be the string type
+    cmd, params_index = commandIndex.lookup(cmdFull)
+    params = cmdFull[params_index:].strip() if cmd else None
     res = {'command': cmd, 'params':  params}
     logger.debug(res)
     return res
@@ -446,11 +661,12 @@ def update(filename = None):
     """updates 'system' files
 
     files should be compressed to 'tar.gz' archive with 'run' subdirectory cause the extracting is done from work directory
-    Before extracting any new files all the old ones will be compressed to 'backup/run.tar.gz' archive, update_flag file created and __main__script exited
-    update_flag file indicates the number of system starts after updating. If the number greater than zero, start_qbot.sh shell script should restore backup/run.tar.gz
-    and run previous version of system.
+    or be a delta package with changed files only (see qdelta.py). Delta is applied just to the version it's made for, otherwise the update is refused
+    Before extracting any new files the old ones are saved to backup store snapshot (see qbackup.py), update_flag file created and __main__script exited
+    update_flag file indicates the number of system starts after updating. If the number greater than zero, start_qbot.sh shell script should restore the last snapshot
+    and run previous version of system. It runs backup/qbackup.py copied here, so the restore doesn't depend on the updated files.
     Also after succsessful after-update start system gives you 10 minutes to check and approve this update (command 'Approve update'). If no approve was given,
-    the backup/run.tar.gz will be restored and system downgraded
+    the snapshot will be restored and system downgraded
     """
     global isWorking
     
@@ -467,53 +683,172 @@ def update(filename = None):
         return res
     if os.path.exists(arcname):
         res = 'Update source: %s' % arcname
+        import qdelta
+        header = qdelta.read_header(arcname) if qdelta.is_delta(arcname) else None
+        if header:
+            mismatches = qdelta.check_base(header, workdir)
+            if mismatches:
+                res = '%s\nDelta is made for another version, update refused:\n%s' % (res, '\n'.join(mismatches[:20]))
+                logger.error(res)
+                return res
+            res = '%s\nDelta: %s' % (res, qdelta.summary(header))
         #Create flag file
         uf = open(updatefile, 'w')
         uf.write('0')
         uf.close()
         logger.debug('Update file created: %s' % updatefile)
-        #Backup current system files
-        res = "%s\n%s" %(res, backup())
-        #Extract new version files to run directory
-        tar = tarfile.open(arcname)
-        fileList = tar.getnames()
+        #Backup current system files. No update without the snapshot to roll back to
+        manifest, text = make_snapshot()
+        res = "%s\n%s" %(res, text)
+        if not manifest:
+            os.remove(updatefile)
+            res = '%s\nUpdate cancelled, nothing changed' % res
+            logger.error(res)
+            return res
+        #start_qbot.sh restores by this copy of qbackup.py
+        import shutil
+        shutil.copy2('%sqbackup.py' % maindir, backupdir)
+        #Extract new version files to run directory. In separate process killed after backupTimeout, so hung I/O doesn't keep the lock
+        try:
+            if header:
+                executor.run_killable(qdelta.apply_delta, arcname, workdir, timeout=backupTimeout)
+                fileList = sorted(header['files']) + ['deleted: %s' % x for x in header['deleted']]
+            else:
+                fileList = executor.run_killable(extract_archive, arcname, workdir, timeout=backupTimeout)
+        except Exception as err:
+            res = '%s\nUpdate failed: %s' % (res, err)
+            try: #the archive may be extracted partly
+                written = executor.run_killable(restore_snapshot, manifest['name'], timeout=backupTimeout)[1]
+                res = '%s\n%s restored, %d files written' % (res, manifest['name'], written)
+            except Exception as err:
+                res = '%s\nRestore of %s failed: %s' % (res, manifest['name'], err)
+            os.remove(updatefile)
+            logger.error(res)
+            return res
         logger.debug('Files to update: %s' % fileList)
-        tar.extractall(path=workdir)
-        tar.close()
         os.remove(arcname)          
         res = "%s\nUpdated files:\n%s\nReloading qbot" % (res, fileList)
         reload()
         isWorking = False
     else:
-        res = "%s doesn't exist. Nothing to update" % arcfile
+        res = "%s doesn't exist. Nothing to update" % arcname
     return res
 
+def extract_archive(arcfile, path='.'):
+    """Extracts tar archive to path. Returns names of its members. Runs by executor.run_killable()"""
+    import tarfile
+    with tarfile.open(arcfile) as tar:
+        tar.extractall(path=path)
+        return tar.getnames()
+
+def restore_snapshot(name):
+    """Restores backup store snapshot. Returns (manifest, files written). Runs by executor.run_killable()"""
+    return backupStore.restore(name)
+
+def snapshot_job(source, name):
+    """Saves backup store snapshot. Runs by executor.run_killable(): the new files are compressed by backupWorkers processes"""
+    from concurrent.futures import ProcessPoolExecutor
+    pool = ProcessPoolExecutor(backupWorkers) if backupWorkers else None
+    try:
+        return backupStore.snapshot(source, name, pool)
+    finally:
+        if pool:
+            pool.shutdown()
+
 def reload():
     """Stop system. Systemd should run it again"""
     global closing_proc
     closing_proc = os.popen('./stop_qbot.sh &')
     return 'Started: stop_qbot.sh'
 
+def reload_commands(module=None):
+    """Re-reads configuration files and applies the commands changes without restart
+
+    Commands of the main module (__main__) and running manager modules (all of them if module is not given) are compared
+    with the live ones, just the changed ones are compiled. Manager modules get their changed commands and triggers by rpc_reload()
+    Users and their permissions are reloaded too
+    """
+    global commands, commandIndex
+    new_config = load_config(configFile, configCacheFile)[0]
+    init_users(new_config['users'])
+    config['users'] = new_config['users']
+    names = [__name__] + [m['name'] for m in managers]
+    if module:
+        names = [x for x in names if x.lower() == module.strip().lower()]
+        if not names:
+            return "Module '%s' not found" % module
+    #Live commands grouped by module in their order. The index is rebuilt from them and replaced at once
+    groups = {}
+    for c in commands:
+        groups.setdefault(c['module'], []).append(c)
+    res = []
+    for name in names:
+        if name == __name__:
+            conf, old_conf = new_config, config
+        else:
+            conf = ([x for x in new_config['managers'] if x['name'] == name] + [None])[0]
+            old_conf = ([x for x in config['managers'] if x['name'] == name] + [None])[0]
+            if not conf:
+                res.append('%s: not found in configuration' % name)
+                continue
+        new_commands = [dict(c, module=name) for c in (conf['commands'] if 'commands' in conf.keys() else [])]
+        merged, added, changed, removed = diff_commands(groups.get(name, []), new_commands)
+        msg = '%s: %d added, %d changed, %d removed' % (name, len(added), len(changed), len(removed))
+        if name == __name__:
+            failed = compile_commands(added + changed, (PARAM_STRING, 'cmdObject'), globals(), logger)
+            msg = '%s%s' % (msg, ', %d failed' % failed if failed else '')
+            config['commands'] = conf['commands']
+        else:
+            strip = lambda triggers: [{k: v for k, v in t.items() if k != 'lastsent'} for t in triggers]
+            triggers = strip(conf['triggers'] if 'triggers' in conf.keys() else [])
+            triggers_changed = not old_conf or triggers != strip(old_conf['triggers'] if 'triggers' in old_conf.keys() else [])
+            if added or changed or removed or triggers_changed:
+                manager = [m for m in managers if m['name'] == name][0]
+                try:
+                    msg = '%s. Module: %s' % (msg, manager['rpc'].call('reload', commands=[command_definition(c) for c in added + changed],
+                                              removed=[c['commandtext'] for c in removed], triggers=triggers if triggers_changed else None))
+                except Exception as err:
+                    res.append('%s: reload failed: %s' % (name, err))
+                    continue
+            config['managers'] = [conf if x is old_conf else x for x in config['managers']]
+        groups[name] = merged
+        res.append(msg)
+    #Modules keep their order, so equal commands resolve the same way
+    order = [c['module'] for c in commands] + names
+    commands = [c for name in sorted(groups, key=order.index) for c in groups[name]]
+    commandIndex = QCommandIndex(commands)
+    res.append('%d users' % len(users))
+    logger.info('Commands reloaded: %s' % '; '.join(res))
+    return '\n'.join(res)
+
 def restore(arcname=None):
-    """Restores the previous version or any version provided by backup/arcname[.tar.gz] and reloads qbot to apply changes"""
+    """Restores the previous version or any snapshot arcname and reloads qbot to apply changes
+
+    Snapshots are taken from backup store (see qbackup.py). Old backup/arcname[.tar.gz] archives are restored as well
+    """
     global isWorking
     arcfile = '%s%s' % (backupdir, arcname) if arcname else '%s%s.tar.gz' % (backupdir, os.path.basename(os.path.normpath(maindir)))
     if not arcfile.endswith('.tar.gz'):
         arcfile = '%s.tar.gz' % arcfile
-    if os.path.exists(arcfile):
-        tar = tarfile.open(arcfile)
+    manifest = backupStore.manifest(os.path.basename(arcname) if arcname else None, os.path.normpath(maindir))
+    if manifest:
+        manifest, written = executor.run_killable(restore_snapshot, manifest['name'], timeout=backupTimeout)
+        res = 'Restoring %s (%s)\n%d of %d files written' % (manifest['name'], manifest['created'], written, len(manifest['files']))
+        logger.debug(res)
+        if os.path.exists(updatefile):
+            os.remove(updatefile)
+        isWorking = False
+    elif os.path.exists(arcfile):
         res = 'Restoring %s' % arcfile
         logger.debug(res)
-        tar.extractall()
-        listFiles = tar.getnames()
-        count = len(listFiles)
+        count = len(executor.run_killable(extract_archive, arcfile, timeout=backupTimeout))
         res += '\n%d files restored to %s' % (count, maindir)
         logger.debug('%d files restored to %s' % (count, maindir))
         if os.path.exists(updatefile):
             os.remove(updatefile)
         isWorking = False
     else:
-        res = "Archive doesn't exist: %s" % arcfile
+        res = "Snapshot or archive doesn't exist: %s" % (arcname if arcname else arcfile)
         logger.error(res)
     return res
     
@@ -530,36 +865,51 @@ def approveUpdate():
     return res
 
 def backup(src=None, arcname=None):
-    """Tar-ing and gz-ing any desired file. By defauld make backup of 'run' directory"""
+    """Saves snapshot arcname of any desired file or directory to backup store. By defauld make backup of 'run' directory
+
+    Unchanged files are not read again, new ones are compressed in executor process pool (see qbackup.py)
+    """
+    return make_snapshot(src, arcname)[1]
+
+def make_snapshot(src=None, arcname=None):
+    """Backup implementation. Returns (manifest, text). Manifest is None if the snapshot was not saved"""
     source = os.path.normpath(src) if src else os.path.normpath(maindir)
     if not os.path.exists(source):
-        return 'No such file or directory: %s' % source
-    listFull = ['%s/%s' % (source, x) for x in os.listdir(source)] if os.path.isdir(source) else [source]
+        return None, 'No such file or directory: %s' % source
     logger.debug('Source: %s' % source)
-    #Set the archive name. Given or default
-    destination = os.path.normpath(backupdir)
-    tarName = '%s/%s' % (destination, os.path.basename(arcname)) if arcname else '%s/%s' % (destination, os.path.basename(source))
-    tarName = tarName if tarName.endswith('.tar.gz') else '%s.tar.gz' % tarName    
-    logger.debug('Creating archive: %s' % tarName)
-    tar = tarfile.open(tarName, 'w:gz')
-    res = tarName
-    tar.add(source)
-    count = len(tar.getnames())
-    tar.close()
-    res = "%s\n%d files saved" % (res, count)
-    logger.debug("%d files saved" % (count))
-    return res
+    name = os.path.basename(arcname)[:-len('.tar.gz')] if arcname and arcname.endswith('.tar.gz') else os.path.basename(arcname) if arcname else None
+    try:
+        manifest = executor.run_killable(snapshot_job, source, name, timeout=backupTimeout)
+    except Exception as err:
+        res = 'Backup failed: %s' % err
+        logger.error(res)
+        return None, res
+    res = 'Snapshot %s\n%d files saved, %d new' % (manifest['name'], len(manifest['files']), manifest['new'])
+    if manifest['deleted']:
+        res = '%s\nOld snapshots deleted: %s' % (res, ', '.join(manifest['deleted']))
+    logger.debug(res)
+    return manifest, res
 
-def listFiles(path=None):
-    """Like ls"""
-    wpath = path if path else workdir
-    files = list(os.scandir(wpath))
-    res = '%s:\nType, Name, Size\n------------' % wpath
-    for f in files:
-        type = 'f' if f.is_file() else 'd' if f.is_dir() else 's'
-        size = f.stat().st_size
-        res = '%s\n%s, %s, %s' % (res, type, f.name, size)
-    return res
+def listFiles(param=None, cmdObject=None):
+    """Like ls. param: [PATH[/GLOB]] [glob=GLOB] [sort=name|size|mtime] [desc] [page=N] or 'next'
+
+    Returns lines iterator of a page. 'next' continues the last listing of the user without reading the directory again
+    """
+    user = (cmdObject['self'].name, str(cmdObject['replyto'])) if cmdObject else None
+    params = parse_files_params(param)
+    if 'next' in params:
+        return fileLister.page(user)
+    return fileLister.list(user, params['path'] if params['path'] else workdir, params['pattern'], params['sort'], params['desc'], params['page_size'])
+
+def getFile(fileName, cmdObject):
+    """Sends file to user. Files bigger than connector MAX_FILE_SIZE are sent by parts (see qtransfer.py)"""
+    connector = cmdObject['self']
+    return transfer.send(connector, cmdObject['replyto'], fileName, connector.MAX_FILE_SIZE)
+
+def resumeTransfer(id, cmdObject):
+    """Sends the rest of interrupted transfer id by the connector it was started by"""
+    running = dict([(c['name'], c['connector']) for c in connectors if c['connector'].is_alive()])
+    return transfer.resume(cmdObject['self'], id.strip() if id else '', running)
 
 def moveFile(param):
     """Like mv"""
@@ -583,45 +933,191 @@ def deleteFile(fileName):
         res = "Error! %s doesn't exist" % fileName
     return res
 
+def managers_metrics():
+    """Returns metrics snapshots of running manager modules labeled with module name"""
+    snapshots = []
+    for m in managers:
+        if not m['connector'].is_alive():
+            continue
+        try:
+            snapshots.append(metrics.merge([m['rpc'].call('metrics', timeout=5)], module=m['name']))
+        except Exception as err:
+            logger.warning('Could not get %s metrics: %s' % (m['name'], err))
+    return snapshots
+
+def getMetrics(filter_text=None):
+    """Returns metrics summary of qbot, connectors and manager modules. filter_text - show only series containing it"""
+    metrics.set('qbot_queue_depth', queue.qsize())
+    executor.set_metrics(metrics)
+    return metrics.summary(managers_metrics(), filter_text)
+
+def write_metrics():
+    """Writes Prometheus text file (config metrics: file)"""
+    try:
+        metrics.write(metricsFile, managers_metrics())
+    except Exception as err:
+        logger.error('Write metrics failed: %s' % err)
+
 #Send script-initiated message
 def sendMessage(msg, connectors = None):
-    """Sends message to default (or provided) connectors"""
+    """Queues message to outboxes of default (or provided) connectors. Connectors send it in their own threads"""
     if not connectors:
         connectors = mainConnectors
     for connector in connectors:
         for to in connector['to']:
             try:
-                connector['connector'].sendMessage(msg, to['address'])
+                connector['connector'].post(msg, to['address'])
             except Exception as err:
                 logger.error("Could not send message: %s" % err)
             #logger.debug("Message sent by %s" % connector['name'])
     
 def process_alerts(manager):
-    """Look for existing alerts from manager modules and send them to default connectors/users"""
-    if manager['alert_pipe_semaphore'].is_set():
+    """Look for existing alerts from manager modules and pass them to coalescer for default connectors/users
+
+    Alert is a dict {'text', 'urgent'} or just a text
+    """
+    if not manager['alert_pipe_semaphore'].is_set():
+        return
+    manager['alert_pipe_semaphore'].clear()
+    while manager['alert_pipe'].poll():
         alert = manager['alert_pipe'].recv()
-        manager['alert_pipe_semaphore'].clear()
-        sendMessage(alert)
-        logger.debug('Alert send: %s' % alert)
-    
+        if not isinstance(alert, dict):
+            alert = {'text': alert, 'urgent': False}
+        #Alert time is wall clock of manager process. Convert it to the age
+        since = monotonic() - max(time() - alert['time'], 0) if 'time' in alert else None
+        metrics.inc('qbot_alerts_total', module=manager['name'])
+        alerts.add(str(alert['text']), mainConnectors, alert.get('urgent', False), since)
+        logger.debug('Alert queued: %s' % alert)
+
+def check_managers():
+    """Fails the requests in flight to dead manager modules. Registers the late started ones"""
+    if startingManagers:
+        check_starting_managers()
+    for m in managers:
+        if not m['connector'].is_alive() and m['rpc'].pending:
+            m['rpc'].fail_all('%s is not running' % m['name'])
+
+def check_update():
+    """If Update is not confirmed in supposed time, roll it back"""
+    if isUpdating and (datetime.datetime.now() - startTime).total_seconds() > waitForConfirm:
+        restore()
+
+def wait_for_work(wait_timeout):
+    """Blocks until a command, an alert or a manager response comes or wait_timeout seconds passed
+
+    Without event_loop just sleeps wait_timeout seconds
+    """
+    if not eventLoop:
+        sleep(wait_timeout)
+        return
+    waitables = [queue.reader]
+    waitables.extend([m['alert_pipe'] for m in managers])
+    waitables.extend([m['command_pipe'] for m in managers if not m['rpc'].closed])
+    try:
+        wait(waitables, wait_timeout)
+    except Exception as err:
+        logger.error('Wait failed: %s' % err)
+        sleep(wait_timeout)
+
+def run_command(command, params, cmdObject):
+    """Runs the command of main module or passes it to its manager module. Returns the response
+
+    params - user text after the command. It's parsed if command has 'args' schema
+    """
+    if 'args' in command:
+        params = parse_args(command['args'], params)
+    if command['module'] == __name__: #If the command from main module
+        if not command['function']:
+            raise Exception(command['error'])
+        return command['function'](params, cmdObject)
+    manager = list(filter(lambda x: x['name'] == command['module'], managers))[0]
+    #The response comes to main loop, it completes the request (see QManagerRPC.dispatch())
+    return manager['rpc'].call('command', timeout=command['timeout'] if 'timeout' in command.keys() else None,
+                               command=command['commandtext'], params=params)
+
+def process_command(cmdObject):
+    """Checks the command from the queue and passes it to executor
+
+    The reply is sent by send_reply() when the command is done. Commands of one user and connector are run in order
+    """
+    cmdTextFull = cmdObject['command'] #Get the command text and upper it
+    cmdSource = cmdObject['self'] #Get the object that has received the command
+    if not isCommandAllowed(cmdObject): #Unknown senders are dropped before any parsing
+        return
+    #Parse command line. Retrieve command an its parameters
+    command_prepared = getCommand(cmdTextFull)
+    command = command_prepared['command']
+    cmdObject['commandtext'] = command['commandtext'] if command else 'unknown' #metrics label
+    timeout, exclusive = None, False
+    if command and not isCommandAllowed(cmdObject, command):
+        func = lambda: "Команда '%s' вам не разрешена" % command['commandtext']
+    elif not command:
+        #If the commands failed we need save though some influence: Several commands of last hope
+        if cmdTextFull == 'Reload':
+            func = lambda: 'Last hope: %s' % reload()
+        elif cmdTextFull.startswith('Restore'):
+            param = cmdTextFull[len('Restore'):].split()
+            param = param[0] if len(param) else None
+            func = lambda: 'Last hope: %s' % restore(param)
+            exclusive = True
+        else:
+            logger.debug('"%s": command not found' % cmdObject['command'])
+            func = lambda: "Неизвестная команда '%s'\nПопробуйте 'Help'" % cmdObject['command']
+    else:
+        user_id = cmdObject['user_id']            
+        logger.info("To module %s: Command='%s', params='%s', from='%s', source='%s'" % (command['module'], command['commandtext'], command_prepared['params'], user_id, cmdSource.name))
+        func = lambda: run_command(command, command_prepared['params'], cmdObject)
+        timeout = command['timeout'] if 'timeout' in command.keys() else None
+        exclusive = command['exclusive'] if 'exclusive' in command.keys() else False
+    executor.submit((cmdSource.name, str(cmdObject['replyto'])), func, lambda res, err: send_reply(cmdObject, res, err),
+                    timeout=timeout, exclusive=exclusive, name=cmdTextFull)
+
+def send_reply(cmdObject, response, error=None):
+    """Sends command response (or error) to the connector the command came from"""
+    labels = {'connector': cmdObject['self'].connectorName, 'command': cmdObject.get('commandtext', 'unknown')}
+    metrics.inc('qbot_commands_total', result='error' if error else 'ok', **labels)
+    if error:
+        response = "%s\nError: %s" % (cmdObject['command'], error)
+        logger.error(response)
+    if response: #if the command don't need response, it should return None
+        try:
+            #Iterator (generator) response is sent by parts while it's produced (see QMessenger.replyAll())
+            if not isinstance(response, Iterator):
+                response = str(response)
+                logger.debug('Response: %s...' % (response.splitlines() or [''])[0])
+            cmdObject['self'].replyAll(response, cmdObject) #Reply using the source object, Reply text and original command parameters
+        except Exception as err:
+            logger.error('response failed: %s' % err)
+            if isinstance(response, Iterator): #the error came from the response iterator. User should know the rest is missing
+                try:
+                    cmdObject['self'].reply("%s\nError: %s" % (cmdObject['command'], err), cmdObject)
+                except Exception:
+                    pass
+    #Inbound message to reply time
+    if 'queued' in cmdObject:
+        metrics.observe('qbot_command_seconds', monotonic() - cmdObject['queued'], **labels)
 
 #-------------------------------------------------------------------------------------------------------------------------------------
 #Script main function
 def main():
-    """Main work function. Eternal loop"""
+    """Main work function. Eternal loop
+
+    Every cycle waits for commands and alerts (see wait_for_work()), then processes all of them.
+    Connectors checks and update confirm checks are run by their own deadlines
+    """
     logger.info('Qbot started, version=%s' % VERSION)
     #global variables
     global relays
     global commands
     global sensors
     global isWorking    
-    global response
     global connectors, mainConnectors, managers
 
     #Filter 'Alive' connectors
     alive = [c['name'] for c in list(filter(lambda x: x['is_alive'], connectors))]
-    startMsg = 'Qbot version %s started:\n%d/%d connectors running: %s' % (VERSION, len(alive), len(config['connectors']), alive)
-    startMsg += '\n%d/%d managers running with %d commands' % (len(managers), len(config['managers']), len(commands))
+    startMsg = 'Qbot version %s started:\n%d/%d connectors running: %s' % (VERSION, len(alive), len(list(filter(is_enabled, config['connectors']))), alive)
+    startMsg += '\n%d/%d managers running with %d commands' % (len(managers), len(list(filter(is_enabled, config['managers']))), len(commands))
+    startMsg += '\nStartup: %.1f seconds' % startupSeconds()
     if isUpdating: #if in testing update mode
         startMsg += "\nUpdating mode. Wait %d seconds for approve" % waitForConfirm
     mainConnectors = None
@@ -636,100 +1132,46 @@ def main():
     except Exception as err:
         logger.error("Sending start message failed: %s" % (err))
     isWorking = True
+    nextCheck = monotonic() + timeout
+    nextMetrics = monotonic() + metricsInterval
+    #Update confirm deadline is counted from the start time
+    updateDeadline = monotonic() + waitForConfirm - (datetime.datetime.now() - startTime).total_seconds()
     while isWorking:
         """pick commands in cycle"""
-        sleep(timeout)
-        #check connectors's statuses
-        for c in connectors:
-            #if daemon is down
-            if not c['connector'].is_alive():
-                if c['is_alive']: #and this just happened
-                    msg = "Connector %s is DOWN!" % (c['name'])
-                    logger.error(msg) #log this event
-                    try:
-                        sendMessage(msg) # and send the message to user
-                        c['is_alive'] = False
-                    except Exception as err:
-                        logger.error("Sending message failed: %s" % (err))
-                if not c['autorestart']:
-                    continue
-                try: #trying to start it again
-                    #Get related config
-                    conf = list(filter(lambda x: x['name'] == c['name'], config['connectors']))[0]
-                    conn = init_connector(conf, queue, logger) #and try to reload daemon
-                    if conn:
-                        connectors.remove(c)
-                        connectors.append(conn)
-                        conn['is_alive'] = conn['connector'].is_alive()
-                        logger.info('Connector reloaded: %s' % conn['name'])
-                except Exception as err:
-                    logger.error("Could not reload connector %s: %s" % (c['name'], err))
+        deadline = min(nextCheck, updateDeadline) if isUpdating else nextCheck
+        if alerts.next_deadline() is not None:
+            deadline = min(deadline, alerts.next_deadline())
+        wait_for_work(max(deadline - monotonic(), 0))
+        if monotonic() >= nextCheck:
+            supervisor.check()
+            mainConnectors = list(filter(lambda x: x['default'], connectors)) #connectors may be added by supervisor
+            check_managers()
+            nextCheck = monotonic() + timeout
+            if metricsFile and monotonic() >= nextMetrics: #Managers are asked by worker thread, main loop completes the requests
+                executor.submit(('metrics', ''), write_metrics, lambda res, err: None, name='write_metrics')
+                nextMetrics = monotonic() + metricsInterval
         
-        #Check if managers sent alerts
+        #Complete manager requests and check if managers sent alerts
         for m in managers:
+            m['rpc'].dispatch()
             process_alerts(m)
+        alerts.flush()
         
-        #Check the queue for new command
-        if queue.empty(): #If no command - continue
-            continue
-        cmdObject = queue.get()
-        cmdTextFull = cmdObject['command'] #Get the command text and upper it
-        cmdSource = cmdObject['self'] #Get the object that has received the command
-        #Parse command line. Retrieve command an its parameters
-        command_prepared = getCommand(cmdTextFull)
-        if not isCommandAllowed(cmdObject):
-            logger.warning('Unknown user_id: %s' % cmdObject['user_id'])
-            continue
-        response = None
-        if not command_prepared['command']:
-            #If the commands failed we need save though some influence: Several commands of last hope
-            if cmdTextFull == 'Reload':
-                response = 'Last hope: %s' % reload()
-            if cmdTextFull.startswith('Restore'):
-                param = cmdTextFull[len('Restore'):].split()
-                param = None if len(param) else param
-                response = 'Last hope: %s' % restore(param)
-            if not response:
-                logger.debug('"%s": command not found' % cmdObject['command'])
-                response = "Неизвестная команда '%s'\nПопробуйте 'Help'" % cmdObject['command']
-        else:
-            msg_id = cmdObject['message_id']
-            msg_time = cmdObject['message_time']
-            user_id = cmdObject['user_id']            
-            logger.info("To module %s: Command='%s', params='%s', from='%s', source='%s'" % (command_prepared['command']['module'], command_prepared['command']['commandtext'], command_prepared['params'], user_id, cmdSource.name))
-            response = ''
-            if command_prepared['command']['module'] == __name__: #If the command from main module
-                #Creating command
-                try:
-                    cmd = ("global response;response = %s" % (command_prepared['command']['commandline'])).replace(PARAM_STRING, command_prepared['params'])
-                    logger.debug("Running: %s" % cmd)
-                    exec(cmd)
-                except Exception as err:
-                    response = "%s\nError: %s" % (cmdTextFull, err)
-                    logger.error(response)
-            else:
-                try:
-                    manager = list(filter(lambda x: x['name'] == command_prepared['command']['module'], managers))[0]
-                    cmd = command_prepared['command']['commandline'].replace(PARAM_STRING, command_prepared['params'])
-                    manager['command_pipe'].send(cmd)
-                    manager['command_pipe_semaphore'].set()
-                    response = manager['command_pipe'].recv() #TODO: insert block with timeout and semaphore analysis to avoid crashing remote side problems
-                except Exception as err:
-                    response = '%s\nError: %s' % (cmdTextFull, err)
-                    logger.error(response)
-        #Sending reply
-        if response: #if the command don't need response, it should return None
+        #Process all the commands came
+        queue.clear_wakeup()
+        metrics.set('qbot_queue_depth', queue.qsize())
+        executor.set_metrics(metrics)
+        while isWorking:
             try:
-                response = str(response)
-                logger.debug('Response: %s...' % response.splitlines()[0])
-                cmdSource.reply(response, cmdObject) #Reply using the source object, Reply text and original command parameters
-            except Exception as err:
-                logger.error('response failed: %s' % err)
+                cmdObject = queue.get_nowait()
+            except Empty:
+                break
+            process_command(cmdObject)
         
-        #Check if Update is not confirmed in supposed time, roll it back
-        if isUpdating and (datetime.datetime.now() - startTime).seconds > waitForConfirm:
-            restore()
+        check_update()
     logger.debug('Stopping')
+    alerts.flush(force=True)
+    executor.shutdown()
     #First send stop command to all Connectors, thus stop process will be parallel
     try:
         for c in connectors:
@@ -737,8 +1179,7 @@ def main():
                 c['connector'].stop()
         for m in managers:
             if m:
-                m['command_pipe'].send('self.stop()')
-                m['command_pipe_semaphore'].set()
+                m['rpc'].request('exec', code='self.stop()')
         #And now waiting the connectors to stop
         #sleep(25)
         for c in connectors:
@@ -756,7 +1197,13 @@ def main():
 #-------------------------------------------------------------------------------------------------------------------------------------
 #Start the script
 if __name__ == "__main__":
-    init()
+    parser = argparse.ArgumentParser(description='qbot - messengers bot for home automation')
+    parser.add_argument('--config', help='configuration file (default run/conf/qbot.yaml)')
+    parser.add_argument('--pidfile', help='PID file (default is taken from systemd qbot.service)')
+    parser.add_argument('--log', help='log file (default logqbot.txt)')
+    parser.add_argument('--cold-config', action='store_true', help='parse configuration files ignoring the cache')
+    args = parser.parse_args()
+    init(args.config, args.pidfile, args.log, args.cold_config)
     signal.signal(signal.SIGTERM, exitFunction)
     signal.signal(signal.SIGINT, exitFunction)
     #logger.removeHandler(ch)
@@ -0,0 +1,223 @@
+#!/usr/bin/python3
+"""Commands support for qbot
+
+QCommandIndex - commands lookup by the longest start match of user text (see qbot.getCommand())
+compile_commands() - compiles commands 'commandline' once at load time
+diff_commands() - compares the live commands with the ones read again from configuration
+parse_args() - parses command parameters by declarative 'args' schema
+"""
+
+import os
+
+class QCommandIndex:
+    """Longest-prefix trie over command texts
+
+    Every command is indexed twice: by 'commandtext' and by 'module.commandtext'. Both keys are lowercased.
+    lookup() walks the trie once along the user text, so its cost depends on the text length only.
+    If several commands have the same commandtext length the one added first wins (as the old linear scan did)
+    """
+    def __init__(self, commands=None):
+        self.root = {}
+        self.counter = 0 #Insertion order. Used to choose between equal matches
+        if commands:
+            for c in commands:
+                self.add(c)
+
+    @staticmethod
+    def keys(command):
+        """Returns the index keys of the command"""
+        text = command['commandtext'].lower()
+        return [text, '%s.%s' % (command['module'].lower(), text)]
+
+    def add(self, command):
+        """Adds command (dict with at least 'commandtext' and 'module' keys) to index"""
+        self.counter += 1
+        for key in self.keys(command):
+            node = self.root
+            for ch in key:
+                node = node.setdefault(ch, {})
+            #None key keeps the commands ending at this node: (order, key length, command)
+            node.setdefault(None, []).append((self.counter, len(key), command))
+
+    def remove(self, command):
+        """Removes command from index. Empty branches are pruned"""
+        for key in self.keys(command):
+            path = [self.root]
+            for ch in key:
+                node = path[-1].get(ch)
+                if node is None:
+                    break
+                path.append(node)
+            else:
+                node = path[-1]
+                entries = [x for x in node.get(None, []) if x[2] is not command]
+                if entries:
+                    node[None] = entries
+                else:
+                    node.pop(None, None)
+                #Prune the branch up to the first node still in use
+                for i in range(len(key), 0, -1):
+                    if path[i]:
+                        break
+                    del path[i-1][key[i-1]]
+
+    def remove_module(self, module):
+        """Removes all commands of module from index. Returns list of removed commands"""
+        removed = {}
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            for ch, child in node.items():
+                if ch is None:
+                    removed.update({id(x[2]): x[2] for x in child if x[2]['module'] == module})
+                else:
+                    stack.append(child)
+        removed = list(removed.values())
+        for c in removed:
+            self.remove(c)
+        return removed
+
+    def lookup(self, text):
+        """Finds the command with the longest commandtext matching the start of text
+
+        Returns tuple (command, position of parameters in text). (None, None) if nothing found
+        """
+        node = self.root
+        best = None
+        for ch in text.lower():
+            node = node.get(ch)
+            if node is None:
+                break
+            for order, length, command in node.get(None, ()):
+                rank = (len(command['commandtext']), -order)
+                if best is None or rank > best[0]:
+                    best = (rank, length, command)
+        if best is None:
+            return None, None
+        return best[2], best[1]
+
+#----------------------------------------------------------------------------------------------------
+#Compiled commands
+#Command 'commandline' is compiled once to a function. Parameters are passed to it as the variable
+#named COMMAND_PARAMETERS instead of substitution to the command text
+
+def compile_command(commandline, arguments, namespace):
+    """Compiles commandline to function with given arguments names
+
+    commandline - python expression (or several statements separated with ';', the first one gives the result)
+    namespace - globals of the function
+    Returns the function. Raises SyntaxError if commandline could not be compiled
+    """
+    source = 'def command(%s):\n    response = %s\n    return response\n' % (', '.join(arguments), commandline.replace('\n', ' '))
+    local = {}
+    exec(compile(source, '<command: %s>' % commandline, 'exec'), namespace, local)
+    return local['command']
+
+def compile_commands(commands, arguments, namespace, logger=None):
+    """Compiles 'commandline' of every command to command['function']
+
+    If compilation fails command['function'] is None and command['error'] keeps the error text
+    Returns the number of failed commands
+    """
+    failed = 0
+    for c in commands:
+        try:
+            if 'args' in c:
+                check_args(c['args'])
+            c['function'] = compile_command(str(c['commandline']), arguments, namespace)
+            c['error'] = None
+        except Exception as err:
+            c['function'] = None
+            c['error'] = "Command '%s' could not be compiled: %s" % (c['commandtext'], err)
+            failed += 1
+            if logger:
+                logger.error(c['error'])
+    return failed
+
+#Keys added to commands at runtime. diff_commands() ignores them
+RUNTIME_KEYS = ('module', 'function', 'error')
+
+def command_definition(command):
+    """Returns command fields from configuration (without runtime keys). It can be pickled (sent by pipe)"""
+    return {k: v for k, v in command.items() if k not in RUNTIME_KEYS}
+
+def diff_commands(old, new):
+    """Compares command lists by commandtext (case insensitive) and definition
+
+    Returns (merged, added, changed, removed):
+    merged - new list where the unchanged commands are taken from old (compiled functions are kept)
+    added, changed - commands from new to compile, removed - commands from old
+    """
+    def keyed(commands):
+        #The same commandtext may be repeated. Such commands are matched by their order
+        res, seen = [], {}
+        for c in commands:
+            text = c['commandtext'].lower()
+            seen[text] = seen.get(text, 0) + 1
+            res.append(((text, seen[text]), c))
+        return res
+    old_keyed = dict(keyed(old))
+    merged, added, changed = [], [], []
+    for key, c in keyed(new):
+        prev = old_keyed.pop(key, None)
+        if prev is None:
+            added.append(c)
+        elif command_definition(prev) != command_definition(c):
+            changed.append(c)
+        else:
+            c = prev
+        merged.append(c)
+    return merged, added, changed, list(old_keyed.values())
+
+#----------------------------------------------------------------------------------------------------
+#Argument schemas
+#Command may have 'args' field describing its parameters. Then user text is parsed by the schema
+#and the result is passed as COMMAND_PARAMETERS:
+#   args: int_list        'Relay on 1, 2 3'  -> [1, 2, 3]
+#   args: [path, string]  'Backup run, old'  -> ['run', 'old'] (comma separated, missing ones are None)
+
+BOOL_VALUES = {'1': True, 'on': True, 'true': True, 'yes': True, 'да': True, 'вкл': True,
+               '0': False, 'off': False, 'false': False, 'no': False, 'нет': False, 'выкл': False}
+
+def parse_string(text):
+    return text.strip()
+
+def parse_int(text):
+    text = text.strip()
+    return int(text) if text else None
+
+def parse_int_list(text):
+    return [int(x) for x in text.replace(',', ' ').split()]
+
+def parse_path(text):
+    text = text.strip()
+    return os.path.normpath(os.path.expanduser(text)) if text else None
+
+def parse_bool(text):
+    text = text.strip().lower()
+    if not text:
+        return None
+    if text not in BOOL_VALUES:
+        raise ValueError("'%s' is not a boolean value" % text)
+    return BOOL_VALUES[text]
+
+ARG_TYPES = {'string': parse_string, 'int': parse_int, 'int_list': parse_int_list, 'path': parse_path, 'bool': parse_bool}
+
+def check_args(schema):
+    """Raises ValueError if schema has unknown types"""
+    for t in (schema if isinstance(schema, list) else [schema]):
+        if t not in ARG_TYPES:
+            raise ValueError("Unknown argument type '%s'. Known types: %s" % (t, ', '.join(sorted(ARG_TYPES))))
+
+def parse_args(schema, text):
+    """Parses user text by schema (type name or list of type names)
+
+    Raises ValueError if text doesn't match the schema
+    """
+    if not isinstance(schema, list):
+        return ARG_TYPES[schema](text)
+    values = text.split(',') if text.strip() else []
+    if len(values) > len(schema):
+        raise ValueError('Too many parameters: %d, expected %d' % (len(values), len(schema)))
+    values += [''] * (len(schema) - len(values))
+    return [ARG_TYPES[t](v) for t, v in zip(schema, values)]
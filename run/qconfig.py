@@ -0,0 +1,83 @@
+#!/usr/bin/python3
+"""Configuration loading for qbot
+
+yaml files with !include statement. Parsed configuration is cached in a pickle file together with path,
+size and mtime of every file read. The cache is used while none of these files changed, so the start
+does not parse yaml again (it's slow on Raspberry Pi with long help texts)
+"""
+
+import os
+import pickle
+import logging
+import yaml
+
+#Cached data format version. Change it when Loader output changes
+CACHE_FORMAT = 1
+#libyaml parser is much faster. Pure python one is used if PyYAML is built without it
+BaseLoader = yaml.CSafeLoader if hasattr(yaml, 'CSafeLoader') else yaml.SafeLoader
+
+class Loader(BaseLoader):
+    """Adds the !include statement to yaml. files - (path, size, mtime) of files read, included ones too"""
+    def __init__(self, stream, files=None):
+        self._root = os.path.split(stream.name)[0]
+        self.files = files if files is not None else []
+        st = os.fstat(stream.fileno()) #taken before reading, so the file changed while parsing invalidates the cache
+        self.files.append((os.path.abspath(stream.name), st.st_size, st.st_mtime_ns))
+        super(Loader, self).__init__(stream)
+    def include(self, node):
+        filename = os.path.join(self._root, self.construct_scalar(node))
+        with open(filename, 'r') as f:
+            loader = Loader(f, self.files)
+            try:
+                return loader.get_single_data()
+            finally:
+                loader.dispose()
+Loader.add_constructor('!include', Loader.include)
+
+def files_key(files):
+    """Returns list of (path, size, mtime) of files. None if any of them is not available (cache is invalid)"""
+    res = []
+    for fileName in files:
+        try:
+            st = os.stat(fileName)
+        except OSError:
+            return None
+        res.append((fileName, st.st_size, st.st_mtime_ns))
+    return res
+
+def parse(fileName):
+    """Parses yaml file. Returns (config, (path, size, mtime) of files read)"""
+    with open(fileName, 'r') as f:
+        loader = Loader(f)
+        try:
+            return loader.get_single_data(), loader.files
+        finally:
+            loader.dispose()
+
+def load_config(fileName, cacheFile=None, cold=False, logger=None):
+    """Returns (config, True if taken from cache)
+
+    cacheFile - pickle file of parsed configuration. None - no cache
+    cold - parse yaml files anyway. The cache is rewritten
+    """
+    logger = logger if logger else logging.getLogger(__name__)
+    if cacheFile and not cold:
+        try:
+            with open(cacheFile, 'rb') as f:
+                cache = pickle.load(f)
+            if cache['format'] == CACHE_FORMAT and cache['files'][0][0] == os.path.abspath(fileName) \
+                    and cache['files'] == files_key([x[0] for x in cache['files']]):
+                return cache['config'], True
+        except Exception as err:
+            if os.path.exists(cacheFile):
+                logger.warning('Configuration cache %s is not used: %s' % (cacheFile, err))
+    config, key = parse(fileName)
+    if cacheFile:
+        tmpName = '%s.tmp' % cacheFile
+        try:
+            with open(tmpName, 'wb') as f:
+                pickle.dump({'format': CACHE_FORMAT, 'files': key, 'config': config}, f, pickle.HIGHEST_PROTOCOL)
+            os.replace(tmpName, cacheFile)
+        except Exception as err:
+            logger.warning('Could not write configuration cache %s: %s' % (cacheFile, err))
+    return config, False
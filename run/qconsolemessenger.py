@@ -89,8 +89,8 @@ class QConsoleMessenger(QMessenger):
         res['messages'].append(msg)
         return res
     
-    def reply(self, msg, originalCommand):
-        self.sendMessage(msg)
+    def sendReply(self, msg, originalCommand):
+        return self.sendMessage(msg)
     #Unexpectadly, sends the message from Telegram bot
     def sendMessage(self, msg, to=None):
         try:
@@ -101,7 +101,7 @@ class QConsoleMessenger(QMessenger):
             res = "failed: %s" % err
         self.sendStatusText = res
         self.logger.error(res)
-        return res
+        return res if res == 'OK' else False
 
     def stop(self):
         QMessenger.stop(self)
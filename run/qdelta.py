@@ -0,0 +1,200 @@
+#!/usr/bin/python3
+"""Delta update packages for qbot (Update command)
+
+A delta package is tar.gz with delta.json as the first member and the changed files under 'files/'.
+delta.json keeps sha256 of the base files the delta changes or deletes (their version the delta is made for),
+hash, size and mode of every new or changed file and the deleted paths. Paths are relative to working directory (run/qbot.py).
+Before update the base is checked, so the delta doesn't overwrite another version of those files. Other files
+may differ. Files are extracted by streaming to temporary files and checked by hash, nothing is replaced until all of them are good.
+Data files (databases) are not a part of version, local configuration (conf/) is updated if changed but never deleted.
+
+Making a delta (BASE - directory of the installed version or snapshot manifest backup/store/snapshots/NAME.json):
+    python3 run/qdelta.py make [--prefix run] BASE NEW_DIR OUTPUT.tar.gz
+    python3 run/qdelta.py show PACKAGE
+"""
+
+import io
+import os
+import sys
+import json
+import tarfile
+import hashlib
+import argparse
+from qbackup import file_hash, READ_SIZE
+
+HEADER = 'delta.json'
+FORMAT = 1
+#Not a part of version: compiled files, caches and data written by the running system
+SKIP_DIRS = ('__pycache__',)
+SKIP_SUFFIXES = ('.pyc', '.pyo', '.db', '.db-journal', '.sqlite', '.sqlite3')
+#Local configuration: delivered if changed, but never deleted by delta
+KEEP_DIRS = ('conf',)
+
+def versioned(path):
+    """False for files not being a part of version"""
+    return not path.endswith(SKIP_SUFFIXES) and not any([x in SKIP_DIRS for x in path.split(os.sep)])
+
+def kept(path):
+    """True for local files delta never deletes"""
+    return any([x in KEEP_DIRS for x in os.path.dirname(path).split(os.sep)])
+
+def tree_hashes(folder, prefix):
+    """Returns {prefix/relative path: sha256} of files in folder"""
+    res = {}
+    for d, _, names in os.walk(folder):
+        for x in names:
+            path = os.path.join(d, x)
+            name = os.path.normpath(os.path.join(prefix, os.path.relpath(path, folder)))
+            if versioned(name) and os.path.isfile(path):
+                res[name] = file_hash(path)
+    return res
+
+def check_path(path):
+    """Raises ValueError for paths leading out of working directory"""
+    if os.path.isabs(path) or os.path.normpath(path).split(os.sep)[0] == '..':
+        raise ValueError('Wrong path in delta: %s' % path)
+
+def make_delta(base, folder, output, prefix='run'):
+    """Writes delta package of folder against base ({path: hash}). Returns header
+
+    Just the base files the delta changes or deletes are kept in header
+    """
+    base = dict([(path, digest) for path, digest in base.items() if versioned(path)])
+    new = tree_hashes(folder, prefix)
+    header = {'format': FORMAT, 'base': {}, 'files': {}, 'deleted': sorted([x for x in set(base) - set(new) if not kept(x)])}
+    for path, digest in sorted(new.items()):
+        if base.get(path) != digest:
+            st = os.stat(os.path.join(folder, os.path.relpath(path, prefix)))
+            header['files'][path] = {'hash': digest, 'size': st.st_size, 'mode': st.st_mode & 0o7777}
+    for path in list(header['files']) + header['deleted']:
+        if path in base:
+            header['base'][path] = base[path]
+    data = json.dumps(header, indent=1, sort_keys=True).encode('utf-8')
+    with tarfile.open(output, 'w:gz') as tar:
+        info = tarfile.TarInfo(HEADER)
+        info.size = len(data)
+        tar.addfile(info, io.BytesIO(data))
+        for path in sorted(header['files']):
+            tar.add(os.path.join(folder, os.path.relpath(path, prefix)), 'files/%s' % path, recursive=False)
+    return header
+
+def is_delta(fileName):
+    """True if fileName is delta package (delta.json is the first member)"""
+    try:
+        with tarfile.open(fileName, 'r|*') as tar:
+            member = tar.next()
+            return member is not None and member.name == HEADER
+    except (tarfile.TarError, OSError):
+        return False
+
+def read_header(fileName):
+    """Returns delta.json of package. Only the beginning of the archive is read"""
+    with tarfile.open(fileName, 'r|*') as tar:
+        member = tar.next()
+        if member is None or member.name != HEADER:
+            raise ValueError('%s is not a delta package' % fileName)
+        header = json.loads(tar.extractfile(member).read().decode('utf-8'))
+    if header.get('format') != FORMAT:
+        raise ValueError('Unknown delta format: %s' % header.get('format'))
+    for path in list(header['files']) + header['deleted']:
+        check_path(path)
+    return header
+
+def check_base(header, root='.'):
+    """Returns list of base files differing from root (missing or changed). Empty list - delta may be applied
+
+    Just the files the delta changes or deletes are checked, whatever the package base keeps
+    """
+    res = []
+    touched = set(header['files']) | set(header['deleted'])
+    for path, digest in sorted(header['base'].items()):
+        if path not in touched:
+            continue
+        fileName = os.path.join(root, path)
+        if not os.path.isfile(fileName):
+            res.append('%s: missing' % path)
+        elif file_hash(fileName) != digest:
+            res.append('%s: changed' % path)
+    return res
+
+def apply_delta(fileName, root='.'):
+    """Extracts delta package to root. Returns header
+
+    Files are streamed to temporary ones next to their places and checked by hash and size. Any mismatch
+    raises ValueError and leaves root untouched. The base is not checked here (see check_base())
+    """
+    header = read_header(fileName)
+    staged = {}
+    try:
+        with tarfile.open(fileName, 'r|*') as tar:
+            for member in tar:
+                if member.name == HEADER:
+                    continue
+                path = member.name[len('files/'):] if member.name.startswith('files/') else None
+                if not member.isfile() or path not in header['files']:
+                    raise ValueError('Unexpected member in delta: %s' % member.name)
+                info = header['files'][path]
+                target = os.path.join(root, path)
+                folder = os.path.dirname(target)
+                if folder:
+                    os.makedirs(folder, exist_ok=True)
+                tmp = '%s.delta.tmp' % target
+                staged[path] = tmp
+                h, size = hashlib.sha256(), 0
+                src = tar.extractfile(member)
+                with open(tmp, 'wb') as dst:
+                    for block in iter(lambda: src.read(READ_SIZE), b''):
+                        h.update(block)
+                        size += len(block)
+                        dst.write(block)
+                if h.hexdigest() != info['hash'] or size != info['size']:
+                    raise ValueError('Hash mismatch: %s' % path)
+                os.chmod(tmp, info['mode'])
+        missing = set(header['files']) - set(staged)
+        if missing:
+            raise ValueError('Files missing in delta: %s' % ', '.join(sorted(missing)))
+    except Exception:
+        for tmp in staged.values():
+            if os.path.exists(tmp):
+                os.remove(tmp)
+        raise
+    for path, tmp in staged.items():
+        os.replace(tmp, os.path.join(root, path))
+    for path in header['deleted']:
+        if versioned(path) and not kept(path) and os.path.isfile(os.path.join(root, path)):
+            os.remove(os.path.join(root, path))
+    return header
+
+def summary(header):
+    """Returns text about delta"""
+    return '%d base files to check, %d new or changed (%d bytes), %d deleted' % (len(header['base']), len(header['files']),
+                                                                         sum([x['size'] for x in header['files'].values()]), len(header['deleted']))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='qbot delta update packages')
+    sub = parser.add_subparsers(dest='action')
+    make = sub.add_parser('make', help='make delta package')
+    make.add_argument('--prefix', default='run', help='path of NEW_DIR in working directory (default run)')
+    make.add_argument('base', help='directory of the installed version or snapshot manifest (.json)')
+    make.add_argument('new', help='directory of the new version')
+    make.add_argument('output', help='package file name')
+    show = sub.add_parser('show', help='show delta package')
+    show.add_argument('package')
+    args = parser.parse_args()
+    if args.action == 'make':
+        if os.path.isfile(args.base):
+            with open(args.base) as f:
+                base = dict([(path, x['hash']) for path, x in json.load(f)['files'].items()])
+        else:
+            base = tree_hashes(args.base, args.prefix)
+        print(summary(make_delta(base, args.new, args.output, args.prefix)))
+    elif args.action == 'show':
+        header = read_header(args.package)
+        print(summary(header))
+        for path in sorted(header['files']):
+            print('+ %s' % path)
+        for path in header['deleted']:
+            print('- %s' % path)
+    else:
+        parser.print_help()
+        sys.exit(1)
@@ -13,6 +13,7 @@ from email.mime.multipart import MIMEMultipart
 from email.utils import COMMASPACE, formatdate
 
 class QEmailMessenger(QMessenger):
+    MAX_FILE_SIZE = 10 * 1024 * 1024 #Mail servers limit messages size, attachments grow by base64
     def __init__(self, **config):
         QMessenger.__init__(self, VERSION=VERSION, **config)
         self.isOk = True
@@ -74,7 +75,7 @@ class QEmailMessenger(QMessenger):
             self.logger.error(res)
         return res
             
-    def reply(self, msg, originalCommand):
+    def sendReply(self, msg, originalCommand):
         a = originalCommand['message']
         fromaddr = a.get('To')
         toaddr = a.get('From')
@@ -82,19 +83,20 @@ class QEmailMessenger(QMessenger):
         enc = a.get('Content-Transfer-Encoding')
         if not subj.upper().startswith('RE:'):
             subj = 'Re: ' + subj
-        return self.simpleSendMessage(fromaddr, toaddr, subj, msg)
+        res = self.simpleSendMessage(fromaddr, toaddr, subj, msg)
+        return res if res.startswith('OK') else False
 
     #Just for connectivity
     def sendMessage(self, msg, to, fileName=None):
         fromaddr = self.login
         subj = "%s: send" % self.searchSubject[0]
-        return self.simpleSendMessage(fromaddr, to, subj, msg, fileName=fileName)
+        res = self.simpleSendMessage(fromaddr, to, subj, msg, fileName=fileName)
+        return res if res.startswith('OK') else False
         
     def sendFile(self, to, fileName):
         self.logger.debug(to)
         self.logger.debug(fileName)
-        self.sendMessage(fileName, to, fileName = fileName)
-        return False
+        return self.sendMessage(os.path.basename(fileName), to, fileName = fileName)
     
     def get_message(self, id, connection = None):
         if not connection:
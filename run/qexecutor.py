@@ -0,0 +1,257 @@
+#!/usr/bin/python3
+"""Command executor for qbot
+
+Commands run on a bounded pool of worker threads, so a slow command doesn't block the main loop and other users.
+Commands with the same key (connector and user) run one by one, thus replies keep their order.
+Exclusive commands (Update, Restore etc.) wait for all running commands and block the new ones until finished
+
+Python threads can't be killed, so a command running after its timeout keeps its lock. Such holder is marked hung:
+the commands it blocks fail at once instead of waiting forever in worker threads. Work which may hang should run
+by run_killable() in a separate process killed on timeout
+"""
+
+import os
+import signal
+import threading
+import logging
+import multiprocessing
+from time import monotonic
+from collections import deque
+from collections.abc import Iterator
+from concurrent.futures import ThreadPoolExecutor
+
+class QRWLock:
+    """Shared/exclusive lock. Exclusive waiters have priority over the new shared ones
+
+    holders - {key: {'name', 'exclusive', 'started', 'hung'}} of the holders given key. Waiters blocked by a hung
+    holder (running after its timeout, see mark_hung()) get RuntimeError instead of waiting
+    """
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.readers = 0
+        self.writer = False
+        self.writers_waiting = 0
+        self.holders = {}
+
+    def acquire(self, exclusive=False, key=None, name=''):
+        with self.cond:
+            if exclusive:
+                self.writers_waiting += 1
+                try:
+                    while self.writer or self.readers:
+                        self.check_hung(True)
+                        self.cond.wait()
+                finally:
+                    self.writers_waiting -= 1
+                    self.cond.notify_all() #shared waiters may go if this waiter failed
+                self.writer = True
+            else:
+                while self.writer or self.writers_waiting:
+                    self.check_hung(False)
+                    self.cond.wait()
+                self.readers += 1
+            if key is not None:
+                self.holders[key] = {'name': name, 'exclusive': exclusive, 'started': monotonic(), 'hung': False}
+
+    def check_hung(self, exclusive):
+        """Raises RuntimeError if a hung holder blocks the waiter. Called with cond held"""
+        blocking = [x['name'] for x in self.holders.values() if x['hung'] and (x['exclusive'] or exclusive)]
+        if blocking:
+            raise RuntimeError('Blocked by %s running after timeout' % ', '.join(sorted(blocking)))
+
+    def release(self, exclusive=False, key=None):
+        with self.cond:
+            if exclusive:
+                self.writer = False
+            else:
+                self.readers -= 1
+            self.holders.pop(key, None)
+            self.cond.notify_all()
+
+    def mark_hung(self, key):
+        """Holder key is running after its timeout. Wakes the waiters to fail. Returns False if it isn't holding the lock already"""
+        with self.cond:
+            if key not in self.holders:
+                return False
+            self.holders[key]['hung'] = True
+            self.cond.notify_all()
+            return True
+
+    def holders_list(self):
+        """Returns copy of holders"""
+        with self.cond:
+            return [dict(x) for x in self.holders.values()]
+
+def killable_target(conn, func, args):
+    """run_killable() child process. Sends ('ok', result) or ('error', exception)"""
+    os.setsid() #own process group, so the processes started by func are killed too
+    try:
+        res = ('ok', func(*args))
+    except Exception as err:
+        res = ('error', err)
+    try:
+        conn.send(res)
+    except Exception as err: #not picklable
+        conn.send(('error', RuntimeError(repr(res[1]) if res[0] == 'error' else 'Result is not picklable: %s' % err)))
+    conn.close()
+
+class QCommandExecutor:
+    """Runs commands in worker threads keeping their order per key"""
+    def __init__(self, workers=4, timeout=60, logger=None):
+        """Sets executor values:
+
+        workers - number of worker threads
+        timeout - default command timeout in seconds. 0 - no timeout
+        """
+        self.logger = logger if logger else logging.getLogger(__name__)
+        self.timeout = timeout
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.rwlock = QRWLock()
+        self.lock = threading.Lock()
+        self.lanes = {} #key -> deque of jobs waiting. The first job of lane is running
+
+    def submit(self, key, func, callback, timeout=None, exclusive=False, name=''):
+        """Queues func() to the lane of key
+
+        callback(result, error) is called from worker thread when func finished or timeout expired.
+        If func finishes after timeout its result is discarded
+        """
+        job = {'func': func, 'callback': callback, 'timeout': self.timeout if timeout is None else timeout,
+               'exclusive': exclusive, 'name': name, 'done': False, 'timer': None, 'deadline': None}
+        with self.lock:
+            lane = self.lanes.setdefault(key, deque())
+            lane.append(job)
+            start = len(lane) == 1
+        if start:
+            self._start(key, job)
+
+    def pending(self):
+        """Returns number of commands running and waiting"""
+        with self.lock:
+            return sum([len(x) for x in self.lanes.values()])
+
+    def running(self):
+        """Returns [(name, exclusive, seconds running, True if timed out)] of commands holding the lock, timed out ones too"""
+        now = monotonic()
+        return [(x['name'], x['exclusive'], now - x['started'], x['hung']) for x in self.rwlock.holders_list()]
+
+    def status(self):
+        """Returns text about commands running, exclusive and hung ones"""
+        running = self.running()
+        #Timed out commands have left their lanes, but still hold the lock
+        lines = ['Commands: %d running, %d waiting' % (len(running), self.pending() - len([x for x in running if not x[3]]))]
+        for name, exclusive, seconds, hung in running:
+            if exclusive or hung:
+                lines.append('%s%s: %.0f s%s' % ('Exclusive ' if exclusive else '', name, seconds,
+                                                 ', timed out, blocks %s commands' % ('all' if exclusive else 'exclusive') if hung else ''))
+        return '\n'.join(lines)
+
+    def set_metrics(self, metrics):
+        """Sets executor gauges to qmetrics registry"""
+        running = self.running()
+        metrics.set('qbot_executor_pending', self.pending())
+        metrics.set('qbot_executor_hung', len([x for x in running if x[3]]))
+        metrics.set('qbot_executor_exclusive_seconds', max([x[2] for x in running if x[1]] + [0]))
+
+    def run_killable(self, func, *args, timeout=None):
+        """Runs func(*args) in a new process and waits for result. Exception of func is raised here
+
+        The process group is killed after timeout seconds (None - executor timeout, 0 - no timeout) and TimeoutError
+        raised, so hung I/O doesn't keep the command lock. The child is forked (not daemonic, so func may use a process pool): func may be any callable, result should be picklable
+        """
+        timeout = self.timeout if timeout is None else timeout
+        reader, writer = multiprocessing.Pipe(duplex=False)
+        proc = multiprocessing.get_context('fork').Process(target=killable_target, args=(writer, func, args))
+        proc.start()
+        writer.close()
+        try:
+            if not reader.poll(timeout if timeout else None):
+                self.kill_group(proc)
+                raise TimeoutError('Killed after %s seconds' % timeout)
+            try:
+                status, res = reader.recv()
+            except EOFError:
+                raise RuntimeError('Process exited with code %s' % proc.exitcode)
+        finally:
+            reader.close()
+            proc.join(1)
+        if status == 'error':
+            raise res
+        return res
+
+    def kill_group(self, proc):
+        """Kills process group of run_killable() child"""
+        for sig in (signal.SIGTERM, signal.SIGKILL):
+            try:
+                os.killpg(proc.pid, sig)
+            except OSError: #already gone
+                return
+            proc.join(2)
+            if not proc.is_alive():
+                break
+
+    def shutdown(self, wait=False):
+        """Stops executor. Running commands are not interrupted"""
+        self.pool.shutdown(wait=wait)
+
+    def _start(self, key, job):
+        try:
+            self.pool.submit(self._run, key, job)
+        except RuntimeError as err: #executor is shut down
+            self.logger.warning('%s not started: %s' % (job['name'], err))
+
+    def _run(self, key, job):
+        result, error = None, None
+        try:
+            self.rwlock.acquire(job['exclusive'], id(job), job['name'])
+        except RuntimeError as err: #a hung command holds the lock
+            self._finish(key, job, None, err)
+            return
+        #Timeout is counted from the real start, waiting for exclusive command is not included
+        if job['timeout']:
+            job['deadline'] = monotonic() + job['timeout']
+            job['timer'] = threading.Timer(job['timeout'], self._expire, (key, job))
+            job['timer'].daemon = True
+            job['timer'].start()
+        try:
+            result = job['func']()
+            if isinstance(result, Iterator) and job['deadline']:
+                result = self._limited(result, job)
+        except Exception as err:
+            error = err
+        finally:
+            self.rwlock.release(job['exclusive'], id(job))
+        self._finish(key, job, result, error)
+
+    def _limited(self, iterator, job):
+        """Iterator response is consumed by callback after the command returned. Its timeout is checked between items"""
+        for item in iterator:
+            yield item
+            if monotonic() > job['deadline']:
+                raise TimeoutError('Timeout %s seconds expired. The rest of response is dropped' % job['timeout'])
+
+    def _expire(self, key, job):
+        if self.rwlock.mark_hung(id(job)):
+            self.logger.error('%s is running after %s seconds timeout, its lock is held' % (job['name'], job['timeout']))
+        self._finish(key, job, None, TimeoutError('Timeout %s seconds expired. Command is still running' % job['timeout']))
+
+    def _finish(self, key, job, result, error):
+        with self.lock:
+            if job['done']:
+                self.logger.warning('%s finished after timeout. Result discarded' % job['name'])
+                return
+            job['done'] = True
+        if job['timer']:
+            job['timer'].cancel()
+        try:
+            job['callback'](result, error)
+        except Exception as err:
+            self.logger.error('%s callback failed: %s' % (job['name'], err))
+        with self.lock:
+            lane = self.lanes[key]
+            lane.popleft()
+            next_job = lane[0] if lane else None
+            if not lane:
+                del self.lanes[key]
+        if next_job:
+            self._start(key, next_job)
@@ -0,0 +1,108 @@
+#!/usr/bin/python3
+"""Files listing for qbot (List files command)
+
+Directory entries with their stat are cached for cache_ttl seconds, so paging and repeated listings don't scan
+the directory again. Listing is filtered by glob pattern, sorted by name, size or mtime and sent by pages.
+Every user has a cursor: 'List files next' continues from the place the last page stopped
+"""
+
+import os
+import fnmatch
+import datetime
+import threading
+from time import monotonic
+
+SORT_KEYS = {'name': lambda x: x[0].lower(), 'size': lambda x: x[2], 'mtime': lambda x: x[3]}
+
+class QFileLister:
+    """Directory listings with stat cache and per user cursors"""
+    def __init__(self, page_size=20, cache_ttl=10, cache_size=20):
+        """page_size - entries per page, cache_ttl - seconds directory entries are kept, cache_size - directories kept"""
+        self.page_size = page_size
+        self.cache_ttl = cache_ttl
+        self.cache_size = cache_size
+        self.lock = threading.Lock()
+        self.cache = {} #path -> (time, [(name, type, size, mtime)])
+        self.cursors = {} #user key -> {'path', 'title', 'entries', 'pos', 'page_size'}
+
+    def entries(self, path):
+        """Returns [(name, type, size, mtime)] of directory. Type: f - file, d - directory, s - other"""
+        path = os.path.abspath(path)
+        with self.lock:
+            cached = self.cache.get(path)
+        if cached and monotonic() - cached[0] < self.cache_ttl:
+            return cached[1]
+        res = []
+        for f in os.scandir(path):
+            try:
+                st = f.stat()
+            except OSError: #broken link
+                st = f.stat(follow_symlinks=False)
+            type = 'd' if f.is_dir() else 'f' if f.is_file() else 's'
+            res.append((f.name, type, st.st_size, st.st_mtime))
+        with self.lock:
+            if path not in self.cache and len(self.cache) >= self.cache_size:
+                del self.cache[min(self.cache, key=lambda x: self.cache[x][0])]
+            self.cache[path] = (monotonic(), res)
+        return res
+
+    def list(self, user, path, pattern=None, sort='name', desc=False, page_size=None):
+        """Makes new cursor for user and returns its first page (see page())"""
+        if sort not in SORT_KEYS:
+            raise ValueError("Unknown sort '%s'. Use %s" % (sort, ', '.join(sorted(SORT_KEYS))))
+        entries = self.entries(path)
+        if pattern:
+            entries = [x for x in entries if fnmatch.fnmatch(x[0], pattern)]
+        entries = sorted(entries, key=SORT_KEYS[sort], reverse=desc)
+        title = '%s%s' % (os.path.join(path, pattern) if pattern else path, ', sort: %s%s' % (sort, ' desc' if desc else ''))
+        with self.lock:
+            self.cursors[user] = {'path': path, 'title': title, 'entries': entries, 'pos': 0, 'page_size': page_size or self.page_size}
+        return self.page(user)
+
+    def page(self, user):
+        """Returns iterator of the next page lines of user cursor"""
+        with self.lock:
+            cursor = self.cursors.get(user)
+            if not cursor or cursor['pos'] >= len(cursor['entries']):
+                self.cursors.pop(user, None)
+                return iter(['No more files. Start with List files PATH'])
+            start, total = cursor['pos'], len(cursor['entries'])
+            entries = cursor['entries'][start:start + cursor['page_size']]
+            cursor['pos'] += len(entries)
+        def lines():
+            yield '%s: %d-%d of %d\nType, Name, Size, Modified\n------------' % (cursor['title'], start + 1, start + len(entries), total)
+            for name, type, size, mtime in entries:
+                yield '\n%s, %s, %s, %s' % (type, name, size, datetime.datetime.fromtimestamp(mtime).strftime('%Y-%m-%d %H:%M'))
+            if start + len(entries) < total:
+                yield '\n------------\nMore: List files next'
+        return lines()
+
+def parse_params(text):
+    """Parses List files parameters: [PATH[/GLOB]] [glob=GLOB] [sort=name|size|mtime] [desc] [page=N] or 'next'
+
+    Returns dict with path, pattern, sort, desc, page_size keys or {'next': True}
+    """
+    words = text.split() if text else []
+    if [x.lower() for x in words] == ['next']:
+        return {'next': True}
+    res = {'path': None, 'pattern': None, 'sort': 'name', 'desc': False, 'page_size': None}
+    path = []
+    for word in words:
+        key, eq, value = word.partition('=')
+        if eq and key.lower() == 'glob':
+            res['pattern'] = value
+        elif eq and key.lower() == 'sort':
+            res['sort'] = value.lower()
+        elif eq and key.lower() == 'page':
+            res['page_size'] = int(value)
+        elif word.lower() == 'desc':
+            res['desc'] = True
+        else:
+            path.append(word)
+    path = ' '.join(path)
+    #Glob in the last part of path: download/*.zip
+    folder, name = os.path.split(path)
+    if not res['pattern'] and any([c in name for c in '*?[']):
+        path, res['pattern'] = folder, name
+    res['path'] = path
+    return res
@@ -0,0 +1,300 @@
+#!/usr/bin/python3
+"""Logging for qbot
+
+Writing: threads and manager processes put records to queues (QueueHandler). QLogListener thread of the main
+process takes them by batches and passes to the handlers: log file (QLogFileHandler, rotated by size and age,
+rotated files are compressed), memory buffer and stdout at startup. Nobody else writes the log file, so lines of
+different processes are not interleaved, and logging doesn't wait for disk.
+
+Reading (Log tail command): QRingBufferHandler keeps the last records in memory, so recent lines are taken
+without I/O. Older history is read from the log file backwards by blocks (reverse_lines()), the file is never
+loaded as a whole. Records are filtered by level, logger name, text or regex and time (see make_filter())
+"""
+
+import os
+import re
+import gzip
+import shutil
+import logging
+import logging.handlers
+import datetime
+import threading
+import multiprocessing
+from queue import Queue, Empty
+from collections import deque
+from time import time
+
+LOG_FORMAT = '%(asctime)s %(name)s %(levelname)s: %(message)s'
+#Log file line starting a record (see LOG_FORMAT). Message lines after it belong to the same record
+RECORD_START = re.compile(r'^(\d{4}-\d\d-\d\d \d\d:\d\d:\d\d),(\d{3}) (\S+) ([A-Z]+): ')
+BLOCK_SIZE = 65536
+
+class QRingBufferHandler(logging.Handler):
+    """Keeps the last 'capacity' records as (time, level, logger name, formatted text)"""
+    def __init__(self, capacity=1000):
+        logging.Handler.__init__(self)
+        self.records = deque(maxlen=capacity)
+
+    def emit(self, record):
+        try:
+            self.records.append((record.created, record.levelno, record.name, self.format(record)))
+        except Exception:
+            self.handleError(record)
+
+    def tail(self, n, match=None):
+        """Returns the last n records passing match(record), the oldest first"""
+        self.acquire()
+        try:
+            records = list(self.records)
+        finally:
+            self.release()
+        res = []
+        for record in reversed(records):
+            if match is None or match(record):
+                res.append(record)
+                if len(res) >= n:
+                    break
+        return res[::-1]
+
+class QLogFileHandler(logging.FileHandler):
+    """Log file written by QLogListener. Records are not flushed one by one, the listener flushes every batch
+
+    The file is rotated when it's bigger than max_size bytes or its first record is older than max_age seconds (0 - no limit).
+    Rotated files are <file>.YYYYmmdd-HHMMSS[.gz], the ones above backup_count are deleted. Compression runs in background
+    """
+    def __init__(self, fileName, max_size=0, max_age=0, backup_count=5, compress=True):
+        self.max_size = max_size
+        self.max_age = max_age
+        self.backup_count = backup_count
+        self.compress = compress
+        self.cleanup_lock = threading.Lock() #rotations may follow each other faster than compression
+        logging.FileHandler.__init__(self, fileName)
+
+    def _open(self):
+        stream = open(self.baseFilename, 'ab')
+        self.size = stream.seek(0, os.SEEK_END)
+        self.started = first_record_time(self.baseFilename) if self.size else None
+        return stream
+
+    def emit(self, record):
+        try:
+            if self.stream is None:
+                self.stream = self._open()
+            data = (self.format(record) + '\n').encode('utf-8')
+            if self.size and ((self.max_size and self.size + len(data) > self.max_size)
+                              or (self.max_age and self.started and record.created - self.started > self.max_age)):
+                self.rotate()
+            if self.started is None:
+                self.started = record.created
+            self.stream.write(data)
+            self.size += len(data)
+        except Exception:
+            self.handleError(record)
+
+    def rotate(self):
+        """Renames log file and opens the new one. Called with handler lock held"""
+        self.stream.close()
+        name = '%s.%s' % (self.baseFilename, datetime.datetime.now().strftime('%Y%m%d-%H%M%S'))
+        while os.path.exists(name) or os.path.exists('%s.gz' % name):
+            name = '%s_' % name
+        os.replace(self.baseFilename, name)
+        self.stream = self._open()
+        threading.Thread(target=self.cleanup, args=(name,), name='LogRotation', daemon=True).start()
+
+    def cleanup(self, name):
+        """Compresses rotated file and deletes the old ones"""
+        with self.cleanup_lock:
+            self.cleanup_files(name)
+
+    def cleanup_files(self, name):
+        try:
+            if self.compress:
+                with open(name, 'rb') as src, gzip.open('%s.gz' % name, 'wb') as dst:
+                    shutil.copyfileobj(src, dst)
+                os.remove(name)
+            folder, base = os.path.split(self.baseFilename)
+            rotated = sorted([x for x in os.listdir(folder) if x.startswith('%s.' % base) and re.match(r'^\.\d{8}-\d{6}', x[len(base):])])
+            for x in rotated[:max(len(rotated) - self.backup_count, 0)]:
+                os.remove(os.path.join(folder, x))
+        except Exception as err:
+            logging.getLogger(__name__).error('Log rotation failed: %s' % err)
+
+class QLogListener:
+    """Passes records from the queues to handlers by one thread
+
+    handler() is for loggers of the main process threads, process_handler() - for manager processes.
+    Records are taken by batches up to 'batch' ones, the handlers are flushed once per batch
+    """
+    def __init__(self, handlers=(), batch=200):
+        self.handlers = list(handlers)
+        self.batch = batch
+        self.queue = Queue()
+        self.process_queue = multiprocessing.Queue()
+        self.thread = threading.Thread(target=self.run, name='LogListener', daemon=True)
+        self.forwarder = threading.Thread(target=self.forward, name='LogForwarder', daemon=True)
+
+    def start(self):
+        self.thread.start()
+        self.forwarder.start()
+
+    def handler(self):
+        return logging.handlers.QueueHandler(self.queue)
+
+    def process_handler(self):
+        return logging.handlers.QueueHandler(self.process_queue)
+
+    def remove_handler(self, handler):
+        self.handlers = [x for x in self.handlers if x is not handler]
+
+    def forward(self):
+        """Moves records of manager processes to the main queue"""
+        while True:
+            record = self.process_queue.get()
+            self.queue.put(record)
+            if record is None:
+                break
+
+    def run(self):
+        stopping = False
+        while not stopping:
+            records = [self.queue.get()]
+            while len(records) < self.batch:
+                try:
+                    records.append(self.queue.get_nowait())
+                except Empty:
+                    break
+            handlers = self.handlers
+            for record in records:
+                if record is None:
+                    stopping = True
+                    continue
+                for h in handlers:
+                    if record.levelno >= h.level:
+                        h.handle(record)
+            for h in handlers:
+                h.flush()
+
+    def stop(self, timeout=5):
+        """Writes the records queued and stops. The records coming after it are not written"""
+        if not self.thread.is_alive():
+            return
+        self.process_queue.put(None) #goes after the manager records already sent
+        self.thread.join(timeout)
+        for h in self.handlers:
+            h.close()
+
+def first_record_time(fileName):
+    """Returns time of the first record of log file or None"""
+    try:
+        with open(fileName, 'rb') as f:
+            m = RECORD_START.match(f.readline(200).decode('utf-8', 'replace'))
+    except OSError:
+        return None
+    return record_time(m) if m else None
+
+def record_time(m):
+    """Returns time from RECORD_START match"""
+    return datetime.datetime.strptime(m.group(1), '%Y-%m-%d %H:%M:%S').timestamp() + int(m.group(2)) / 1000
+
+def parse_since(text):
+    """Returns time (seconds since epoch) from '30m', '2h', '1d', 'HH:MM' (today) or 'YYYY-MM-DD[ HH:MM]'"""
+    text = text.strip()
+    units = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+    if text[-1:] in units and text[:-1].isdigit():
+        return time() - int(text[:-1]) * units[text[-1]]
+    for fmt in ('%H:%M', '%Y-%m-%d %H:%M', '%Y-%m-%d'):
+        try:
+            t = datetime.datetime.strptime(text, fmt)
+        except ValueError:
+            continue
+        if fmt == '%H:%M':
+            t = datetime.datetime.combine(datetime.date.today(), t.time())
+        return t.timestamp()
+    raise ValueError("Wrong time '%s'. Use 30m, 2h, 1d, HH:MM or YYYY-MM-DD HH:MM" % text)
+
+def make_filter(level=None, module=None, text=None, regex=None, since=None):
+    """Returns function(record) -> bool for record (time, level, logger name, text). None if there are no conditions
+
+    level - minimum level name (WARNING etc), module - part of logger name, text - substring (case insensitive),
+    regex - regular expression searched in the text, since - time (seconds since epoch)
+    """
+    if not any((level, module, text, regex, since)):
+        return None
+    levelno = logging.getLevelName(level.upper()) if level else 0
+    if not isinstance(levelno, int):
+        raise ValueError("Unknown level '%s'" % level)
+    module = module.lower() if module else None
+    text = text.lower() if text else None
+    pattern = re.compile(regex) if regex else None
+    def match(record):
+        return record[1] >= levelno and (not since or record[0] >= since) and (not module or module in record[2].lower()) \
+            and (not text or text in record[3].lower()) and (not pattern or pattern.search(record[3]) is not None)
+    return match
+
+def reverse_lines(fileName, block_size=BLOCK_SIZE):
+    """Yields lines of file from the last one to the first one reading it by blocks from the end"""
+    with open(fileName, 'rb') as f:
+        pos = f.seek(0, os.SEEK_END)
+        rest = b''
+        while pos > 0:
+            size = min(block_size, pos)
+            pos -= size
+            f.seek(pos)
+            lines = (f.read(size) + rest).split(b'\n')
+            rest = lines.pop(0) #may be a part of line, it's completed by the previous block
+            for line in reversed(lines):
+                yield line.decode('utf-8', 'replace')
+        yield rest.decode('utf-8', 'replace')
+
+def reverse_records(fileName):
+    """Yields log file records (time, level, logger name, text) from the last one. Lines before the first record start are skipped"""
+    lines = []
+    for line in reverse_lines(fileName):
+        if not line and not lines:
+            continue #trailing new line
+        lines.append(line)
+        m = RECORD_START.match(line)
+        if m:
+            yield (record_time(m), logging.getLevelName(m.group(4)), m.group(3), '\n'.join(reversed(lines)))
+            lines = []
+
+def file_tail(fileName, n, match=None, since=None):
+    """Returns the last n records of log file passing match(record), the oldest first. Reading stops at since time"""
+    res = []
+    for record in reverse_records(fileName):
+        if since and record[0] < since:
+            break
+        if match is None or match(record):
+            res.append(record)
+            if len(res) >= n:
+                break
+    return res[::-1]
+
+def parse_query(text, default=20):
+    """Parses 'Log tail' parameters: [N] [level=LEVEL] [module=NAME] [since=TIME] [text=TEXT | re=REGEX]
+
+    text and re take the rest of the line. Returns (n, filters for make_filter())
+    """
+    n, filters = default, {}
+    text = text.strip() if text else ''
+    while text:
+        word, _, rest = text.partition(' ')
+        key, eq, value = word.partition('=')
+        key = key.lower()
+        if not eq and word.isdigit():
+            n = int(word)
+        elif eq and key in ('text', 're'):
+            filters['text' if key == 'text' else 'regex'] = text[len(key) + 1:]
+            break
+        elif eq and key in ('level', 'module'):
+            filters[key] = value
+        elif eq and key == 'since':
+            #Date and time are separated by space
+            if re.match(r'^\d{4}-\d\d-\d\d$', value) and re.match(r'^\d\d?:\d\d(\s|$)', rest):
+                clock, _, rest = rest.partition(' ')
+                value = '%s %s' % (value, clock)
+            filters['since'] = parse_since(value)
+        else:
+            raise ValueError("Unknown parameter '%s'" % word)
+        text = rest.strip()
+    return n, filters
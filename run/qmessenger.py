@@ -6,26 +6,46 @@ import os
 import threading
 import queue
 import logging
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from time import sleep
+from collections.abc import Iterator
+from time import sleep, monotonic
+from qratelimit import QRateLimiter
+from qmetrics import metrics
+
+DOWNLOAD_BLOCK = 65536 #Bytes of downloaded file kept in memory
 
 class QMessenger(threading.Thread):
     """Defines basic behaviour of a messenger module"""
+    RATE_LIMIT = {} #Default rate limits of connector (see qratelimit.QRateLimiter). Provider limits are set in child classes
+    FLOOD_RETRIES = 3 #Attempts to send a message part after provider 'too many requests' errors
+    MAX_FILE_SIZE = 0 #Biggest file sendFile() may send, bytes. Bigger files are sent by parts (see qtransfer.py). 0 - no limit
     def __init__(self, **config):
         """Sets messenger basic values:
 
         logger - copy of qbot logger. Difference is just the name
         queue - Common command queue
         MAX_MESSAGE_LENGTH - Maximum single message length. If message exeed the value it will be divided into multiple ones
+        MAX_FILE_SIZE - Maximum file size for sendFile(). Config value overrides the class one
         timeout - time interval between run() cycles
         savedir = default download directory
         proxies = proxies
         shortStatusText - first part of status
         getStatusText - status part representing receive commands process state (OK, errors etc)
         sendStatusText - represents send message process state
+        outbox - outgoing messages queue. It's drained by sender thread (see post()). Command replies go there too
+        outbox_wait - seconds reply() waits for free place in full outbox before the message is dropped
+        sendLock - held while sending. Sender thread and sendFile() callers take turns on the transport
+        send_retries - number of send attempts before the message is dropped
+        send_retry_delay - delay before the second attempt, seconds. Doubles after every failed attempt
+        rateLimiter - outgoing messages limiter. Config 'rate_limit' overrides RATE_LIMIT values
+        download_workers - files of one message downloaded at once
+        download_timeout - seconds download may wait for data
         """
         threading.Thread.__init__(self)
         self.name = "%s_%s" % (config['name'], self.name)
+        self.connectorName = config['name'] #metrics label
         self.logger = logging.getLogger(self.name)
         for h in config['logger'].handlers:
             self.logger.addHandler(h)
@@ -34,6 +54,7 @@ class QMessenger(threading.Thread):
         self.queue = config['queue']
         self.isWorking=True
         self.MAX_MESSAGE_LENGTH = config['MAX_MESSAGE_LENGTH'] if 'MAX_MESSAGE_LENGTH' in config.keys() else 4096
+        self.MAX_FILE_SIZE = config['MAX_FILE_SIZE'] if 'MAX_FILE_SIZE' in config.keys() else self.MAX_FILE_SIZE
         self.timeout = config['timeout'] if 'timeout' in config.keys() else 1
         self.savedir = config['save_directory'] if 'save_directory' in config.keys() else 'download'
         self.proxies = config['proxies'] if 'proxies' in config.keys() else None
@@ -42,80 +63,245 @@ class QMessenger(threading.Thread):
         self.getStatusText = 'OK'
         self.sendStatusText = 'OK'
         self.statusText = '%s\n%s\n%s' % (self.shortStatusText, self.getStatusText, self.sendStatusText)
+        self.outbox = queue.Queue(config['outbox_size'] if 'outbox_size' in config.keys() else 1000)
+        self.outbox_wait = config['outbox_wait'] if 'outbox_wait' in config.keys() else 60
+        self.send_retries = config['send_retries'] if 'send_retries' in config.keys() else 3
+        self.send_retry_delay = config['send_retry_delay'] if 'send_retry_delay' in config.keys() else 5
+        self.sending = None #message being sent by sender thread
+        self.sendLock = threading.Lock()
+        self.outboxCounters = {'sent': 0, 'failed': 0, 'retried': 0, 'dropped': 0}
+        rate_limit = dict(self.RATE_LIMIT)
+        rate_limit.update(config['rate_limit'] if 'rate_limit' in config.keys() else {})
+        self.rateLimiter = QRateLimiter(**rate_limit)
+        self.sender = threading.Thread(target=self.sendLoop, name='%s_sender' % self.name, daemon=True)
+        self.download_workers = config['download_workers'] if 'download_workers' in config.keys() else 3
+        self.download_timeout = config['download_timeout'] if 'download_timeout' in config.keys() else 60
         #self.logger.info('Init completed')
 
     def run(self):
         """Main function"""
         self.logger.info('Running')
-        while self.isWorking:
-            sleep(self.timeout)
-            self.statusText = '%s\ngetMessages %s\nsendMessage %s' % (self.shortStatusText, self.getStatusText, self.sendStatusText)
-            #Processing incoming messages
-            try: #Processing status of connector
-                res = self.getMessages()
-                if not res['ok']:
+        self.sender.start()
+        try:
+            while self.isWorking:
+                sleep(self.timeout)
+                outbox = self.outboxStatus()
+                metrics.set('qbot_outbox_depth', outbox['depth'], connector=self.connectorName)
+                metrics.set('qbot_outbox_age_seconds', outbox['age'], connector=self.connectorName)
+                self.statusText = '%s\ngetMessages %s\nsendMessage %s\noutbox %d (%.0f s)' % (self.shortStatusText, self.getStatusText, self.sendStatusText, outbox['depth'], outbox['age'])
+                #Processing incoming messages
+                t0 = monotonic()
+                try: #Processing status of connector
+                    res = self.getMessages()
+                    metrics.observe('qbot_poll_seconds', monotonic() - t0, connector=self.connectorName)
+                    if not res['ok']:
+                        metrics.inc('qbot_poll_errors_total', connector=self.connectorName)
+                        if self.isConnected:
+                            msg = 'error: %s' % (res['status'])
+                            self.logger.error(msg)
+                            self.isConnected = False
+                            self.getStatusText = msg
+                        continue
+    ##                self.logger.debug(res)
+                    messages = res['messages']
+                    if not self.isConnected:                
+                        #self.logger.debug('Result: {}'.format(res))
+                        self.getStatusText = 'OK: %s' % res['status']
+                        self.isConnected = True
+                    total_updates = len(messages)
+                except Exception as err:
+                    metrics.inc('qbot_poll_errors_total', connector=self.connectorName)
+                    msg = "failed: %s" % err
+                    self.logger.debug(msg)
                     if self.isConnected:
-                        msg = 'error: %s' % (res['status'])
                         self.logger.error(msg)
-                        self.isConnected = False
                         self.getStatusText = msg
+                        self.isConnected = False
+                    total_updates = 0
+                if total_updates == 0:
                     continue
-##                self.logger.debug(res)
-                messages = res['messages']
-                if not self.isConnected:                
-                    #self.logger.debug('Result: {}'.format(res))
-                    self.getStatusText = 'OK: %s' % res['status']
-                    self.isConnected = True
-                total_updates = len(messages)
-            except Exception as err:
-                msg = "failed: %s" % err
-                self.logger.debug(msg)
-                if self.isConnected:
-                    self.logger.error(msg)
-                    self.getStatusText = msg
-                    self.isConnected = False
-                total_updates = 0
-            if total_updates == 0:
+                for message in messages:
+                    if message == None:
+                        continue
+                    self.logger.debug("New message from '%s': text='%s', id=%s, replyto=%s" %(message['user_id'], message['text'], message['message_id'], message['replyto']))
+                    if len(message['files']) > 0:
+                        command = 'File'
+                        if not message['text']:
+                            command += ' %s' % message['text']
+                        if not message['caption']:
+                            command += ' %s' % message['caption']
+                    else:
+                        try:
+                            command = message['text']
+                        except Exception as err:
+                            command = "Unknown: %s" % err
+                            self.logger.error("Message has no text: %s" %err)
+                    command = command.strip()
+                    #self.logger.debug("New command:text='%s', from=%s, date=%s, files: %d" % (command, message['message']['from']['username'], str(datetime.fromtimestamp(message['message']['date'])), len(files)))
+                    queueCommand = {'self' : self, 'command' : command, 'user_id' : message['user_id'], 'message_id' : message['message_id'],\
+                                    'message_time' : message['message_time'], 'replyto': message['replyto'], 'files': message['files'], 'message' : message['message'],
+                                    'queued': monotonic()}
+                    metrics.inc('qbot_messages_total', connector=self.connectorName)
+                    if command.upper() == 'TEST': #for 'ping connector' purposes. So we can check state of connector even without working service
+                        self.reply(msg=self.statusText, originalCommand=queueCommand)
+                    self.queue.put(queueCommand)
+        finally:
+            #The sender thread stops with the connector, even if run() failed
+            self.isWorking = False
+            self.sender.join(self.timeout * 10)
+            self.logger.debug('Exit')
+
+    def post(self, msg, to, since=None, kind='message', originalCommand=None, wait=0):
+        """Queues msg to 'to' for sender thread. Returns False if outbox is full
+
+        since - time (monotonic) the message was originated. Delivery lag is counted from it
+        kind - metrics label: message, alert etc
+        originalCommand - msg is a reply to this command, it's sent by sendReply()
+        wait - seconds to wait for free place in full outbox. 0 - return at once
+        """
+        now = monotonic()
+        try:
+            self.outbox.put({'msg': msg, 'to': to, 'time': now, 'since': since if since else now, 'kind': kind, 'attempts': 0,
+                             'reply': originalCommand}, wait > 0, wait if wait > 0 else None)
+        except queue.Full:
+            self.outboxCounters['dropped'] += 1
+            self.logger.error('Outbox is full. Message to %s dropped' % to)
+            return False
+        return True
+
+    def sendLoop(self):
+        """Sender thread. Sends the queued messages one by one, so slow or failed sending doesn't block other connectors"""
+        while self.isWorking:
+            try:
+                item = self.outbox.get(timeout=self.timeout)
+            except queue.Empty:
                 continue
-            for message in messages:
-                if message == None:
-                    continue
-                self.logger.debug("New message from '%s': text='%s', id=%s, replyto=%s" %(message['user_id'], message['text'], message['message_id'], message['replyto']))
-                if len(message['files']) > 0:
-                    command = 'File'
-                    if not message['text']:
-                        command += ' %s' % message['text']
-                    if not message['caption']:
-                        command += ' %s' % message['caption']
+            self.sending = item
+            while not self.deliver(item) and item['attempts'] < self.send_retries and self.isWorking:
+                self.outboxCounters['retried'] += 1
+                sleep(self.send_retry_delay * 2 ** (item['attempts'] - 1))
+            self.sending = None
+        #Stopping. One attempt for the messages left (stop notifications etc)
+        while True:
+            try:
+                item = self.outbox.get_nowait()
+            except queue.Empty:
+                break
+            item['attempts'] = self.send_retries - 1
+            self.deliver(item)
+        self.logger.debug('Sender exit')
+
+    def deliver(self, item):
+        """Makes one attempt to send outbox item. Failure is exception or False returned by sendMessage() or sendReply()
+
+        Waits for rate limits first, so every connector keeps its 'rate_limit'
+        """
+        item['attempts'] += 1
+        try:
+            self.throttle(item['to'])
+            with self.sendLock:
+                if item['reply'] is not None:
+                    ok = self.sendReply(item['msg'], item['reply']) is not False
                 else:
-                    try:
-                        command = message['text']
-                    except Exception as err:
-                        command = "Unknown: %s" % err
-                        self.logger.error("Message has no text: %s" %err)
-                command = command.strip()
-                #self.logger.debug("New command:text='%s', from=%s, date=%s, files: %d" % (command, message['message']['from']['username'], str(datetime.fromtimestamp(message['message']['date'])), len(files)))
-                queueCommand = {'self' : self, 'command' : command, 'user_id' : message['user_id'], 'message_id' : message['message_id'],\
-                                'message_time' : message['message_time'], 'replyto': message['replyto'], 'files': message['files'], 'message' : message['message']}
-                if command.upper() == 'TEST': #for 'ping connector' purposes. So we can check state of connector even without working service
-                    self.reply(msg=self.statusText, originalCommand=queueCommand)
-                self.queue.put(queueCommand)
-        #On exit write to log
-        self.logger.debug('Exit')
-
-    def getFiles(self, files, path=None):
-        """Downloads requested files"""
+                    ok = self.sendMessage(item['msg'], item['to']) is not False
+        except Exception as err:
+            self.logger.error('Send message to %s failed: %s' % (item['to'], err))
+            ok = False
+        if ok:
+            self.outboxCounters['sent'] += 1
+            metrics.observe('qbot_delivery_seconds', monotonic() - item['since'], connector=self.connectorName, kind=item['kind'])
+        elif item['attempts'] >= self.send_retries:
+            self.outboxCounters['failed'] += 1
+            metrics.inc('qbot_delivery_failures_total', connector=self.connectorName, kind=item['kind'])
+            self.logger.error('Message to %s dropped after %d attempts' % (item['to'], item['attempts']))
+        return ok
+
+    def outboxStatus(self):
+        """Returns outbox metrics: depth (messages waiting and being sent), age of the oldest one in seconds and counters"""
+        with self.outbox.mutex:
+            items = list(self.outbox.queue)
+        sending = self.sending
+        if sending:
+            items.insert(0, sending)
+        res = {'depth': len(items), 'age': monotonic() - items[0]['time'] if items else 0}
+        res.update(self.outboxCounters)
+        return res
+
+    def throttle(self, to=None):
+        """Waits until rate limits allow to send one more message (part) to 'to'
+
+        deliver() and transmitFile() call it before sending. Connectors call it before every other provider request
+        (the next parts of a long message, retries after floodWait())
+        """
+        waited = self.rateLimiter.wait(to)
+        if waited > 1:
+            self.logger.debug('Rate limit: waited %.1f seconds to send to %s' % (waited, to))
+
+    def floodWait(self, seconds, to=None):
+        """Provider asked to retry after seconds. The next throttle() calls wait for it"""
+        self.logger.warning('Provider rate limit hit. Sending paused for %s seconds' % seconds)
+        self.rateLimiter.retry_after(seconds, to)
+
+    def getFiles(self, files, path=None, transfer=None):
+        """Downloads requested files, up to download_workers at once. Transfer parts are passed to transfer (see qtransfer.QTransfer.receive())"""
         res = ''
         if not path:
             path = self.savedir
-        for f in files:
-            self.logger.debug('File: %s' % f)
-            res += self.get_file(f, path) + '\n'
+        files = list(files)
+        if len(files) > 1 and self.download_workers > 1:
+            with ThreadPoolExecutor(min(self.download_workers, len(files))) as pool:
+                results = list(pool.map(lambda f: self.safe_get_file(f, path), files))
+        else:
+            results = [self.safe_get_file(f, path) for f in files]
+        for f, text in zip(files, results):
+            res += text + '\n'
+            fileName = os.path.join(path, f['file_name'])
+            if transfer and transfer.is_part(fileName) and os.path.exists(fileName):
+                res += transfer.receive(fileName) + '\n'
         return res
 
     #---------------------------------------------------------------------------------------------------------------------------------------------------------------------------
     #The fuctions below need to be overwritten in child classes
 
+    def safe_get_file(self, file, path):
+        """get_file() returning error text instead of exception, so one failed file doesn't stop the others"""
+        self.logger.debug('File: %s' % file)
+        try:
+            return self.get_file(file, path)
+        except Exception as err:
+            res = '%s - error: %s' % (file['file_name'], err)
+            self.logger.error(res)
+            return res
+
+    def download(self, url, fileName, size=None, **kwargs):
+        """Streams url to fileName by DOWNLOAD_BLOCK bytes. Returns (bytes, sha256)
+
+        Data goes to fileName.part renamed when complete, so a broken download never leaves a partial fileName.
+        size - expected size. Mismatch raises IOError. kwargs are passed to requests.get() (proxies etc)
+        """
+        import requests
+        h, sz = hashlib.sha256(), 0
+        tmp = '%s.part' % fileName
+        try:
+            resp = requests.get(url, stream=True, timeout=self.download_timeout, **kwargs)
+            try:
+                resp.raise_for_status()
+                with open(tmp, 'wb') as f:
+                    for block in resp.iter_content(DOWNLOAD_BLOCK):
+                        h.update(block)
+                        f.write(block)
+                        sz += len(block)
+            finally:
+                resp.close()
+            if size is not None and sz != size:
+                raise IOError('%d bytes received, %d expected' % (sz, size))
+            os.replace(tmp, fileName)
+        except Exception:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        return sz, h.hexdigest()
+
     def getMessages(self):
         """Reads user messages (commands). Messenger-specific function. Should be overrided in derived classes
         
@@ -135,21 +321,69 @@ class QMessenger(threading.Thread):
 
         
     def sendMessage(self, msg, to):
-        """Sends msg to to. Should be overrided"""
+        """Sends msg to to. Should be overrided. Blocks until sent, returns False if failed"""
         res = "Empty function sendMessage() needs to be overwritten in child classes"
-        logger.error(res)
+        self.logger.error(res)
         self.sendStatusText = res
-        return res
+        return False
     
     def reply(self, msg, originalCommand):
-        """Sends msg to originalCommand['replyto']"""
+        """Queues msg as reply to originalCommand (see post()). Returns False if outbox stays full for outbox_wait seconds
+
+        Long responses (replyAll()) are not dropped: their parts wait while sender thread drains the outbox.
+
+        Only sender thread calls sendMessage() and sendReply(), so transports aren't used by several threads.
+        Replies to the same user keep their order
+        """
+        return self.post(msg, originalCommand['replyto'], originalCommand.get('queued'), 'reply', originalCommand, self.outbox_wait)
+
+    def sendReply(self, msg, originalCommand):
+        """Sends msg to originalCommand['replyto']. Called by sender thread. Connectors override it to reply by the original message"""
         return self.sendMessage(msg, originalCommand['replyto'])
+
+    def replyAll(self, response, originalCommand):
+        """Sends command response by reply(). Response may be an iterator of text chunks (like generator)
+
+        Chunks are packed to messages up to MAX_MESSAGE_LENGTH and every message is queued as soon as it's packed,
+        so the first part goes to user while the rest is produced
+        """
+        if not isinstance(response, Iterator):
+            return self.reply(str(response), originalCommand)
+        res = None
+        for msg in self.pack(response):
+            res = self.reply(msg, originalCommand)
+        return res
+
+    def pack(self, chunks):
+        """Yields messages up to MAX_MESSAGE_LENGTH joined from text chunks. Line breaks at the message edges are dropped"""
+        buf, size = [], 0
+        for chunk in chunks:
+            chunk = str(chunk)
+            while size + len(chunk) > self.MAX_MESSAGE_LENGTH:
+                if buf: #send what is packed and try the chunk again
+                    msg = ''.join(buf).strip('\n')
+                    buf, size = [], 0
+                else: #chunk is too long itself
+                    msg, chunk = chunk[:self.MAX_MESSAGE_LENGTH].strip('\n'), chunk[self.MAX_MESSAGE_LENGTH:]
+                if msg:
+                    yield msg
+            buf.append(chunk)
+            size += len(chunk)
+        msg = ''.join(buf).strip('\n')
+        if msg:
+            yield msg
     
+    def transmitFile(self, to, fileName):
+        """Calls sendFile() holding sendLock, so it doesn't run together with sender thread. Use it from command threads"""
+        self.throttle(to)
+        with self.sendLock:
+            return self.sendFile(to, fileName)
+
     def sendFile(self, to, fileName):
-        """Sends file 'fileName' to 'to'. Should be overrided"""
+        """Sends file 'fileName' to 'to'. Should be overrided. Blocks until sent, returns False if failed"""
         res = "Empty function sendFile() needs to be overwritten in child classes"
-        logger.error(res)
-        return res
+        self.logger.error(res)
+        return False
 
     def get_file(self, file, path=None):
         """Gets 'file' from messenger. Should be overrided"""
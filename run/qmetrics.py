@@ -0,0 +1,138 @@
+#!/usr/bin/python3
+"""Runtime metrics for qbot
+
+Counters, gauges and latency histograms with labels. Main module and connectors share the module registry
+'metrics', every manager module keeps its own one and the main module merges their snapshots.
+Output is Prometheus text format (prometheus()) or short text for users (summary())
+"""
+
+import os
+import threading
+
+#Histogram upper bounds in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, float('inf'))
+
+class QMetrics:
+    """Thread safe metrics registry. Series key is (name, ((label, value), ...))"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.counters = {}
+            self.gauges = {}
+            self.histograms = {} #key -> {'buckets': [count per bucket], 'sum': seconds, 'count': n}
+
+    @staticmethod
+    def key(name, labels):
+        return (name, tuple(sorted([(k, str(v)) for k, v in labels.items()])))
+
+    def inc(self, name, value=1, **labels):
+        """Adds value to counter"""
+        key = self.key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        """Sets gauge value"""
+        with self.lock:
+            self.gauges[self.key(name, labels)] = value
+
+    def observe(self, name, seconds, **labels):
+        """Adds value to histogram"""
+        key = self.key(name, labels)
+        with self.lock:
+            h = self.histograms.get(key)
+            if not h:
+                h = {'buckets': [0] * len(BUCKETS), 'sum': 0, 'count': 0}
+                self.histograms[key] = h
+            for i, bound in enumerate(BUCKETS):
+                if seconds <= bound:
+                    h['buckets'][i] += 1
+                    break
+            h['sum'] += seconds
+            h['count'] += 1
+
+    def snapshot(self):
+        """Returns copy of all series. It can be pickled (sent by pipe) and merged to other registry"""
+        with self.lock:
+            return {'counters': dict(self.counters), 'gauges': dict(self.gauges),
+                    'histograms': {k: {'buckets': list(v['buckets']), 'sum': v['sum'], 'count': v['count']} for k, v in self.histograms.items()}}
+
+    @staticmethod
+    def merge(snapshots, **labels):
+        """Merges snapshots into one. labels are added to every series (like module name)"""
+        res = {'counters': {}, 'gauges': {}, 'histograms': {}}
+        extra = dict([(k, str(v)) for k, v in labels.items()])
+        for snap in snapshots:
+            for kind in res.keys():
+                for (name, l), value in snap[kind].items():
+                    l = dict(l)
+                    l.update(extra)
+                    res[kind][(name, tuple(sorted(l.items())))] = value
+        return res
+
+    def prometheus(self, snapshots=()):
+        """Returns registry and snapshots as Prometheus text format"""
+        snap = self.merge([self.snapshot()] + list(snapshots))
+        lines = []
+        for kind, type_name in (('counters', 'counter'), ('gauges', 'gauge')):
+            names = sorted(set([k[0] for k in snap[kind]]))
+            for name in names:
+                lines.append('# TYPE %s %s' % (name, type_name))
+                for key in sorted([k for k in snap[kind] if k[0] == name]):
+                    lines.append('%s%s %s' % (name, format_labels(key[1]), snap[kind][key]))
+        for name in sorted(set([k[0] for k in snap['histograms']])):
+            lines.append('# TYPE %s histogram' % name)
+            for key in sorted([k for k in snap['histograms'] if k[0] == name]):
+                h = snap['histograms'][key]
+                total = 0
+                for bound, count in zip(BUCKETS, h['buckets']):
+                    total += count
+                    le = '+Inf' if bound == float('inf') else str(bound)
+                    lines.append('%s_bucket%s %d' % (name, format_labels(key[1] + (('le', le),)), total))
+                lines.append('%s_sum%s %f' % (name, format_labels(key[1]), h['sum']))
+                lines.append('%s_count%s %d' % (name, format_labels(key[1]), h['count']))
+        return '\n'.join(lines) + '\n'
+
+    def summary(self, snapshots=(), filter_text=None):
+        """Returns short text: counters and gauges values, histograms count, average and 95 percentile bound"""
+        snap = self.merge([self.snapshot()] + list(snapshots))
+        lines = []
+        for kind in ('counters', 'gauges', 'histograms'):
+            for key in sorted(snap[kind]):
+                text = '%s%s' % (key[0], format_labels(key[1]))
+                if filter_text and filter_text.lower() not in text.lower():
+                    continue
+                value = snap[kind][key]
+                if kind == 'histograms':
+                    avg = value['sum'] / value['count'] if value['count'] else 0
+                    value = 'n=%d avg=%.3fs p95<=%s' % (value['count'], avg, percentile_bound(value, 0.95))
+                lines.append('%s: %s' % (text, value))
+        return '\n'.join(lines) if lines else 'No metrics'
+
+    def write(self, fileName, snapshots=()):
+        """Writes Prometheus text file atomically (for node_exporter textfile collector etc)"""
+        tmpName = '%s.tmp' % fileName
+        with open(tmpName, 'w') as f:
+            f.write(self.prometheus(snapshots))
+        os.replace(tmpName, fileName)
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join(['%s="%s"' % (k, v.replace('\\', '\\\\').replace('"', '\\"')) for k, v in labels])
+
+def percentile_bound(h, q):
+    """Returns upper bound of the bucket keeping q part of histogram values"""
+    need = h['count'] * q
+    total = 0
+    for bound, count in zip(BUCKETS, h['buckets']):
+        total += count
+        if total >= need:
+            return '+Inf' if bound == float('inf') else '%ss' % bound
+    return '+Inf'
+
+#Registry of the process
+metrics = QMetrics()
@@ -0,0 +1,79 @@
+#!/usr/bin/python3
+"""Outgoing messages rate limiting for qbot connectors
+
+Token bucket: 'rate' tokens per second are added up to 'burst'. Every message takes a token, if there is none
+the sender waits for it (messages are delayed, never dropped). Connector has a bucket for all its messages
+and a bucket per recipient. Provider 'retry after' hints pause the buckets (see QRateLimiter.retry_after())
+"""
+
+import threading
+from time import monotonic, sleep
+
+class QTokenBucket:
+    """Thread safe token bucket. rate 0 means no limit"""
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.tokens = self.burst
+        self.updated = monotonic()
+        self.paused_until = 0
+        self.lock = threading.Lock()
+
+    def reserve(self):
+        """Takes a token and returns seconds to wait before using it"""
+        with self.lock:
+            now = monotonic()
+            wait = max(self.paused_until - now, 0)
+            if not self.rate:
+                return wait
+            self.tokens = min(self.tokens + (now - self.updated) * self.rate, self.burst)
+            self.updated = now
+            self.tokens -= 1 #may go negative: the next senders are queued behind this one
+            if self.tokens < 0:
+                wait = max(wait, -self.tokens / self.rate)
+            return wait
+
+    def pause(self, seconds):
+        """No tokens are given for seconds"""
+        with self.lock:
+            self.paused_until = max(self.paused_until, monotonic() + seconds)
+
+class QRateLimiter:
+    """Per-connector and per-recipient limits of a connector"""
+    def __init__(self, rate=0, burst=1, recipient_rate=0, recipient_burst=1):
+        """Sets limiter values:
+
+        rate, burst - messages per second and burst size for all the connector messages. 0 - no limit
+        recipient_rate, recipient_burst - the same for every recipient
+        """
+        self.bucket = QTokenBucket(rate, burst)
+        self.recipient_rate = recipient_rate
+        self.recipient_burst = recipient_burst
+        self.recipients = {} #recipient -> QTokenBucket
+        self.lock = threading.Lock()
+        self.waited = 0 #total seconds senders waited
+
+    def recipient(self, to):
+        with self.lock:
+            bucket = self.recipients.get(to)
+            if not bucket:
+                bucket = QTokenBucket(self.recipient_rate, self.recipient_burst)
+                self.recipients[to] = bucket
+            return bucket
+
+    def wait(self, to=None):
+        """Blocks until a message to 'to' may be sent. Returns seconds waited"""
+        delay = self.bucket.reserve()
+        if to is not None:
+            delay = max(delay, self.recipient(to).reserve())
+        if delay > 0:
+            self.waited += delay
+            sleep(delay)
+        return delay
+
+    def retry_after(self, seconds, to=None):
+        """Provider asked to wait. Pauses recipient bucket if to is given, otherwise the whole connector"""
+        if to is None:
+            self.bucket.pause(seconds)
+        else:
+            self.recipient(to).pause(seconds)
@@ -0,0 +1,118 @@
+#!/usr/bin/python3
+"""Request/response calls to manager modules over their command pipes
+
+Request: {'id': request_id, 'method': method_name, 'args': {...}}
+Response: {'id': request_id, 'result': value} or {'id': request_id, 'error': error_text}
+Manager module runs method 'rpc_<method_name>(**args)' (see QBaseManager.process_command_pipe())
+"""
+
+import threading
+import logging
+import itertools
+from time import monotonic
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from qmetrics import metrics
+
+class QRPCError(Exception):
+    """Error returned by manager module"""
+    pass
+
+class QManagerRPC:
+    """Main module side of manager command pipe
+
+    Several requests may be in flight. Every request gets a Future. Main loop calls dispatch() when the pipe
+    is readable, and the responses complete their futures by request id. Responses for the requests nobody
+    waits for (timed out) are discarded
+    """
+    def __init__(self, pipe, semaphore=None, name='', timeout=30, logger=None):
+        """pipe - main module end of command pipe
+        semaphore - command pipe semaphore. It's set after every request for the managers checking it
+        timeout - default call timeout in seconds
+        """
+        self.pipe = pipe
+        self.semaphore = semaphore
+        self.name = name
+        self.timeout = timeout
+        self.logger = logger if logger else logging.getLogger(__name__)
+        self.send_lock = threading.Lock() #requests are sent from worker threads
+        self.lock = threading.Lock()
+        self.ids = itertools.count(1)
+        self.pending = {} #request_id -> Future
+        self.closed = False #pipe is broken. Main loop shouldn't wait for it
+
+    def request(self, method, **args):
+        """Sends request and returns its Future"""
+        if self.closed:
+            raise QRPCError('%s: command pipe is closed' % self.name)
+        future = Future()
+        with self.lock:
+            request_id = next(self.ids)
+            self.pending[request_id] = future
+        future.request_id = request_id
+        try:
+            with self.send_lock:
+                self.pipe.send({'id': request_id, 'method': method, 'args': args})
+            if self.semaphore:
+                self.semaphore.set()
+        except Exception:
+            self.discard(request_id)
+            raise
+        return future
+
+    def call(self, method, timeout=None, **args):
+        """Sends request and waits for its result
+
+        Raises TimeoutError if no response in timeout (default self.timeout) seconds, QRPCError if manager failed
+        """
+        timeout = self.timeout if timeout is None else timeout
+        t0 = monotonic()
+        future = self.request(method, **args)
+        try:
+            result = future.result(timeout if timeout else None)
+        except FutureTimeoutError:
+            self.discard(future.request_id)
+            metrics.inc('qbot_rpc_errors_total', module=self.name, method=method, error='timeout')
+            raise TimeoutError('%s: no response for %s in %s seconds' % (self.name, method, timeout))
+        except Exception:
+            metrics.inc('qbot_rpc_errors_total', module=self.name, method=method, error='error')
+            raise
+        finally:
+            metrics.observe('qbot_rpc_seconds', monotonic() - t0, module=self.name, method=method)
+        return result
+
+    def discard(self, request_id):
+        """Forgets the request. Its response will be discarded"""
+        with self.lock:
+            self.pending.pop(request_id, None)
+
+    def dispatch(self):
+        """Reads all the responses from pipe and completes their futures. Returns number of responses read"""
+        count = 0
+        while self.pipe.poll():
+            try:
+                response = self.pipe.recv()
+            except Exception as err:
+                self.logger.error('%s: command pipe recv() failed: %s' % (self.name, err))
+                self.closed = True
+                self.fail_all(err)
+                break
+            count += 1
+            if not isinstance(response, dict) or 'id' not in response:
+                self.logger.warning('%s: response without request id discarded: %s' % (self.name, response))
+                continue
+            with self.lock:
+                future = self.pending.pop(response['id'], None)
+            if not future:
+                self.logger.warning('%s: late response for request %s discarded' % (self.name, response['id']))
+            elif 'error' in response:
+                future.set_exception(QRPCError(response['error']))
+            else:
+                future.set_result(response['result'])
+        return count
+
+    def fail_all(self, error):
+        """Completes all the requests in flight with error. For example, if manager process is dead"""
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        for future in pending.values():
+            future.set_exception(QRPCError(str(error)))
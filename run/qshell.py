@@ -0,0 +1,96 @@
+#!/usr/bin/python3
+"""Shell commands for qbot (Shell command)
+
+Command runs in its own process group with stdin closed. Output (stdout and stderr) is read without blocking
+until the process exits or the wall clock timeout. On timeout the whole group is killed (SIGTERM, then SIGKILL),
+so the children started by the command don't stay. Output above max_output bytes is read and dropped.
+New output may be passed to on_output() every stream_interval seconds while the command is running
+"""
+
+import os
+import signal
+import codecs
+import logging
+import selectors
+import subprocess
+from time import monotonic
+
+READ_SIZE = 4096
+KILL_WAIT = 2 #Seconds between SIGTERM and SIGKILL
+
+def kill_group(proc):
+    """Terminates process group of proc. Kills it if it doesn't exit in KILL_WAIT seconds"""
+    for sig in (signal.SIGTERM, signal.SIGKILL):
+        try:
+            os.killpg(proc.pid, sig)
+        except OSError: #already gone
+            return
+        try:
+            proc.wait(KILL_WAIT)
+            return
+        except subprocess.TimeoutExpired:
+            pass
+
+def run_shell(cmd, timeout=10, max_output=65536, on_output=None, stream_interval=0, logger=None):
+    """Runs shell command. Returns (output, status): status is None if the command exited with 0, otherwise text about it
+
+    timeout - seconds the command may run
+    max_output - bytes of output kept. The rest is dropped
+    on_output(text) - gets new output every stream_interval seconds while the command runs. The rest is returned as output
+    """
+    logger = logger if logger else logging.getLogger(__name__)
+    proc = subprocess.Popen(cmd, shell=True, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                            start_new_session=True)
+    decoder = codecs.getincrementaldecoder('utf-8')('replace')
+    chunks, kept, dropped = [], 0, 0
+    deadline = monotonic() + timeout
+    next_stream = monotonic() + stream_interval
+    timed_out = False
+    with selectors.DefaultSelector() as sel:
+        sel.register(proc.stdout, selectors.EVENT_READ)
+        while True:
+            now = monotonic()
+            if now >= deadline:
+                timed_out = True
+                break
+            wait = deadline - now
+            if on_output and stream_interval:
+                wait = min(wait, max(next_stream - now, 0))
+            if sel.select(wait):
+                data = os.read(proc.stdout.fileno(), READ_SIZE)
+                if not data: #EOF: the command and its children closed output
+                    break
+                if kept < max_output:
+                    data, rest = data[:max_output - kept], data[max_output - kept:]
+                    chunks.append(decoder.decode(data))
+                    kept += len(data)
+                    dropped += len(rest)
+                else:
+                    dropped += len(data)
+            if on_output and stream_interval and monotonic() >= next_stream:
+                next_stream = monotonic() + stream_interval
+                text = ''.join(chunks)
+                if text:
+                    try:
+                        on_output(text)
+                    except Exception as err:
+                        logger.error('Shell output streaming failed: %s' % err)
+                    chunks = []
+    chunks.append(decoder.decode(b'', True))
+    if timed_out:
+        kill_group(proc)
+    else:
+        try:
+            proc.wait(max(deadline - monotonic(), 0))
+        except subprocess.TimeoutExpired: #output closed, but the process is still running
+            timed_out = True
+            kill_group(proc)
+    proc.stdout.close()
+    status = []
+    if dropped:
+        status.append('output truncated: %d bytes dropped' % dropped)
+    if timed_out:
+        status.append('killed after %s seconds' % timeout)
+    elif proc.returncode:
+        status.append('exit code %d' % proc.returncode)
+    return ''.join(chunks), ', '.join(status) if status else None
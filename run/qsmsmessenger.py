@@ -23,6 +23,7 @@ MAX_SEQUENCED_MESSAGE_LENGTH = 67
 
 
 class QSMSMessenger(QMessenger):
+    RATE_LIMIT = {'rate': 0.2, 'burst': 2} #Modem sends a message part in a few seconds. Queue the parts instead of keeping modem busy
     def __init__(self, **config):
         QMessenger.__init__(self, VERSION=VERSION, **config)
         self.devSerial = config['device_serial']
@@ -185,7 +186,7 @@ class QSMSMessenger(QMessenger):
         for m in res['messages']:
             self.deleteMessage(m['message_id'])
         
-    def reply(self, msg, originalCommand):
+    def sendReply(self, msg, originalCommand):
         return self.sendMessage(msg, originalCommand['message']['msisdn'])
         
     def sendMessage(self, msg, to):
@@ -209,14 +210,18 @@ class QSMSMessenger(QMessenger):
         else:
             gsm.append(encodeSMS(to, msg))
         self.logger.debug("%d messages ready" % len(gsm))
-        for g in gsm:
+        for n, g in enumerate(gsm):
             gsm_msg = g['message']
             gsm_len = g['message_length']
             atCmd = "at+cmgs=%d\x0D%s\x1a" % (gsm_len, gsm_msg)
             self.logger.debug("Send GSM:'%s'(length=%d)" % (g['message'], g['message_length']))
+            if n: #the first part is throttled by deliver()
+                self.throttle(to)
             res = self.sendAT(atCmd)
             self.sendStatusText = "send: %s" % res
             self.logger.debug(res)
+            if not isinstance(res, list): #sendAT() returns error text if failed
+                return False
 #        self.logger.debug("Message sent: '%s'. Response: '%s'" % (msg, response))
 
     def stop(self):
@@ -0,0 +1,172 @@
+#!/usr/bin/python3
+"""Connectors supervisor for qbot
+
+Watches connectors threads and restarts the dead ones. Restart attempts follow exponential backoff with jitter
+and are limited by restart budget per time window. Connector constructors may block on network, so they run
+in background threads and the main loop just picks up their results (see check()).
+At startup all the connectors are constructed at once (see start() and wait())
+"""
+
+import random
+import threading
+import logging
+from time import monotonic
+
+class QConnectorSupervisor:
+    """Keeps state of every connector: UP, DOWN, STARTING or STOPPED (dead and not restarted)"""
+    def __init__(self, connectors, start, notify, logger=None, backoff=5, backoff_max=600, jitter=0.2, budget=5, window=3600):
+        """Sets supervisor values:
+
+        connectors - list of connectors dicts (see qbot.init_connector()). Restarted connector dict is updated in place,
+            the connector started for the first time is appended to the list
+        start(conf) - creates and starts connector. Returns connector dict or None
+        notify(msg) - sends the state change message to user
+        backoff - delay before the first restart attempt, seconds. Every next failed attempt doubles it up to backoff_max
+        jitter - random part of delay (0.2 means +-20%)
+        budget - maximum restart attempts during window seconds
+        """
+        self.connectors = connectors
+        self.start_func = start
+        self.notify = notify
+        self.logger = logger if logger else logging.getLogger(__name__)
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+        self.jitter = jitter
+        self.budget = budget
+        self.window = window
+        self.states = {} #connector name -> state dict
+
+    def add(self, conf, connector=None):
+        """Starts to watch connector with configuration conf. connector is None if it failed to start"""
+        autorestart = conf['autorestart'] if 'autorestart' in conf.keys() else True
+        state = {'name': conf['name'], 'conf': conf, 'connector': connector, 'autorestart': autorestart,
+                 'state': 'UP' if connector else 'DOWN', 'failures': 0, 'attempts': [], 'next_attempt': monotonic(),
+                 'thread': None, 'result': None, 'exhausted': False, 'started': None, 'deadline': None, 'late': False}
+        if not connector:
+            state['next_attempt'] = monotonic() + self.delay(0)
+        self.states[conf['name']] = state
+        return state
+
+    def start(self, conf, deadline=None):
+        """Starts to watch connector and starts it in background. wait() waits for it 'deadline' seconds"""
+        state = self.add(conf)
+        state['started'] = monotonic()
+        state['deadline'] = state['started'] + deadline if deadline else None
+        self.restart(state)
+        return state
+
+    def wait(self):
+        """Waits for the connectors being started until their deadlines
+
+        Returns dict connector name -> (start time, finish time) for the started ones. The late ones are taken by check() later
+        """
+        res = {}
+        for state in list(self.states.values()):
+            if state['state'] != 'STARTING' or not state['started']:
+                continue
+            timeout = max(state['deadline'] - monotonic(), 0) if state['deadline'] else None
+            state['thread'].join(timeout)
+            if state['thread'].is_alive():
+                state['late'] = True
+                self.logger.warning('Connector %s missed startup deadline. It will be taken when started' % state['name'])
+                continue
+            res[state['name']] = (state['started'], monotonic())
+            self.adopt(state)
+        return res
+
+    def delay(self, failures):
+        """Seconds before the next restart attempt after 'failures' failed ones"""
+        d = min(self.backoff * (2 ** failures), self.backoff_max)
+        return d * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def check(self):
+        """Checks connectors states. Should be called periodically from the main loop"""
+        now = monotonic()
+        for state in self.states.values():
+            if state['state'] == 'STARTING':
+                if not state['thread'].is_alive():
+                    self.adopt(state)
+                continue
+            c = state['connector']
+            if state['state'] == 'UP':
+                if c['connector'].is_alive():
+                    continue
+                c['is_alive'] = False
+                state['state'] = 'DOWN'
+                state['next_attempt'] = now + self.delay(0)
+                self.report('Connector %s is DOWN!' % state['name'], logging.ERROR)
+            if not state['autorestart']:
+                state['state'] = 'STOPPED'
+                continue
+            if state['state'] != 'DOWN' or now < state['next_attempt']:
+                continue
+            #Restart budget
+            state['attempts'] = [x for x in state['attempts'] if now - x < self.window]
+            if len(state['attempts']) >= self.budget:
+                state['next_attempt'] = state['attempts'][0] + self.window
+                if not state['exhausted']:
+                    state['exhausted'] = True
+                    self.report('Connector %s: %d restarts in %d seconds failed. Next attempt in %d seconds' %
+                                (state['name'], len(state['attempts']), self.window, state['next_attempt'] - now), logging.ERROR)
+                continue
+            state['attempts'].append(now)
+            self.restart(state)
+
+    def restart(self, state):
+        """Runs connector start in background thread"""
+        self.logger.info('Starting connector %s. Attempt %d' % (state['name'], state['failures'] + 1))
+        state['state'] = 'STARTING'
+        state['result'] = None
+        def target():
+            try:
+                state['result'] = self.start_func(state['conf'])
+            except Exception as err:
+                self.logger.error('Start connector %s failed: %s' % (state['name'], err))
+        state['thread'] = threading.Thread(target=target, name='start_%s' % state['name'], daemon=True)
+        state['thread'].start()
+
+    def adopt(self, state):
+        """Takes the result of background start"""
+        new = state['result']
+        state['thread'] = None
+        if new and new['connector'].is_alive():
+            new['is_alive'] = True
+            if state['connector']:
+                state['connector'].update(new) #the dict may be referenced from other lists (mainConnectors)
+            else:
+                state['connector'] = new
+                self.connectors.append(new)
+            attempts = state['failures'] + 1
+            started, late = state['started'], state['late'] #started is set for the first start only
+            state.update({'state': 'UP', 'failures': 0, 'exhausted': False, 'started': None, 'late': False})
+            if not started:
+                self.report('Connector %s RECOVERED (attempts: %d)' % (state['name'], attempts))
+            elif late:
+                self.report('Connector %s started in %d seconds' % (state['name'], monotonic() - started))
+            else:
+                self.logger.info('Connector %s started' % state['name'])
+        else:
+            state['started'], state['late'] = None, False
+            state['failures'] += 1
+            state['state'] = 'DOWN'
+            state['next_attempt'] = monotonic() + self.delay(state['failures'])
+            self.logger.warning('Connector %s start failed. Next attempt in %d seconds' % (state['name'], state['next_attempt'] - monotonic()))
+
+    def report(self, msg, level=logging.INFO):
+        """Logs state change and sends it to user"""
+        self.logger.log(level, msg)
+        try:
+            self.notify(msg)
+        except Exception as err:
+            self.logger.error('Sending message failed: %s' % err)
+
+    def status(self):
+        """Returns text with connectors states"""
+        lines = []
+        for state in self.states.values():
+            line = '%s: %s, restarts: %d' % (state['name'], state['state'], len(state['attempts']))
+            if state['connector']:
+                outbox = state['connector']['connector'].outboxStatus()
+                line += ', outbox: %d (%.0f s), sent: %d, failed: %d' % (outbox['depth'], outbox['age'], outbox['sent'], outbox['failed'])
+            lines.append(line)
+        return '\n'.join(lines)
@@ -8,6 +8,9 @@ from qmessenger import QMessenger
 from datetime import datetime
 
 class QTelegramMessenger(QMessenger):
+    #Bot API limits: about 30 messages per second, 1 message per second to the same chat
+    RATE_LIMIT = {'rate': 30, 'burst': 30, 'recipient_rate': 1, 'recipient_burst': 3}
+    MAX_FILE_SIZE = 50 * 1024 * 1024 #Bot API sendDocument limit
     def __init__(self, **config):
         QMessenger.__init__(self, **config, VERSION=VERSION)
         self.url = config['url']
@@ -77,42 +80,61 @@ class QTelegramMessenger(QMessenger):
         i = 0
         params = {'chat_id': to}
         self.sendStatusText = 'OK'
+        retries = 0
         try:
-            while i <= len(msg):
+            while i < len(msg) or i == 0: #the last part may be exactly MAX_MESSAGE_LENGTH long
                 j = i+self.MAX_MESSAGE_LENGTH if i+self.MAX_MESSAGE_LENGTH <= len(msg) else len(msg)
                 params['text'] = msg[i:j]
+                if i or retries: #the first request is throttled by deliver()
+                    self.throttle(to)
                 response = requests.post(self.url + 'sendMessage', data=params, proxies = self.proxies)
+                if response.status_code == 429 and retries < self.FLOOD_RETRIES: #Too many requests. Send the part again later
+                    retries += 1
+                    self.floodWait(self.retryAfter(response))
+                    continue
+                response.raise_for_status()
                 i += self.MAX_MESSAGE_LENGTH
         except Exception as err:
             self.sendStatusText = "Send message failed: %s" % (err)
-            self.logger.error(self.sendStatusText)        
+            self.logger.error(self.sendStatusText)
+            return False
         self.sendStatusText = 'sendMessage - %s' % response
         self.logger.debug(self.sendStatusText)
             
     
-    def reply(self, msg, originalCommand):
+    def retryAfter(self, response):
+        """Returns 'retry_after' seconds from 429 response"""
+        try:
+            return response.json()['parameters']['retry_after']
+        except Exception:
+            return 5
+
+    def sendReply(self, msg, originalCommand):
         return self.sendMessage(msg, originalCommand['message']['message']['chat']['id'])
     
     
     def sendFile(self, to, fileName):
         if not os.path.exists(fileName):
-            res = "%s doesn't exist" % fileName
-            self.logger.debug(res)
-            return res
+            self.logger.error("%s doesn't exist" % fileName)
+            return False
         
         params = {'chat_id':to}
-        files = {'document': open(fileName, 'rb')}
         try:
-            resp = requests.post(self.url+'sendDocument', files=files, data=params, proxies=self.proxies)
+            with open(fileName, 'rb') as f:
+                resp = requests.post(self.url+'sendDocument', files={'document': f}, data=params, proxies=self.proxies)
             if resp.ok:
                 res = resp.json()
+                self.logger.debug(res)
             else:
                 res = "sendFile failed: %s" % resp.reason
-            self.logger.debug(res)
+                self.logger.error(res)
+                self.sendStatusText = res
+                return False
         except Exception as err:
             res = 'sendFile failed: %s' % err
             self.logger.error(res)
-            self.sendStatusText = res        
+            self.sendStatusText = res
+            return False
         return res
     
     #file is native variable message['file']
@@ -120,21 +142,18 @@ class QTelegramMessenger(QMessenger):
         if not path:
             path = self.savedir
         self.logger.debug(file)
-        file_content = None
-        sz0 = file['file_size']
+        sz0 = file['file_size'] if 'file_size' in file.keys() else None
         #Photos don't have file_name key
         fileFullName = "%s/%s" %(path, file['file_name'])
         resp = requests.get(self.url+'getFile', data={'file_id':file['file_id']}, proxies=self.proxies)
         if resp.ok:
             file_path = resp.json()['result']['file_path']
-            res = requests.get(self.file_url+file_path, proxies=self.proxies)
-            sz = 0
-            if res.status_code == 200:
-                fil = open(fileFullName, 'wb')
-                sz = fil.write(res.content)
-                resStr = '%s: %d/%d bytes' % (fileFullName, sz, sz0)
-            else:
-                resStr = '%s - error: %s' % (fileFullName, resp.json())
+            try:
+                sz, digest = self.download(self.file_url+file_path, fileFullName, sz0, proxies=self.proxies)
+                resStr = '%s: %d/%s bytes, sha256 %s' % (fileFullName, sz, sz0, digest)
+            except Exception as err:
+                resStr = '%s - error: %s' % (fileFullName, err)
+                self.logger.error(resStr)
         else:
             resStr = '%s - error: %s' % (fileFullName, resp.json())
         return resStr
@@ -0,0 +1,266 @@
+#!/usr/bin/python3
+"""Chunked file transfer for qbot connectors (Get file, File, Resume transfer, Transfers commands)
+
+Files bigger than connector MAX_FILE_SIZE are sent by parts: NAME.ID.manifest first, then NAME.ID.partNNN-of-MMM.
+ID is the beginning of the file sha256, the manifest keeps size and sha256 of the file and of every part.
+Every part confirmed by sendFile() is saved to transfer/out/ID.json, so an interrupted transfer is resumed
+from the next part ('Resume transfer ID') by the same connector to the same address. Received parts are collected in transfer/in/ID/ and checked by the
+manifest. When all of them are there, the file is assembled to download/ (or update/ if the manifest says so)
+and checked by its sha256. Parts may come in any order and by any connector implementing sendFile()/get_file().
+
+Splitting a file to send it to qbot (target: download or update):
+    python3 run/qtransfer.py split [--size BYTES] [--target download|update] FILE [OUTPUT_DIR]
+"""
+
+import os
+import re
+import json
+import shutil
+import hashlib
+import argparse
+from qbackup import file_hash, READ_SIZE
+
+CHUNK_SIZE = 10 * 1024 * 1024
+PART_NAME = re.compile(r'^(?P<name>.+)\.(?P<id>[0-9a-f]{12})\.(?:part(?P<n>\d{3,})-of-(?P<total>\d{3,})|manifest)$')
+
+def part_name(manifest, n):
+    """Returns file name of part n (0 based)"""
+    return '%s.%s.part%03d-of-%03d' % (manifest['name'], manifest['id'], n + 1, len(manifest['chunks']))
+
+def manifest_name(manifest):
+    return '%s.%s.manifest' % (manifest['name'], manifest['id'])
+
+def copy_range(fileName, start, size, destination):
+    """Copies size bytes of fileName from start to destination. Returns sha256"""
+    h = hashlib.sha256()
+    with open(fileName, 'rb') as src, open(destination, 'wb') as dst:
+        src.seek(start)
+        while size > 0:
+            block = src.read(min(READ_SIZE, size))
+            if not block:
+                break
+            h.update(block)
+            dst.write(block)
+            size -= len(block)
+    return h.hexdigest()
+
+def make_manifest(fileName, chunk_size, target='download'):
+    """Returns manifest of fileName split by chunk_size bytes. Parts are hashed by one reading"""
+    size = os.path.getsize(fileName)
+    whole, chunks = hashlib.sha256(), []
+    with open(fileName, 'rb') as f:
+        for start in range(0, max(size, 1), chunk_size):
+            h, rest = hashlib.sha256(), min(chunk_size, size - start)
+            while rest > 0:
+                block = f.read(min(READ_SIZE, rest))
+                if not block:
+                    break
+                h.update(block)
+                whole.update(block)
+                rest -= len(block)
+            chunks.append(h.hexdigest())
+    digest = whole.hexdigest()
+    return {'id': digest[:12], 'name': os.path.basename(fileName), 'size': size, 'sha256': digest,
+            'chunk_size': chunk_size, 'chunks': chunks, 'target': target}
+
+def split(fileName, chunk_size=CHUNK_SIZE, folder='.', target='download'):
+    """Writes manifest and parts of fileName to folder. Returns list of file names, the manifest first"""
+    manifest = make_manifest(fileName, chunk_size, target)
+    res = [os.path.join(folder, manifest_name(manifest))]
+    with open(res[0], 'w') as f:
+        json.dump(manifest, f)
+    for n in range(len(manifest['chunks'])):
+        res.append(os.path.join(folder, part_name(manifest, n)))
+        copy_range(fileName, n * chunk_size, chunk_size, res[-1])
+    return res
+
+class QTransfer:
+    """Outgoing transfers state and incoming parts"""
+    def __init__(self, root='transfer', targets=None):
+        """root - state directory, targets - {manifest target: directory} where received files are assembled"""
+        self.root = root
+        self.outdir = os.path.join(root, 'out')
+        self.indir = os.path.join(root, 'in')
+        self.targets = targets if targets else {'download': 'download', 'update': 'update'}
+
+    def is_part(self, fileName):
+        """True if fileName is a transfer part or manifest"""
+        return PART_NAME.match(os.path.basename(fileName)) is not None
+
+    def save_state(self, state):
+        os.makedirs(self.outdir, exist_ok=True)
+        fileName = os.path.join(self.outdir, '%s.json' % state['manifest']['id'])
+        with open('%s.tmp' % fileName, 'w') as f:
+            json.dump(state, f)
+        os.replace('%s.tmp' % fileName, fileName)
+
+    def send(self, connector, to, fileName, chunk_size=0):
+        """Sends fileName by connector. Files above chunk_size bytes are sent by parts (0 - always as one file)
+
+        Returns text about transfer. Interrupted transfer keeps its state for resume()
+        """
+        if not os.path.isfile(fileName):
+            return "%s doesn't exist" % fileName
+        if not chunk_size or os.path.getsize(fileName) <= chunk_size:
+            res = connector.transmitFile(to, fileName)
+            return 'Sending %s failed' % fileName if res is False else '%s sent' % fileName
+        manifest = make_manifest(fileName, chunk_size)
+        state = {'file': os.path.abspath(fileName), 'connector': connector.connectorName, 'to': to, 'manifest': manifest, 'sent': 0}
+        stateFile = os.path.join(self.outdir, '%s.json' % manifest['id'])
+        if os.path.exists(stateFile): #the same content was being sent
+            with open(stateFile) as f:
+                old = json.load(f)
+            if old['manifest'] == manifest and old['to'] == to and old.get('connector') == state['connector']:
+                state = old
+        return self.send_parts(connector, state)
+
+    def resume(self, connector, id, connectors=None):
+        """Continues outgoing transfer id from the first part not confirmed
+
+        The parts go by the connector the transfer was started by, its address belongs to that one. connector - the one
+        the command came from, connectors - {name: connector} to find the original connector if it's another one
+        """
+        stateFile = os.path.join(self.outdir, '%s.json' % id)
+        if not os.path.exists(stateFile):
+            return 'No transfer %s. See Transfers' % id
+        with open(stateFile) as f:
+            state = json.load(f)
+        name = state.get('connector', connector.connectorName) #transfers saved before connector was kept
+        if name != connector.connectorName:
+            connector = connectors.get(name) if connectors else None
+            if not connector:
+                return 'Transfer %s is sent by %s to %s, the connector is not running. Resume it when %s works' % (id, name, state['to'], name)
+        if not os.path.isfile(state['file']) or os.path.getsize(state['file']) != state['manifest']['size']:
+            return '%s changed or deleted. Send it again' % state['file']
+        return self.send_parts(connector, state)
+
+    def send_parts(self, connector, state):
+        """Sends manifest (step 0) and parts (steps 1..N) from state['sent']"""
+        manifest = state['manifest']
+        folder = os.path.join(self.outdir, manifest['id'])
+        os.makedirs(folder, exist_ok=True)
+        total = len(manifest['chunks']) + 1
+        started = state['sent']
+        while state['sent'] < total:
+            step = state['sent']
+            if step == 0:
+                partFile = os.path.join(folder, manifest_name(manifest))
+                with open(partFile, 'w') as f:
+                    json.dump(manifest, f)
+            else:
+                partFile = os.path.join(folder, part_name(manifest, step - 1))
+                digest = copy_range(state['file'], (step - 1) * manifest['chunk_size'], manifest['chunk_size'], partFile)
+                if digest != manifest['chunks'][step - 1]:
+                    os.remove(partFile)
+                    return '%s changed while sending. Send it again' % state['file']
+            ok = connector.transmitFile(state['to'], partFile) is not False
+            os.remove(partFile)
+            if not ok:
+                self.save_state(state)
+                return '%s: %d of %d parts sent, interrupted. Resume transfer %s' % (manifest['name'], max(step - 1, 0), total - 1, manifest['id'])
+            state['sent'] += 1
+            self.save_state(state)
+        os.remove(os.path.join(self.outdir, '%s.json' % manifest['id']))
+        shutil.rmtree(folder, ignore_errors=True)
+        return '%s sent by %d parts%s' % (manifest['name'], total - 1, ', resumed from part %d' % started if started else '')
+
+    def receive(self, fileName):
+        """Takes downloaded part or manifest fileName. Returns text about transfer, assembles the file when all parts are here"""
+        m = PART_NAME.match(os.path.basename(fileName))
+        if not m:
+            return '%s is not a transfer part' % fileName
+        folder = os.path.join(self.indir, m.group('id'))
+        os.makedirs(folder, exist_ok=True)
+        os.replace(fileName, os.path.join(folder, os.path.basename(fileName)))
+        manifest = self.incoming_manifest(m.group('id'))
+        if not manifest:
+            return '%s: part received, waiting for manifest' % m.group('name')
+        missing = self.missing(manifest)
+        if missing:
+            return '%s: %d of %d parts received. Missing: %s' % (manifest['name'], len(manifest['chunks']) - len(missing),
+                                                                len(manifest['chunks']), compact([x + 1 for x in missing]))
+        return self.assemble(manifest)
+
+    def incoming_manifest(self, id):
+        """Returns manifest of incoming transfer id or None if it's not received yet"""
+        folder = os.path.join(self.indir, id)
+        for x in os.listdir(folder) if os.path.isdir(folder) else []:
+            if x.endswith('.manifest'):
+                with open(os.path.join(folder, x)) as f:
+                    manifest = json.load(f)
+                if manifest['id'] != id or manifest['target'] not in self.targets or os.path.basename(manifest['name']) != manifest['name']:
+                    raise ValueError('Wrong manifest %s' % x)
+                return manifest
+        return None
+
+    def missing(self, manifest):
+        """Returns numbers (0 based) of parts not received. Broken parts are deleted and count as missing"""
+        folder = os.path.join(self.indir, manifest['id'])
+        res = []
+        for n, digest in enumerate(manifest['chunks']):
+            partFile = os.path.join(folder, part_name(manifest, n))
+            if not os.path.exists(partFile):
+                res.append(n)
+            elif file_hash(partFile) != digest:
+                os.remove(partFile)
+                res.append(n)
+        return res
+
+    def assemble(self, manifest):
+        """Joins received parts to the target directory"""
+        folder = os.path.join(self.indir, manifest['id'])
+        target = os.path.join(self.targets[manifest['target']], manifest['name'])
+        tmp = '%s.transfer.tmp' % target
+        h = hashlib.sha256()
+        with open(tmp, 'wb') as dst:
+            for n in range(len(manifest['chunks'])):
+                with open(os.path.join(folder, part_name(manifest, n)), 'rb') as src:
+                    for block in iter(lambda: src.read(READ_SIZE), b''):
+                        h.update(block)
+                        dst.write(block)
+        if h.hexdigest() != manifest['sha256']:
+            os.remove(tmp)
+            shutil.rmtree(folder, ignore_errors=True)
+            return '%s: checksum mismatch, parts deleted. Send it again' % manifest['name']
+        os.replace(tmp, target)
+        shutil.rmtree(folder, ignore_errors=True)
+        return '%s: %d bytes received by %d parts' % (target, manifest['size'], len(manifest['chunks']))
+
+    def status(self):
+        """Returns text about incomplete outgoing and incoming transfers"""
+        lines = []
+        for x in sorted(os.listdir(self.outdir)) if os.path.isdir(self.outdir) else []:
+            if x.endswith('.json'):
+                with open(os.path.join(self.outdir, x)) as f:
+                    state = json.load(f)
+                lines.append('Out %s: %s to %s%s, %d of %d parts sent' % (state['manifest']['id'], state['file'], state['to'],
+                                                                         ' by %s' % state['connector'] if 'connector' in state else '',
+                                                                         max(state['sent'] - 1, 0), len(state['manifest']['chunks'])))
+        for id in sorted(os.listdir(self.indir)) if os.path.isdir(self.indir) else []:
+            manifest = self.incoming_manifest(id)
+            if manifest:
+                lines.append('In %s: %s, missing parts: %s' % (id, manifest['name'], compact([x + 1 for x in self.missing(manifest)])))
+            else:
+                lines.append('In %s: %d parts, no manifest' % (id, len(os.listdir(os.path.join(self.indir, id)))))
+        return '\n'.join(lines) if lines else 'No transfers'
+
+def compact(numbers):
+    """Returns '1-3, 5' for [1, 2, 3, 5]"""
+    res = []
+    for n in numbers:
+        if res and res[-1][1] == n - 1:
+            res[-1][1] = n
+        else:
+            res.append([n, n])
+    return ', '.join(['%d' % a if a == b else '%d-%d' % (a, b) for a, b in res])
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Split file to send it to qbot by parts')
+    parser.add_argument('action', choices=['split'])
+    parser.add_argument('--size', type=int, default=CHUNK_SIZE, help='part size in bytes (default %d)' % CHUNK_SIZE)
+    parser.add_argument('--target', default='download', choices=['download', 'update'], help='qbot directory for the file')
+    parser.add_argument('file')
+    parser.add_argument('output', nargs='?', default='.', help='directory for parts (default current)')
+    args = parser.parse_args()
+    for x in split(args.file, args.size, args.output, args.target):
+        print(x)
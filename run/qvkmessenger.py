@@ -3,7 +3,6 @@ VERSION = '1.2.7'
 import vk_api
 import threading
 import os
-import requests
 from datetime import datetime
 from time import sleep
 from vk_api.longpoll import VkLongPoll, VkEventType
@@ -13,6 +12,9 @@ class QVkMessenger(QMessenger):
     """VC (vc.com) connector for qbot"""
     MAX_MESSAGE_LENGTH = 4096
     MAX_MESSAGE_LENGTH_FOR_LOG = 80
+    #Community messages limit is 20 requests per second
+    RATE_LIMIT = {'rate': 20, 'burst': 20, 'recipient_rate': 1, 'recipient_burst': 3}
+    FLOOD_PAUSE = {6: 1, 9: 60} #API error code -> pause in seconds. 6 - too many requests per second, 9 - flood control
     def __init__(self, **config):
         QMessenger.__init__(self, VERSION=VERSION, **config)
         self.dvd_group_id = config['group_id']
@@ -56,33 +58,41 @@ class QVkMessenger(QMessenger):
         if not path:
             path = self.savedir
         fname = "%s/%s" %(os.path.normpath(path), file['file_name'])
-        resp = requests.get(file['url'])
-        if resp.ok:
-            fil = open(fname, 'wb')
-            sz = fil.write(resp.content)
-            fil.close()
-            res = "%s: %s/%s bytes" % (fname, sz, file['file_size'])
+        try:
+            sz, digest = self.download(file['url'], fname, file['file_size'])
+            res = "%s: %s/%s bytes, sha256 %s" % (fname, sz, file['file_size'], digest)
             self.logger.debug(res)
-        else:
-            res = '%s - error: %s' % (fname, resp.json())
+        except Exception as err:
+            res = '%s - error: %s' % (fname, err)
             self.logger.error(res)
         return res
         
-    def reply(self, msg, originalCommand):
+    def sendReply(self, msg, originalCommand):
         return self.sendMessage(msg, originalCommand['user_id'])
         
     def sendMessage(self, msg, to):
         i = 0
         self.sendStatusText = 'OK'
+        retries = 0
         try:
-            while i <= len(msg):
+            while i < len(msg) or i == 0: #the last part may be exactly MAX_MESSAGE_LENGTH long
                 j = i+self.MAX_MESSAGE_LENGTH if i+self.MAX_MESSAGE_LENGTH <= len(msg) else len(msg)
-                self.vk.messages.send(
-                    user_id=to,
-                    message=msg[i:j])
+                if i or retries: #the first request is throttled by deliver()
+                    self.throttle(to)
+                try:
+                    self.vk.messages.send(
+                        user_id=to,
+                        message=msg[i:j])
+                except vk_api.ApiError as err:
+                    if err.code not in self.FLOOD_PAUSE or retries >= self.FLOOD_RETRIES:
+                        raise
+                    retries += 1
+                    self.floodWait(self.FLOOD_PAUSE[err.code])
+                    continue
                 i += self.MAX_MESSAGE_LENGTH
         except Exception as err:
             self.sendStatusText = "Send message failed: %s" % (err)
             self.logger.error(self.sendStatusText)
+            return False
         self.logger.debug('Message sent: %s' % (msg[0:self.MAX_MESSAGE_LENGTH_FOR_LOG]))
        
\ No newline at end of file
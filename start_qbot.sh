@@ -9,7 +9,8 @@ if [ -f 'update_flag' ]; then
 	echo "qbot is in updating mode. Num of starts: $i"
 	if [ $i -ne "0" ]; then
 		echo "Restoring previous version"
-		tar -xf backup/run.tar.gz 
+		#backup/qbackup.py is copied by update, archive - by old versions
+		/usr/bin/python3 backup/qbackup.py --store backup/store restore || tar -xf backup/run.tar.gz
 		rm update_flag
 	else
 		i=$(($i+1))
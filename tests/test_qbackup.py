@@ -0,0 +1,63 @@
+#!/usr/bin/python3
+"""Tests of backup store (run/qbackup.py). Run from repository root: python3 -m unittest discover tests"""
+
+import os
+import sys
+import shutil
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'run'))
+import qbackup
+
+class BackupStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.cwd = os.getcwd()
+        os.chdir(self.dir)
+        os.makedirs('run')
+        with open('run/qbot.py', 'w') as f:
+            f.write('qbot')
+        self.store = qbackup.QBackupStore('store')
+        self.store_file = qbackup.store_file
+
+    def tearDown(self):
+        qbackup.store_file = self.store_file
+        os.chdir(self.cwd)
+        shutil.rmtree(self.dir)
+
+    def test_prune_waits_for_snapshot(self):
+        stored, go = threading.Event(), threading.Event()
+        def slow_store(path, objects):
+            digest = self.store_file(path, objects)
+            stored.set() #the object is saved, the manifest is not yet
+            go.wait(5)
+            return digest
+        qbackup.store_file = slow_store
+        res = {}
+        saving = threading.Thread(target=lambda: res.update(manifest=self.store.snapshot('run', 'first')))
+        saving.start()
+        self.assertTrue(stored.wait(5))
+        pruning = threading.Thread(target=lambda: res.update(deleted=self.store.prune()))
+        pruning.start()
+        pruning.join(0.5)
+        self.assertTrue(pruning.is_alive()) #prune waits for the store lock
+        go.set()
+        saving.join(5)
+        pruning.join(5)
+        self.assertEqual(res['deleted'], [])
+        digest = res['manifest']['files']['run/qbot.py']['hash']
+        self.assertTrue(os.path.exists(self.store.object_path(digest)))
+        os.remove('run/qbot.py')
+        self.assertEqual(self.store.restore('first')[1], 1)
+        with open('run/qbot.py') as f:
+            self.assertEqual(f.read(), 'qbot')
+
+    def test_unique_names(self):
+        first, second = self.store.snapshot('run'), self.store.snapshot('run')
+        self.assertNotEqual(first['name'], second['name'])
+        self.assertEqual([x['name'] for x in self.store.manifests()], [first['name'], second['name']])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+#!/usr/bin/python3
+"""Tests of delta update packages (run/qdelta.py). Run from repository root: python3 -m unittest discover tests"""
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'run'))
+import qdelta
+
+def write(path, text):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        f.write(text)
+
+def read(path):
+    with open(path) as f:
+        return f.read()
+
+class DeltaTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.root = os.path.join(self.dir, 'root')
+        self.new = os.path.join(self.dir, 'new')
+        for folder in (os.path.join(self.root, 'run'), self.new):
+            write(os.path.join(folder, 'qbot.py'), 'old qbot')
+            write(os.path.join(folder, 'qlog.py'), 'old log')
+            write(os.path.join(folder, 'conf', 'qbot.yaml'), 'config')
+        write(os.path.join(self.root, 'run', 'qrpi.db'), 'data')
+        write(os.path.join(self.root, 'run', 'conf', 'local.yaml'), 'local config')
+        write(os.path.join(self.root, 'run', 'qold.py'), 'removed module')
+        write(os.path.join(self.new, 'qbot.py'), 'new qbot')
+        self.package = os.path.join(self.dir, 'delta.tar.gz')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def make(self):
+        base = qdelta.tree_hashes(os.path.join(self.root, 'run'), 'run')
+        return qdelta.make_delta(base, self.new, self.package)
+
+    def test_data_and_config_are_not_deleted(self):
+        header = self.make()
+        self.assertEqual(sorted(header['files']), ['run/qbot.py'])
+        self.assertEqual(header['deleted'], ['run/qold.py'])
+        self.assertEqual(sorted(header['base']), ['run/qbot.py', 'run/qold.py'])
+        qdelta.apply_delta(self.package, self.root)
+        self.assertEqual(read(os.path.join(self.root, 'run', 'qbot.py')), 'new qbot')
+        self.assertFalse(os.path.exists(os.path.join(self.root, 'run', 'qold.py')))
+        self.assertEqual(read(os.path.join(self.root, 'run', 'qrpi.db')), 'data')
+        self.assertEqual(read(os.path.join(self.root, 'run', 'conf', 'local.yaml')), 'local config')
+
+    def test_files_out_of_delta_may_change(self):
+        self.make()
+        write(os.path.join(self.root, 'run', 'qrpi.db'), 'new sensor data')
+        write(os.path.join(self.root, 'run', 'qlog.py'), 'local fix')
+        write(os.path.join(self.root, 'run', 'conf', 'qbot.yaml'), 'local config')
+        header = qdelta.read_header(self.package)
+        self.assertEqual(qdelta.check_base(header, self.root), [])
+        qdelta.apply_delta(self.package, self.root)
+        self.assertEqual(read(os.path.join(self.root, 'run', 'qbot.py')), 'new qbot')
+        self.assertEqual(read(os.path.join(self.root, 'run', 'qlog.py')), 'local fix')
+
+    def test_changed_base_of_delta_refused(self):
+        self.make()
+        write(os.path.join(self.root, 'run', 'qbot.py'), 'another qbot')
+        self.assertEqual(qdelta.check_base(qdelta.read_header(self.package), self.root), ['run/qbot.py: changed'])
+
+if __name__ == '__main__':
+    unittest.main()
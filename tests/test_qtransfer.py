@@ -0,0 +1,53 @@
+#!/usr/bin/python3
+"""Tests of chunked file transfer (run/qtransfer.py). Run from repository root: python3 -m unittest discover tests"""
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'run'))
+from qtransfer import QTransfer
+
+class Connector:
+    """Connector stub keeping the files sent"""
+    def __init__(self, name, ok=True):
+        self.connectorName = name
+        self.ok = ok
+        self.sent = []
+
+    def transmitFile(self, to, fileName):
+        if not self.ok:
+            return False
+        self.sent.append((to, os.path.basename(fileName)))
+
+class ResumeTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.fileName = os.path.join(self.dir, 'data.bin')
+        with open(self.fileName, 'wb') as f:
+            f.write(os.urandom(2500))
+        self.transfer = QTransfer(os.path.join(self.dir, 'transfer'))
+        self.telegram = Connector('telegram', ok=False)
+        self.vk = Connector('vk')
+        self.transfer.send(self.telegram, 'chat', self.fileName, 1000)
+        self.id = [x for x in os.listdir(self.transfer.outdir) if x.endswith('.json')][0][:-len('.json')]
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_resume_by_original_connector(self):
+        self.telegram.ok = True
+        res = self.transfer.resume(self.vk, self.id, {'vk': self.vk, 'telegram': self.telegram})
+        self.assertEqual(res, 'data.bin sent by 3 parts')
+        self.assertEqual(self.vk.sent, [])
+        self.assertEqual([to for to, _ in self.telegram.sent], ['chat'] * 4)
+
+    def test_original_connector_not_running(self):
+        res = self.transfer.resume(self.vk, self.id, {'vk': self.vk})
+        self.assertIn('not running', res)
+        self.assertEqual(self.vk.sent, [])
+
+if __name__ == '__main__':
+    unittest.main()